@@ -50,6 +50,35 @@ VALID_AMINOACIDS = [
     "Y",
 ]
 
+# Natural frequencies (%) of the amino acids in UniProtKB/Swiss-Prot, used to sample the reference peptides of the
+# percentile ranks
+AMINOACID_FREQUENCIES = {
+    "A": 8.25,
+    "C": 1.37,
+    "E": 6.75,
+    "D": 5.45,
+    "G": 7.07,
+    "F": 3.86,
+    "I": 5.96,
+    "H": 2.27,
+    "K": 5.84,
+    "M": 2.42,
+    "L": 9.66,
+    "N": 4.06,
+    "Q": 3.93,
+    "P": 4.70,
+    "S": 6.56,
+    "R": 5.53,
+    "T": 5.34,
+    "W": 1.08,
+    "V": 6.87,
+    "Y": 2.92,
+}
+
+# percentile ranks: number of reference peptides scored for each hla and number of quantiles stored (every 0.1%)
+RANK_REFERENCE_SIZE = 100000
+RANK_LEVELS = 1001
+
 # minimum structural crystal evidence
 THRESHOLD = {8: 0, 9: 0, 10: 0, "default": 0}
 
@@ -0,0 +1,139 @@
+import bisect
+import os
+
+import numpy as np
+from hlaizer import iedb_reader
+
+
+class AlignmentStore:
+    """
+    Indexed access to a file with the HLA sequences in selex format.
+    Only the name and the byte offset of each sequence are kept in memory, and the sequences are read
+    from the file when they are requested. The index is saved next to the file (file.idx.npz) and reused
+    while the file does not change.
+    """
+
+    def __init__(self, aligment_file, index_file=None):
+        """
+        :param aligment_file: file with the HLA sequences in selex format
+        :param index_file: file where the index is saved (default aligment_file.idx.npz, None to not save it)
+        """
+        self.aligment_file = aligment_file
+        if index_file is None:
+            index_file = "%s.idx.npz" % aligment_file
+        self.index_file = index_file
+        self.names = []  # sorted hla names
+        self.offsets = np.zeros(0, dtype=np.int64)  # offset of the line of each hla
+        self._load_index()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, hla):
+        return self._position(hla) is not None
+
+    def _position(self, hla):
+        # Index of an hla in names (None if it is not present)
+        position = bisect.bisect_left(self.names, hla)
+        if position < len(self.names) and self.names[position] == hla:
+            return position
+        return None
+
+    def _load_index(self):
+        # Loads the saved index, or builds it if the file changed since it was saved
+        key = iedb_reader.file_key(self.aligment_file)
+        if self.index_file and os.path.exists(self.index_file):
+            try:
+                with np.load(self.index_file, allow_pickle=False) as index:
+                    if str(index["key"]) == key:
+                        self.names = index["names"].tolist()
+                        self.offsets = index["offsets"]
+                        return
+            except (OSError, ValueError, KeyError):
+                pass
+        self._build_index()
+        if self.index_file:
+            tmp_file = "%s.tmp" % self.index_file
+            try:
+                with open(tmp_file, "wb") as f:
+                    np.savez(
+                        f,
+                        key=np.array(key),
+                        names=np.array(self.names, dtype=str),
+                        offsets=self.offsets,
+                    )
+                os.replace(tmp_file, self.index_file)
+            except OSError as e:
+                print(
+                    "Could not save the alignment index %s: %s" % (self.index_file, e)
+                )
+
+    def _build_index(self):
+        # Reads the offset of the line of each hla (the first one if an hla is repeated)
+        offsets = {}
+        with open(self.aligment_file, "rb") as inn:
+            offset = 0
+            for line in inn:
+                fields = line.split(None, 1)
+                if fields:
+                    hla = fields[0].decode("utf-8", "replace")
+                    offsets.setdefault(hla, offset)
+                offset += len(line)
+        self.names = sorted(offsets)
+        self.offsets = np.array([offsets[hla] for hla in self.names], dtype=np.int64)
+
+    def get(self, hla):
+        """
+        Reads the sequence of an hla
+        :param hla: exact hla name
+        :return: sequence (None if the hla is not present)
+        """
+        if hla not in self:
+            return None
+        return self.select([hla])[hla]
+
+    def _read(self, inn, hla):
+        # Reads the sequence of an hla from the opened file
+        inn.seek(int(self.offsets[self._position(hla)]))
+        return inn.readline().decode("utf-8", "replace").split()[1]
+
+    def with_prefix(self, prefix):
+        # Names of the hlas that start with the given prefix (for example an allele group like HLA-A*02)
+        position = bisect.bisect_left(self.names, prefix)
+        hlas = []
+        while position < len(self.names) and self.names[position].startswith(prefix):
+            hlas.append(self.names[position])
+            position += 1
+        return hlas
+
+    def select(self, hlas):
+        """
+        Reads the sequences of the given hlas. Names that are not an exact hla are used as prefixes.
+        :param hlas: list of hla names or prefixes
+        :return: dict {hla: sequence}
+        """
+        aligment_dict = {}
+        with open(self.aligment_file, "rb") as inn:
+            for query in hlas:
+                names = [query] if query in self else self.with_prefix(query)
+                for hla in names:
+                    if hla not in aligment_dict:
+                        aligment_dict[hla] = self._read(inn, hla)
+        return aligment_dict
+
+    @staticmethod
+    def select_from_dict(aligment_dict, hlas):
+        # Same as select for an alignment that is already loaded in a dict {hla: sequence}
+        selected = {}
+        for query in hlas:
+            if query in aligment_dict:
+                selected[query] = aligment_dict[query]
+                continue
+            for hla, sequence in aligment_dict.items():
+                if hla.startswith(query):
+                    selected.setdefault(hla, sequence)
+        return selected
+
+    def to_dict(self):
+        # Reads all the sequences (as Parser.parse_aligment_file)
+        return self.select(self.names)
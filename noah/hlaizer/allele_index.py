@@ -0,0 +1,103 @@
+import bisect
+
+# Characters that separate the fields of an allele name (HLA-A*02:01)
+FIELD_SEPARATORS = "*:"
+
+
+def normalize_allele(name):
+    """
+    Normalizes the writing of an allele name, so aliases like "HLA-A*02:01", "A*02:01", "hla-a0201" or "A0201"
+    are the same name ("A0201")
+    :param name: allele name
+    :return: normalized name
+    """
+    name = name.strip().upper()
+    if name.startswith("HLA-"):
+        name = name[4:]
+    return name.replace("*", "").replace(":", "").replace("-", "")
+
+
+def field_ends(name):
+    """
+    Lengths of the normalized name (see normalize_allele) at which each field of an allele name ends, so
+    "HLA-A*02:01" ("A0201") gives {1, 3, 5}
+    :param name: allele name
+    :return: set of lengths
+    """
+    name = name.strip().upper()
+    if name.startswith("HLA-"):
+        name = name[4:]
+    ends = set()
+    length = 0
+    for letter in name:
+        if letter in FIELD_SEPARATORS:
+            ends.add(length)
+        elif letter != "-":
+            length += 1
+    ends.add(length)
+    return ends
+
+
+class AlleleIndex:
+    """
+    Sorted index of allele names that resolves a query to the alleles it refers to: the allele with that exact name,
+    all the alleles that start with it (an allele group such as HLA-A*02) or, if there is none, the alleles that
+    match it once the names are normalized (see normalize_allele). A prefix only matches whole fields, so a
+    truncated name such as HLA-A*02:0 matches no allele. The result of each query is memoized.
+    """
+
+    def __init__(self, names):
+        """
+        :param names: list of allele names
+        """
+        self.names = sorted(set(names))
+        self.normalized = sorted((normalize_allele(name), name) for name in self.names)
+        self.normalized_keys = [x[0] for x in self.normalized]
+        self.field_ends = {name: field_ends(name) for name in self.names}
+        self.queries = {}  # {query: [alleles]}
+
+    def __contains__(self, name):
+        position = bisect.bisect_left(self.names, name)
+        return position < len(self.names) and self.names[position] == name
+
+    @staticmethod
+    def _with_prefix(keys, prefix):
+        # Range of the sorted keys that start with the prefix
+        start = bisect.bisect_left(keys, prefix)
+        end = start
+        while end < len(keys) and keys[end].startswith(prefix):
+            end += 1
+        return start, end
+
+    def resolve(self, query):
+        """
+        Finds the alleles that a query refers to
+        :param query: allele name, allele group prefix or alias
+        :return: sorted list of allele names (empty if none matches)
+        """
+        try:
+            return self.queries[query]
+        except KeyError:
+            pass
+        if query in self:
+            alleles = [query]
+        else:
+            start, end = self._with_prefix(self.names, query)
+            alleles = [
+                name
+                for name in self.names[start:end]
+                if query[-1:] in FIELD_SEPARATORS
+                or name[len(query)] in FIELD_SEPARATORS
+            ]
+            normalized_query = normalize_allele(query)
+            if not alleles and normalized_query:
+                # The fields of the query have to end where the fields of the allele end
+                query_ends = field_ends(query)
+                start, end = self._with_prefix(self.normalized_keys, normalized_query)
+                alleles = sorted(
+                    name
+                    for _, name in self.normalized[start:end]
+                    if query_ends <= self.field_ends[name]
+                )
+        self.queries[query] = alleles
+        return alleles
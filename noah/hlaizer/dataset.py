@@ -0,0 +1,253 @@
+import numpy as np
+from constants.constants import NEGATIVE, POSITIVE_HIGH, VALID_AMINOACIDS
+from utilities import peptide_keys
+
+# Entries of each length kept as tuples before they are encoded
+ENCODE_CHUNK = 100000
+
+
+class EncodedDataset:
+    """
+    Columnar representation of the peptides of one length: each peptide is a row of letter indexes
+    (uint8, len(valid_letters) marks an invalid letter) and the hla and the qualitative value of each
+    entry are stored as small integer codes
+    """
+
+    def __init__(
+        self,
+        peptides,
+        alleles,
+        labels,
+        allele_names,
+        label_names,
+        valid_letters=VALID_AMINOACIDS,
+    ):
+        """
+        :param peptides: uint8 array (N, length) with the index of each letter in valid_letters
+        :param alleles: array (N,) with the index of the hla of each entry in allele_names
+        :param labels: array (N,) with the index of the qualitative value of each entry in label_names
+        :param allele_names: list of hlas
+        :param label_names: list of qualitative values
+        :param valid_letters: list of valid amino acids
+        """
+        self.peptides = peptides
+        self.alleles = alleles
+        self.labels = labels
+        self.allele_names = list(allele_names)
+        self.label_names = list(label_names)
+        self.valid_letters = list(valid_letters)
+        self.length = peptides.shape[1]
+
+    def __len__(self):
+        return len(self.alleles)
+
+    @staticmethod
+    def encode_peptides(peptides, length, valid_letters=VALID_AMINOACIDS):
+        """
+        Encodes peptides of the same length as a matrix of letter indexes
+        :param peptides: list of peptides
+        :param length: length of the peptides
+        :param valid_letters: list of valid amino acids
+        :return: uint8 array (N, length), letters not in valid_letters get the index len(valid_letters)
+        """
+        return peptide_keys.letter_codes(peptides, length, valid_letters)
+
+    def peptide_keys(self):
+        # Peptides packed as uint64 keys (see utilities.peptide_keys)
+        return peptide_keys.encode_codes(self.peptides, self.valid_letters)
+
+    def decode_peptides(self):
+        # Returns the peptides as strings
+        letters = np.array([ord(letter) for letter in self.valid_letters] + [ord("X")])
+        buffer = letters.astype(np.uint8)[self.peptides]
+        return (
+            np.ascontiguousarray(buffer).view("S%s" % self.length).ravel().astype(str)
+        )
+
+    @classmethod
+    def from_entries_by_length(
+        cls, entries, lengths, hla_set=None, valid_letters=VALID_AMINOACIDS
+    ):
+        """
+        Encodes the entries with peptides of the given lengths and valid letters. The entries are read once
+        and encoded in chunks of ENCODE_CHUNK, so only the encoded columns are kept in memory.
+        :param entries: iterable of tuples (peptide, hla, qualitative_value)
+        :param lengths: lengths of the peptides to keep
+        :param hla_set: hlas to keep (None keeps all of them)
+        :param valid_letters: list of valid amino acids
+        :return: dict {length: EncodedDataset}, the datasets share the (sorted) hlas and qualitative values
+        """
+        allele_index = {}  # {hla: code}, in the order they appear
+        label_index = {}  # {qualitative_value: code}
+        pending = {length: [] for length in lengths}
+        columns = {length: ([], [], []) for length in lengths}
+
+        def encode(length):
+            selected = pending[length]
+            peptides = cls.encode_peptides(
+                [entry[0] for entry in selected], length, valid_letters
+            )
+            alleles = np.array(
+                [
+                    allele_index.setdefault(entry[1], len(allele_index))
+                    for entry in selected
+                ],
+                dtype=np.uint32,
+            )
+            labels = np.array(
+                [
+                    label_index.setdefault(entry[2], len(label_index))
+                    for entry in selected
+                ],
+                dtype=np.uint8,
+            )
+            valid = np.all(peptides < len(valid_letters), axis=1)
+            for column, values in zip(columns[length], (peptides, alleles, labels)):
+                column.append(values[valid])
+            pending[length] = []
+
+        for entry in entries:
+            if not entry[0] or not entry[1] or not entry[2]:
+                continue
+            if len(entry[0]) not in pending or (
+                hla_set is not None and entry[1] not in hla_set
+            ):
+                continue
+            pending[len(entry[0])].append(entry)
+            if len(pending[len(entry[0])]) >= ENCODE_CHUNK:
+                encode(len(entry[0]))
+        for length in lengths:
+            if pending[length]:
+                encode(length)
+
+        # The codes follow the sorted names, whatever the order of the entries
+        allele_names = sorted(allele_index)
+        label_names = sorted(label_index)
+        allele_codes = np.zeros(len(allele_index), dtype=np.uint32)
+        for i, hla in enumerate(allele_names):
+            allele_codes[allele_index[hla]] = i
+        label_codes = np.zeros(len(label_index), dtype=np.uint8)
+        for i, qual in enumerate(label_names):
+            label_codes[label_index[qual]] = i
+        datasets = {}
+        for length in lengths:
+            peptides, alleles, labels = columns[length]
+            if not peptides:
+                peptides = [np.zeros((0, length), dtype=np.uint8)]
+                alleles = [np.zeros(0, dtype=np.uint32)]
+                labels = [np.zeros(0, dtype=np.uint8)]
+            datasets[length] = cls(
+                np.concatenate(peptides),
+                allele_codes[np.concatenate(alleles)],
+                label_codes[np.concatenate(labels)],
+                allele_names,
+                label_names,
+                valid_letters,
+            )
+        return datasets
+
+    def subset(self, mask):
+        # Returns a dataset with the entries selected by a boolean mask (or an array of indexes)
+        return EncodedDataset(
+            self.peptides[mask],
+            self.alleles[mask],
+            self.labels[mask],
+            self.allele_names,
+            self.label_names,
+            self.valid_letters,
+        )
+
+    def _group_ids(self, with_label=True):
+        # One integer for each different (peptide, hla) or (peptide, hla, qualitative value)
+        if self.length <= peptide_keys.MAX_LENGTH:
+            _, peptide_ids = peptide_keys.unique_keys(
+                self.peptide_keys(), return_inverse=True
+            )
+        else:
+            # Too long to be packed in one key
+            _, peptide_ids = np.unique(self.peptides, axis=0, return_inverse=True)
+        ids = peptide_ids.ravel().astype(np.int64) * len(self.allele_names)
+        ids += self.alleles
+        if with_label:
+            ids = ids * len(self.label_names) + self.labels
+        return ids
+
+    def deduplicate(self):
+        # Returns a dataset where each (peptide, hla, qualitative value) appears only once
+        if not len(self):
+            return self
+        _, index = np.unique(self._group_ids(), return_index=True)
+        return self.subset(np.sort(index))
+
+    def remove_conflicts(self):
+        """
+        Removes the peptides that appear more than once on a given hla with different qualitative values
+        (all the entries of the peptide are removed for that hla)
+        :return: EncodedDataset
+        """
+        dataset = self.deduplicate()
+        if not len(dataset):
+            return dataset
+        _, inverse, counts = np.unique(
+            dataset._group_ids(with_label=False),
+            return_inverse=True,
+            return_counts=True,
+        )
+        return dataset.subset(counts[inverse.ravel()] == 1)
+
+    def label_counts(self, label):
+        # Number of entries of each hla (in allele_names order) with the given qualitative value
+        if label not in self.label_names:
+            return np.zeros(len(self.allele_names), dtype=np.int64)
+        mask = self.labels == self.label_names.index(label)
+        return np.bincount(self.alleles[mask], minlength=len(self.allele_names))
+
+    def without_hlas(self, hlas):
+        # Returns a dataset without the entries of the given hlas
+        codes = [
+            self.allele_names.index(hla) for hla in hlas if hla in self.allele_names
+        ]
+        return self.subset(~np.isin(self.alleles, codes))
+
+    def select_hlas(self, minimum_data_signal, minimum_data_background):
+        """
+        Selects the hlas that reach the minimum data requirements
+        :param minimum_data_signal: minimum number of binding peptides
+        :param minimum_data_background: minimum number of non binding peptides
+        :return: list of hlas
+        """
+        selected = (self.label_counts(POSITIVE_HIGH) >= minimum_data_signal) & (
+            self.label_counts(NEGATIVE) >= minimum_data_background
+        )
+        return [self.allele_names[i] for i in np.flatnonzero(selected)]
+
+    def to_test_data(self, hlas=None):
+        """
+        Converts the peptides of the given hlas to the dictionary used to test the models
+        :param hlas: hlas to convert (None converts all of them)
+        :return: test_data {hla: {qualitative_value : set(peptides)}}
+        """
+        test_data = {}
+        dataset = self
+        if hlas is not None:
+            codes = [self.allele_names.index(x) for x in hlas if x in self.allele_names]
+            dataset = self.subset(np.isin(self.alleles, codes))
+        if not len(dataset):
+            return test_data
+        peptides = dataset.decode_peptides()
+        order = np.lexsort((dataset.labels, dataset.alleles))
+        alleles = dataset.alleles[order]
+        labels = dataset.labels[order]
+        boundaries = (
+            np.flatnonzero((alleles[1:] != alleles[:-1]) | (labels[1:] != labels[:-1]))
+            + 1
+        )
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(order)]])
+        for start, end in zip(starts, ends):
+            hla = dataset.allele_names[alleles[start]]
+            qual = dataset.label_names[labels[start]]
+            test_data.setdefault(hla, {})[qual] = set(
+                peptides[order[start:end]].tolist()
+            )
+        return test_data
@@ -0,0 +1,201 @@
+import hashlib
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+# Columns of the IEDB csv that are used (peptide, qualitative value, hla)
+PEPTIDE_COLUMN = 11
+QUALITATIVE_COLUMN = 83
+HLA_COLUMN = 95
+HEADER_LINES = 2
+SEPARATOR = b'","'
+# Bytes of the beginning and the end of the file that are hashed to identify it
+HASHED_BYTES = 1 << 20
+MINIMUM_CHUNK_SIZE = 1 << 22
+BLOCK_SIZE = 1 << 24
+CACHE_VERSION = 1
+
+
+def _data_start(file):
+    # Byte offset of the first line after the header
+    with open(file, "rb") as f:
+        for _ in range(HEADER_LINES):
+            f.readline()
+        return f.tell()
+
+
+def line_ranges(file, start, chunks):
+    # Splits the bytes of the file after start in ranges that begin at the start of a line
+    size = os.path.getsize(file)
+    step = max((size - start) // chunks, 1)
+    offsets = [start]
+    with open(file, "rb") as f:
+        for i in range(1, chunks):
+            f.seek(start + i * step - 1)
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            if position > offsets[-1]:
+                offsets.append(position)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _read_range(task):
+    """
+    Reads the entries of a range of lines of the IEDB file, splitting only the columns up to the hla
+    :param task: tuple (file, start, end), start and end are the byte offsets of the range
+    :return: set of tuples (peptide, hla, qualitative_value)
+    """
+    file, start, end = task
+    entries = set()
+    with open(file, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        rest = b""
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            lines = (rest + block).split(b"\n")
+            # The last line can continue in the next block
+            rest = lines.pop()
+            _add_lines(lines, entries)
+        _add_lines([rest], entries)
+    return {
+        (
+            peptide.decode("utf-8", "replace"),
+            hla.decode("utf-8", "replace"),
+            qual.decode("utf-8", "replace"),
+        )
+        for peptide, hla, qual in entries
+    }
+
+
+def _add_lines(lines, entries):
+    # Adds the (peptide, hla, qualitative value) of each line to entries (still as bytes)
+    for line in lines:
+        h_line = line.split(SEPARATOR, HLA_COLUMN + 1)
+        if len(h_line) <= HLA_COLUMN:
+            continue
+        hla = h_line[HLA_COLUMN]
+        if len(h_line) == HLA_COLUMN + 1:
+            # The hla is the last column and keeps the end of the line
+            hla = hla.rstrip(b"\r") + b"\n"
+        entries.add((h_line[PEPTIDE_COLUMN], hla, h_line[QUALITATIVE_COLUMN]))
+
+
+def file_key(file):
+    """
+    Identifies the content of a file by its size, its modification time and a hash of its first and last bytes
+    :param file: path to the file
+    :return: string
+    """
+    stat = os.stat(file)
+    digest = hashlib.sha1()
+    with open(file, "rb") as f:
+        digest.update(f.read(HASHED_BYTES))
+        if stat.st_size > HASHED_BYTES:
+            f.seek(max(stat.st_size - HASHED_BYTES, HASHED_BYTES))
+            digest.update(f.read())
+    return "%s:%s:%s:%s" % (
+        CACHE_VERSION,
+        stat.st_size,
+        stat.st_mtime_ns,
+        digest.hexdigest(),
+    )
+
+
+def _encode(values):
+    # Unique values and the index of each value in them
+    values = np.array(values, dtype=str)
+    if not len(values):
+        return values, np.zeros(0, dtype=np.uint32)
+    table, codes = np.unique(values, return_inverse=True)
+    return table, codes.astype(np.uint32)
+
+
+def save_cache(entries, cache_file, key):
+    """
+    Saves the entries of the IEDB file in a numpy (.npz) file, each column is stored as
+    a table of its different values and the index of each entry in the table
+    :param entries: iterable of tuples (peptide, hla, qualitative_value)
+    :param cache_file: path to the cache file
+    :param key: file_key of the IEDB file
+    :return:
+    """
+    entries = list(entries)
+    columns = {}
+    for i, name in enumerate(["peptide", "hla", "qual"]):
+        table, codes = _encode([entry[i] for entry in entries])
+        columns["%s_table" % name] = table
+        columns["%s_codes" % name] = codes
+    tmp_file = "%s.tmp" % cache_file
+    with open(tmp_file, "wb") as f:
+        np.savez(f, key=np.array(key), **columns)
+    os.replace(tmp_file, cache_file)
+
+
+def load_cache(cache_file, key):
+    """
+    Loads the entries saved with save_cache
+    :param cache_file: path to the cache file
+    :param key: file_key of the IEDB file
+    :return: list of tuples (peptide, hla, qualitative_value) or None if the cache does not exist
+    or belongs to another version of the file
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            if str(cache["key"]) != key:
+                return None
+            columns = [
+                cache["%s_table" % name][cache["%s_codes" % name]].tolist()
+                for name in ["peptide", "hla", "qual"]
+            ]
+    except (OSError, ValueError, KeyError):
+        return None
+    return list(zip(*columns))
+
+
+def read_IEDB_data(file, processors=1, cache_file=None):
+    """
+    Reads the peptide, the hla and the qualitative value of the entries of the IEDB file.
+    The file is split in byte ranges that are read in parallel, and the result is saved in
+    cache_file so the next reads of the same file only have to load it.
+    Repeated entries are returned only once.
+    :param file: IEDB database in csv format
+    :param processors: number of processors to use
+    :param cache_file: path to the cache file (None to not use a cache)
+    :return: list of tuples (peptide, hla, qualitative_value)
+    """
+    key = None
+    if cache_file:
+        key = file_key(file)
+        entries = load_cache(cache_file, key)
+        if entries is not None:
+            print("     Loaded IEDB data from cache %s" % cache_file)
+            return entries
+    start = _data_start(file)
+    size = os.path.getsize(file)
+    chunks = max(1, min(int(processors), (size - start) // MINIMUM_CHUNK_SIZE))
+    tasks = [(file, begin, end) for begin, end in line_ranges(file, start, chunks)]
+    if len(tasks) > 1:
+        with mp.Pool(min(int(processors), len(tasks))) as pool:
+            results = pool.map(_read_range, tasks)
+    else:
+        results = [_read_range(task) for task in tasks]
+    entries = set()
+    for result in results:
+        entries.update(result)
+    entries = list(entries)
+    if cache_file:
+        try:
+            save_cache(entries, cache_file, key)
+        except OSError as e:
+            print("     Could not save the IEDB cache %s: %s" % (cache_file, e))
+    return entries
@@ -4,11 +4,11 @@ import os
 from constants.constants import (
     DATA_PATH,
     MOTIFF_BASE_LENGTH,
-    NEGATIVE,
-    POSITIVE_HIGH,
     THRESHOLD,
     VALID_AMINOACIDS,
 )
+from hlaizer import iedb_reader
+from hlaizer.dataset import EncodedDataset
 
 
 class Parser:
@@ -33,10 +33,14 @@ class Parser:
         self.csv_file = csv_file
         self.aligment_file = aligment_file
         self.positions_file = os.path.join(DATA_PATH, "key_positions_%s.txt" % length)
-        self.valid_letters = set(valid_letters)
+        self.valid_letters = list(valid_letters)
         self.length = length
         self.minimum_data_signal = 50
         self.minimum_data_background = 10
+        self.processors = 1
+        self.IEDB_cache_file = None
+        if IEDB_file:
+            self.IEDB_cache_file = "%s.cache.npz" % IEDB_file
 
         # Containers
         self.hla_set = set()
@@ -48,6 +52,25 @@ class Parser:
     def set_minimum_data_background(self, minimum_data):
         self.minimum_data_background = minimum_data
 
+    def set_processors(self, processors):
+        # Processors used to read the IEDB file
+        self.processors = int(processors)
+
+    def set_IEDB_cache_file(self, cache_file):
+        # File where the parsed IEDB entries are cached (None to not use a cache)
+        self.IEDB_cache_file = cache_file
+
+    def read_IEDB_data(self):
+        """
+        Reads the IEDB file in parallel, or loads it from the cache if the file has not changed since it was cached
+        :return: list of tuples (peptide, hla, qualitative_value)
+        """
+        if not self.IEDB_file:
+            return []
+        return iedb_reader.read_IEDB_data(
+            self.IEDB_file, self.processors, self.IEDB_cache_file
+        )
+
     @staticmethod
     def process_csv_data_generator(file):
         peptide = None
@@ -110,66 +133,119 @@ class Parser:
         return matrix_dict
 
     def parse_data(self):
+        return self.parse_data_by_length([self.length])[self.length]
 
-        # Initialize variables
-        final_dict = {}
-        test_data_dict = {}
-        hla_with_signal = set()
-        hla_with_background = set()
-        used_peptides = {}
+    def parse_data_by_length(self, lengths):
+        """
+        Reads the data files once and splits the data by peptide length
+        :param lengths: list of peptide lengths to keep
+        :return: dict {length: (EncodedDataset, test_data, hla_list)}, test_data has the peptides of the
+        hlas of hla_list {hla: {qualitative_value : set(peptides)}}
+        """
+        parsed_data = {}
+        for length, (dataset, hla_list) in self.parse_dataset_by_length(
+            lengths
+        ).items():
+            parsed_data[length] = (dataset, dataset.to_test_data(hla_list), hla_list)
+        return parsed_data
 
-        # Extract and verify data
+    def parse_dataset_by_length(self, lengths):
+        """
+        Reads the data files once and encodes the data of each peptide length as an EncodedDataset
+        :param lengths: list of peptide lengths to keep
+        :return: dict {length: (EncodedDataset, hla_list)}
+        """
+        # Extract and verify data, the entries are encoded as they are read
         print("     Reading data files")
-        for element in itertools.chain(
-            self.process_IEDB_data_generator(self.IEDB_file),
-            self.process_csv_data_generator(self.csv_file),
-        ):
-            peptide, hla, qual = element
+        datasets = EncodedDataset.from_entries_by_length(
+            itertools.chain(
+                self.read_IEDB_data(),
+                self.process_csv_data_generator(self.csv_file),
+            ),
+            lengths,
+            self.hla_set,
+            self.valid_letters,
+        )
+
+        print("     Curating data")
+        parsed_data = {}
+        for length in lengths:
+            parsed_data[length] = self._curate_dataset(datasets.pop(length))
+        return parsed_data
+
+    def _curate_dataset(self, dataset):
+        # Filters the data of one peptide length and selects the HLAs with enough data
+        # Filter repeated entry's
+        # (those peptides that appear more than once on a given hla and have different experimental characterization)
+        dataset = dataset.remove_conflicts()
+
+        # Remove HLAs that do not reach minimum data requirements
+        correct_hlas = dataset.select_hlas(
+            self.minimum_data_signal, self.minimum_data_background
+        )
+
+        return dataset, correct_hlas
+
+    def select_hlas(self, data, minimum_data_signal, minimum_data_background):
+        """
+        Selects the HLAs that reach the minimum data requirements
+        :param data: parsed data (EncodedDataset)
+        :param minimum_data_signal: minimum number of binding peptides
+        :param minimum_data_background: minimum number of non binding peptides
+        :return: list of hlas
+        """
+        return [
+            hla
+            for hla in data.select_hlas(minimum_data_signal, minimum_data_background)
+            if hla in self.hla_set
+        ]
+
+    def parse_delta_data(self, delta_file):
+        """
+        Parses a file with new data to add to an already trained model
+        (same format as the csv_file: peptide;hla;qualitative_value)
+        Peptides that appear more than once for a given hla with different qualitative values are discarded.
+        :param delta_file: file with the new data
+        :return: dict {qualitative_value : {hla:[peptides]}}
+        """
+        delta_dict = {}
+        used_peptides = {}
+        for peptide, hla, qual in self.process_csv_data_generator(delta_file):
             if not peptide or not hla or not qual:
                 continue
-            peptide_set = set(peptide)
             if (
-                hla in self.hla_set
-                and not peptide_set.difference(self.valid_letters)
+                not set(peptide).difference(self.valid_letters)
                 and len(peptide) == self.length
             ):
-                # sets remove identical repeated entry's without removing all of them
                 used_peptides.setdefault(hla, {}).setdefault(peptide, set()).add(qual)
-                final_dict.setdefault(qual, {}).setdefault(hla, set()).add(peptide)
-                test_data_dict.setdefault(hla, {}).setdefault(qual, set()).add(peptide)
-
-        # Filter repeated entry's
-        # (those peptides that appear more than once on a given hla and have different experimental characterization)
-        print("     Curating data")
+                delta_dict.setdefault(qual, {}).setdefault(hla, set()).add(peptide)
         for hla in used_peptides:
-            for peptide in used_peptides[hla]:
-                different_qualitatives = used_peptides[hla][peptide]
+            for peptide, different_qualitatives in used_peptides[hla].items():
                 if len(different_qualitatives) > 1:
                     for qual in different_qualitatives:
-                        final_dict[qual][hla].remove(peptide)
-                        test_data_dict[hla][qual].remove(peptide)
-
-        # Remove HLAs that do not reach minimum data requirements
-        for hla, peptides_set in final_dict[POSITIVE_HIGH].items():
-            if len(peptides_set) >= self.minimum_data_signal:
-                hla_with_signal.add(hla)
-        for hla, peptides_set in final_dict[NEGATIVE].items():
-            if len(peptides_set) >= self.minimum_data_background:
-                hla_with_background.add(hla)
-        correct_hlas = list(
-            self.hla_set.intersection(hla_with_signal, hla_with_background)
-        )
+                        delta_dict[qual][hla].remove(peptide)
+        return delta_dict
 
-        return final_dict, test_data_dict, correct_hlas
+    def key_position_file(self, length=None):
+        # Path of the key positions file of the given length (by default the length of the parser)
+        if length is None or length == self.length:
+            return self.positions_file
+        return os.path.join(DATA_PATH, "key_positions_%s.txt" % length)
 
-    def parse_key_position_file(self):
+    def parse_key_position_file(self, length=None, threshold=None):
+        # Parses the key positions file of the given length (by default the length of the parser)
+        # keeping the positions with at least threshold crystal evidence (by default the one in THRESHOLD)
+        positions_file = self.key_position_file(length)
+        if length is None:
+            length = self.length
         key_pos = {}
         sim_weight = {}
-        try:
-            threshold = THRESHOLD[self.length]
-        except KeyError:
-            threshold = "default"
-        with open(self.positions_file, "r") as inn:
+        if threshold is None:
+            try:
+                threshold = THRESHOLD[length]
+            except KeyError:
+                threshold = THRESHOLD["default"]
+        with open(positions_file, "r") as inn:
             for line in inn:
                 line = line.split()
                 pos = int(line[0])
@@ -194,23 +270,47 @@ class Parser:
         return self.hla_sequences
 
     def parse_all(self):
+        return self.parse_all_lengths([self.length])[self.length]
+
+    def parse_all_lengths(self, lengths):
+        """
+        Parses all the files required to build the models of several peptide lengths,
+        reading the alignment and the data files only once
+        :param lengths: list of peptide lengths
+        :return: dict {length: (data, test_data, hla_list, hla_aligment, key_positions, sim_weight)},
+        data is an EncodedDataset
+        """
 
         # Process data (the order of execution is important)
         print("Reading Aligment file %s" % self.aligment_file)
         hla_aligment = self.parse_aligment_file(self.aligment_file)
         print("Extracting environment")
-        key_positions, sim_weight = self.parse_key_position_file()
+        key_positions = {
+            length: self.parse_key_position_file(length) for length in lengths
+        }
         print("Parsing Data")
-        data, test_data, hla_list = self.parse_data()
+        parsed_data = self.parse_data_by_length(lengths)
 
-        # Purge incorrect data
-        hla_in_aligment = list(hla_aligment.keys())
-        for hla in hla_in_aligment:
-            if hla not in hla_list:
-                hla_aligment.pop(hla, None)
+        parsed = {}
+        for length in lengths:
+            data, test_data, hla_list = parsed_data[length]
+            # Purge incorrect data
+            length_aligment = {
+                hla: sequence
+                for hla, sequence in hla_aligment.items()
+                if hla in hla_list
+            }
+            parsed[length] = (
+                data,
+                test_data,
+                hla_list,
+                length_aligment,
+                key_positions[length][0],
+                key_positions[length][1],
+            )
 
         print("Parsing Finished")
-        return data, test_data, hla_list, hla_aligment, key_positions, sim_weight
+        return parsed
 
 
 if __name__ == "__main__":
@@ -1,10 +1,20 @@
 import argparse
-import multiprocessing as mp
 import sys
 
 import numpy as np
 import utilities
-from hlaizer.parser import Parser
+from hlaizer.alignment_store import AlignmentStore
+from predictor.Scorer import ScorerEnsemble
+from predictor.variants import score_variants
+from utilities import (
+    columnar,
+    diagnostics,
+    executor,
+    peptide_keys,
+    pipeline,
+    shards,
+    streams,
+)
 
 
 def parse_args():
@@ -18,95 +28,477 @@ def parse_args():
     parser.add_argument(
         "-i",
         required=True,
-        help="File with the peptides to Predict. The file must have the following"
-        "structure; peptide  HLA",
+        help="File with the peptides to Predict, one pair per line: peptide,HLA (comma or whitespace "
+        "separated, only the peptides with -genotype). It can be compressed with gzip (.gz) or zstd (.zst), "
+        "or be a columnar file (.npz, or .arrow/.feather with pyarrow) with a peptide column and an hla "
+        "column (int32 codes with the hlas dictionary in npz, dictionary encoded in Arrow)",
     )
     parser.add_argument(
         "-seq",
         default=None,
         help="File with the proteic sequences for the unknown HLAs (Selex format)",
     )
-    parser.add_argument("-o", required=True, help="Output file")
     parser.add_argument(
-        "-model", required=True, help="Path to where the models are stored"
+        "-o",
+        required=True,
+        help="Output file, compressed with gzip or zstd if its name ends with .gz or .zst. The scores of "
+        "(peptide, HLA) pairs can be written to a columnar file (.npz, or .arrow/.feather with pyarrow) "
+        "with the columns peptide, hla (dictionary encoded), score and rank (float32)",
+    )
+    parser.add_argument(
+        "-model",
+        required=True,
+        nargs="+",
+        help="Path to where the models are stored. If more than one model is given they are scored "
+        "as an ensemble and the output has the aggregated score and the score of each model",
+    )
+    parser.add_argument(
+        "-processors", default=1, type=int, help="Number of processors to use"
+    )
+    parser.add_argument(
+        "-executor",
+        default="auto",
+        choices=executor.EXECUTORS,
+        help="How the peptides are scored: inprocess, thread (pool of threads), process (pool of processes) "
+        "or auto (default), which scores small jobs in this process and measures the others to choose",
+    )
+    parser.add_argument(
+        "-genotype",
+        default=None,
+        help="Comma separated HLAs of a patient (for example HLA-A*02:01,HLA-A*11:01,HLA-B*07:02). "
+        "If given, the input file only needs the peptides, each peptide is scored for all the HLAs "
+        "at once and the output has the best HLA and score of each peptide",
+    )
+    parser.add_argument(
+        "-rank",
+        action="store_true",
+        help="Add the percentile rank of each score (percentage of reference peptides that score "
+        "better or equal, lower is better). With -genotype the best HLA is chosen by rank",
+    )
+    parser.add_argument(
+        "-proteins",
+        default=None,
+        help="Fasta file with the protein sequences. If given, the input file has missense variants "
+        "(protein position ref alt, 1-based position) and the wild type and mutant windows that "
+        "overlap each variant are scored for the HLAs of -genotype",
+    )
+    parser.add_argument(
+        "-lengths",
+        default="8,9,10,11",
+        help="Comma separated lengths of the windows scored with -proteins (default 8,9,10,11)",
+    )
+    parser.add_argument(
+        "-aggregate",
+        default="mean",
+        choices=ScorerEnsemble.AGGREGATIONS,
+        help="How the scores of an ensemble are aggregated: mean, min (best score of the models) or vote "
+        "(number of models with a score lower or equal than -voteThreshold). Default mean",
+    )
+    parser.add_argument(
+        "-voteThreshold",
+        default=-1,
+        type=float,
+        help="Binding threshold of the vote aggregation (default -1)",
+    )
+    parser.add_argument(
+        "-shard",
+        "--shard",
+        default=None,
+        help="Score only shard i of N of the input file (i/N, for example 2/8). The file is split in N byte "
+        "ranges of the same size, so each node reads only its part. The output is written to "
+        "<output>.shard-i-of-N with a manifest, and merge_NOAH.py combines the N shards into <output>",
+    )
+    parser.add_argument(
+        "-diagnostics",
+        default=None,
+        help="Write a JSON report of the warnings and errors of the scoring (counts by type and HLA, and "
+        "samples) to this file. A summary is always printed at the end",
     )
-    parser.add_argument("-processors", default=1, help="Number of processors to use")
     args = parser.parse_args()
-    return args.i, args.seq, args.o, args.model, args.processors
+    shard = None
+    if args.shard:
+        shard = shards.parse_shard(args.shard)
+        if shard is None:
+            sys.stderr.write("Error: invalid -shard %s, expected i/N\n" % args.shard)
+            exit(1)
+    genotype = None
+    if args.genotype:
+        genotype = [hla.strip() for hla in args.genotype.split(",") if hla.strip()]
+    if len(args.model) > 1 and (args.rank or args.proteins):
+        sys.stderr.write("Error: -rank and -proteins only support one model\n")
+        exit(1)
+    if columnar.is_columnar(args.o) and (genotype or len(args.model) > 1):
+        sys.stderr.write(
+            "Error: columnar outputs only support the pairs scored with one model (without -genotype)\n"
+        )
+        exit(1)
+    if args.proteins and columnar.is_columnar(args.i):
+        sys.stderr.write("Error: the variants of -proteins must be a text file\n")
+        exit(1)
+    if args.proteins and not genotype:
+        sys.stderr.write("Error: -proteins requires the HLAs to score (-genotype)\n")
+        exit(1)
+    try:
+        lengths = [int(length) for length in args.lengths.split(",") if length.strip()]
+    except ValueError:
+        sys.stderr.write("Error: invalid -lengths %s\n" % args.lengths)
+        exit(1)
+    return (
+        args.i,
+        args.seq,
+        args.o,
+        args.model,
+        args.processors,
+        genotype,
+        args.rank,
+        args.proteins,
+        lengths,
+        args.aggregate,
+        args.voteThreshold,
+        args.executor,
+        shard,
+        args.diagnostics,
+    )
 
 
-def process_peptides(model, data):
+def rank_scores(scorer, output_data):
     """
-    Scores each peptide in the data array
-    :param model: model to use to score the peptides
-    :param data: list of tuples containing the data to score (peptide, HLA)
-    :return: scored data
+    Computes the percentile rank of the scores, each peptide with the model of its length
+    :param scorer: model used to score the peptides
+    :param output_data: dict {hla: {peptide: score}}
+    :return: dict {hla: {peptide: rank}}
     """
-    results = {}
-    for element in data:
-        print(data)
-        peptide = element[0]
-        hla = element[1]
-        try:
-            result = model.score_peptide(peptide, hla)
-            for processed_hla in result:
-                results.setdefault(processed_hla, {}).setdefault(
-                    peptide, result[processed_hla][peptide]
+    ranks = {}
+    for hla in output_data:
+        groups = {}  # {model length: [peptides]}
+        for peptide in output_data[hla]:
+            model = scorer.get_model(len(peptide))
+            groups.setdefault(model.motif_length, (model, []))[1].append(peptide)
+        for model, peptides in groups.values():
+            # Unknown HLAs prepared in worker processes have to be prepared here too
+            model.resolve_hla(hla)
+            scores = np.array([output_data[hla][peptide] for peptide in peptides])
+            for peptide, rank in zip(peptides, model.percentile_rank(hla, scores)):
+                ranks.setdefault(hla, {})[peptide] = rank
+    return ranks
+
+
+def score_genotype(scorer, input_file, output, genotype, rank=False, shard=None):
+    """
+    Scores all the peptides of the input file for all the HLAs of a genotype in one vectorized pass
+    :param scorer: model to use to score the peptides
+    :param input_file: file with the peptides (first column)
+    :param output: output file
+    :param genotype: list of HLAs
+    :param rank: Boolean, add the percentile rank of the best HLA (chosen by rank)
+    :param shard: tuple (i, N) to score only one shard of the input file
+    :return:
+    """
+    peptides = utilities.load_peptides(input_file, shard)
+    result = scorer.score_genotype(peptides, genotype, rank)
+    print("Saving results")
+    with streams.open_text(output, "w") as out:
+        best_rank = "\tbest_rank" if rank else ""
+        out.write(
+            "peptide\tbest_hla\tbest_score%s\t%s\n"
+            % (best_rank, "\t".join(result["hlas"]))
+        )
+        for n, peptide in enumerate(peptides):
+            scores = "\t".join([str(score) for score in result["scores"][n]])
+            if rank:
+                best_rank = "\t%s" % result["best_rank"][n]
+            out.write(
+                "%s\t%s\t%s%s\t%s\n"
+                % (
+                    peptide,
+                    result["best_hla"][n],
+                    result["best_score"][n],
+                    best_rank,
+                    scores,
                 )
-        except:
-            sys.stderr.write(
-                "Error ocurred while processing %s for HLA %s\n" % (peptide, hla)
             )
-    return results
+    print("Prediction finished")
 
 
-def main(input_file, hla_seq, output, model, processors):
-    print("Starting NOAH")
-    try:
-        scorer = utilities.load_model(model)
-    except:
-        raise Exception("Error: Unable to load model %s\n" % model)
+def score_variant_windows(
+    scorer,
+    input_file,
+    proteins_file,
+    output,
+    genotype,
+    lengths,
+    rank=False,
+    shard=None,
+):
+    """
+    Scores the wild type and mutant windows of the missense variants of the input file for all the HLAs
+    of a genotype (see predictor.variants.score_variants)
+    :param scorer: model to use to score the peptides
+    :param input_file: file with the variants (protein position ref alt)
+    :param proteins_file: fasta file with the protein sequences
+    :param output: output file
+    :param genotype: list of HLAs
+    :param lengths: list of window lengths
+    :param rank: Boolean, add the percentile ranks of the scores
+    :param shard: tuple (i, N) to score only one shard of the input file
+    :return:
+    """
+    variants = utilities.load_variants(input_file, shard)
+    proteins = utilities.load_fasta(proteins_file)
+    result = score_variants(scorer, variants, proteins, genotype, lengths, rank)
+    print("Saving results")
+    with streams.open_text(output, "w") as out:
+        header = "protein\tposition\tref\talt\tstart\twt_peptide\tmut_peptide\thla\twt_score\tmut_score\tdelta"
+        if rank:
+            header += "\twt_rank\tmut_rank"
+        out.write("%s\n" % header)
+        for n, (variant, start, peptide, mutant, _) in enumerate(result["windows"]):
+            for column, hla in enumerate(result["hlas"]):
+                wt_score = result["wt_scores"][n, column]
+                mut_score = result["mut_scores"][n, column]
+                line = "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+                    variant[0],
+                    variant[1],
+                    variant[2],
+                    variant[3],
+                    start + 1,
+                    peptide,
+                    mutant,
+                    hla,
+                    wt_score,
+                    mut_score,
+                    round(mut_score - wt_score, 3),
+                )
+                if rank:
+                    line += "\t%s\t%s" % (
+                        result["wt_ranks"][n, column],
+                        result["mut_ranks"][n, column],
+                    )
+                out.write("%s\n" % line)
+    print("Prediction finished")
 
-    if hla_seq:
-        parser = Parser()
-        hla_align = parser.parse_aligment_file(hla_seq)
-        scorer.load_sequences(hla_align)
-
-    pool = mp.Pool(processors)
-    workers = []
-    loaded_data = utilities.load_data(input_file)
-    splited_data = np.array_split(loaded_data, processors)
-    output_data = {}
-
-    for i in range(processors):
-        workers.append(pool.apply_async(process_peptides, (scorer, splited_data[i])))
-    for worker in workers:
-        result = worker.get()
-        for hla in result:
-            for peptide in result[hla]:
-                output_data.setdefault(hla, {}).setdefault(
-                    peptide, result[hla][peptide]
+
+def score_ensemble(
+    ensemble,
+    input_file,
+    output,
+    genotype=None,
+    aggregate="mean",
+    threshold=-1,
+    shard=None,
+):
+    """
+    Scores the peptides of the input file with all the models of an ensemble in one pass
+    :param ensemble: ScorerEnsemble
+    :param input_file: file with the peptides and HLAs (or only the peptides with a genotype)
+    :param output: output file
+    :param genotype: list of HLAs (None scores the pairs of the input file)
+    :param aggregate: how the scores of the models are aggregated (mean, min or vote)
+    :param threshold: binding threshold of the vote
+    :param shard: tuple (i, N) to score only one shard of the input file
+    :return:
+    """
+    names = "\t".join(ensemble.names)
+    if genotype:
+        peptides = utilities.load_peptides(input_file, shard)
+        result = ensemble.score_genotype(peptides, genotype, aggregate, threshold)
+        print("Saving results")
+        with streams.open_text(output, "w") as out:
+            out.write(
+                "peptide\tbest_hla\tbest_%s\t%s\n"
+                % (aggregate, "\t".join(result["hlas"]))
+            )
+            for n, peptide in enumerate(peptides):
+                scores = "\t".join([str(score) for score in result["scores"][n]])
+                out.write(
+                    "%s\t%s\t%s\t%s\n"
+                    % (peptide, result["best_hla"][n], result["best_score"][n], scores)
                 )
+    else:
+        data = peptide_keys.unique_pairs(
+            utilities.load_data(input_file, shard), ensemble.valid_letters
+        )
+        aggregated, model_scores = ensemble.score_pairs(data, aggregate, threshold)
+        print("Saving results")
+        with streams.open_text(output, "w") as out:
+            out.write("hla\tpeptide\t%s\t%s\n" % (aggregate, names))
+            for hla in aggregated:
+                for peptide in aggregated[hla]:
+                    scores = "\t".join(
+                        [str(score) for score in model_scores[hla][peptide]]
+                    )
+                    out.write(
+                        "%s\t%s\t%s\t%s\n"
+                        % (hla, peptide, aggregated[hla][peptide], scores)
+                    )
+    print("Prediction finished")
 
-    print("Saving results")
+
+def score_pairs(
+    scorer, input_file, output, processors, rank=False, executor_type="auto", shard=None
+):
+    """
+    Scores the (peptide, hla) pairs of the input file in batches, reading the next batch and writing the
+    previous one while a batch is scored
+    :param scorer: model to use to score the peptides
+    :param input_file: file with the peptides and HLAs
+    :param output: output file
+    :param processors: number of processors to use
+    :param rank: Boolean, add the percentile rank of each score
+    :param executor_type: how the pairs are scored (see utilities.executor.PairExecutor)
+    :param shard: tuple (i, N) to score only one shard of the input file
+    :return:
+    """
+    # The pairs already read are kept packed, so repeated pairs are scored only once
+    seen = peptide_keys.SeenPairs(scorer.valid_letters)
+
+    def batches():
+        for batch in utilities.load_data_batches(input_file, shard):
+            yield seen.filter(batch)
+
+    def score(batch):
+        output_data = pairs.score(batch)
+        return output_data, rank_scores(scorer, output_data) if rank else None
+
+    def write(result):
+        output_data, ranks = result
+        for hla in output_data:
+            for peptide in output_data[hla]:
+                line = "%s\t%s\t%s" % (hla, peptide, output_data[hla][peptide])
+                if ranks is not None:
+                    line += "\t%s" % ranks[hla][peptide]
+                file.write("%s\n" % line)
+
+    # The executor is chosen with the first batch and its workers score all the batches
+    pairs = executor.PairExecutor(scorer, processors, executor_type)
+    if columnar.is_columnar(output):
+        # The columns of all the batches are written at once
+        tables = []
+        with pairs:
+            pipeline.run_pipeline(
+                batches(),
+                score,
+                lambda result: tables.append(columnar.pairs_table(*result)),
+            )
+        columnar.write_table(output, columnar.concat_tables(tables))
+        print("Prediction finished")
+        return
     try:
-        file = open(output, "w")
+        file = streams.open_text(output, "w")
     except IOError:
         sys.stderr.write(
             "WARNING: Can't open outputfile %s, using _tmp_result.txt instead\n"
             % output
         )
         file = open("_tmp_result.txt", "w")
-
-    for hla in output_data:
-        for peptide in output_data[hla]:
-            file.write("%s\t%s\t%s\n" % (hla, peptide, output_data[hla][peptide]))
+    # The next batch is read and the previous one written while a batch is scored
+    with pairs:
+        pipeline.run_pipeline(batches(), score, write)
     file.close()
     print("Prediction finished")
 
 
+def main(
+    input_file,
+    hla_seq,
+    output,
+    model,
+    processors,
+    genotype=None,
+    rank=False,
+    proteins_file=None,
+    lengths=(8, 9, 10, 11),
+    aggregate="mean",
+    threshold=-1,
+    executor_type="auto",
+    shard=None,
+    diagnostics_file=None,
+):
+    print("Starting NOAH")
+    models = model if isinstance(model, list) else [model]
+    loaded_models = []
+    for model in models:
+        try:
+            loaded_models.append(utilities.load_model(model))
+        except Exception as error:
+            diagnostics.collector.error(error, None, "loading model %s" % model)
+            raise Exception("Error: Unable to load model %s\n" % model)
+    if len(loaded_models) > 1:
+        scorer = ScorerEnsemble(loaded_models, models)
+    else:
+        scorer = loaded_models[0]
+
+    if hla_seq:
+        # Only the sequences of the unknown HLAs that are scored are read
+        scorer.load_sequences(AlignmentStore(hla_seq))
+
+    if shard:
+        final_output = output
+        output = shards.shard_output(final_output, shard)
+        print("Scoring shard %s of %s" % shard)
+
+    if len(loaded_models) > 1:
+        score_ensemble(
+            scorer, input_file, output, genotype, aggregate, threshold, shard
+        )
+    elif proteins_file:
+        score_variant_windows(
+            scorer, input_file, proteins_file, output, genotype, lengths, rank, shard
+        )
+    elif genotype:
+        score_genotype(scorer, input_file, output, genotype, rank, shard)
+    else:
+        score_pairs(scorer, input_file, output, processors, rank, executor_type, shard)
+
+    if shard:
+        # The (hla, peptide) pairs are unique in the pairs outputs, and only the one of a single model has no header
+        pairs = not genotype and not proteins_file
+        shards.write_manifest(
+            final_output,
+            shard,
+            input_file,
+            models,
+            len(loaded_models) > 1 or not pairs,
+            pairs,
+        )
+
+    diagnostics.collector.print_summary()
+    if diagnostics_file:
+        diagnostics.collector.write_report(diagnostics_file)
+
+
 if __name__ == "__main__":
     # main("data_proba.txt", os.path.join(DATA_PATH, "HLA-A.pfam"), "resu_random.txt",
     # os.path.join(DATA_PATH, "NOAH_9.pkl"), 1)
-    input_file, hla_seq, output, models, processors = parse_args()
-    main(input_file, hla_seq, output, models, processors)
+    (
+        input_file,
+        hla_seq,
+        output,
+        models,
+        processors,
+        genotype,
+        rank,
+        proteins_file,
+        lengths,
+        aggregate,
+        threshold,
+        executor_type,
+        shard,
+        diagnostics_file,
+    ) = parse_args()
+    main(
+        input_file,
+        hla_seq,
+        output,
+        models,
+        processors,
+        genotype,
+        rank,
+        proteins_file,
+        lengths,
+        aggregate,
+        threshold,
+        executor_type,
+        shard,
+        diagnostics_file,
+    )
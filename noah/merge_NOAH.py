@@ -0,0 +1,45 @@
+import argparse
+
+from utilities import shards
+
+
+def parse_args():
+    """
+    Parse command line arguments
+    :returns:
+    """
+    desc = """Script that merges the outputs of the shards of a prediction (main_NOAH.py -shard i/N) into
+    one output. The shards are checked with their manifests and combined in shard order, so the merged output
+    is the same whichever nodes ran the shards."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        "-o",
+        required=True,
+        help="Output file given to main_NOAH.py. The shards are read from <output>.shard-i-of-N",
+    )
+    parser.add_argument(
+        "-shards",
+        default=None,
+        type=int,
+        help="Number of shards (default read from the manifests)",
+    )
+    parser.add_argument(
+        "-remove",
+        action="store_true",
+        help="Remove the outputs and manifests of the shards once they are merged",
+    )
+    args = parser.parse_args()
+    return args.o, args.shards, args.remove
+
+
+def main(output, number_shards=None, remove=False):
+    print("Merging the shards of %s" % output)
+    written = shards.merge_shards(output, number_shards, remove)
+    if written is None:
+        exit(1)
+    print("%s lines written to %s" % (written, output))
+
+
+if __name__ == "__main__":
+    output, number_shards, remove = parse_args()
+    main(output, number_shards, remove)
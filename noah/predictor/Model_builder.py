@@ -1,10 +1,20 @@
 import copy
+import hashlib
 import multiprocessing as mp
+import os
+import time
 
 import numpy as np
-from constants.constants import NEGATIVE, POSITIVE_HIGH, VALID_AMINOACIDS
-from predictor import Scorer
+from constants.constants import (
+    NEGATIVE,
+    POSITIVE_HIGH,
+    RANK_REFERENCE_SIZE,
+    VALID_AMINOACIDS,
+)
+from hlaizer.dataset import EncodedDataset
+from predictor import Scorer, ranks
 from predictor.PredictorCore import PredictorCore
+from utilities import utilities, work_queue
 
 # ignore warning of 0 division errors (infinit positions are expected if no pseudocounts are used)
 np.seterr(divide="ignore")
@@ -29,7 +39,7 @@ class MotifMaker(PredictorCore):
     ):
         """
 
-        :param data: data to use to build the model
+        :param data: data to use to build the model (EncodedDataset, or dict {qualitative_value : {hla:[peptides]}})
         :param test_data: data to use to test the model
         :param hla_list: list of valid hlas
         :param motif_length: length of the motif
@@ -46,7 +56,7 @@ class MotifMaker(PredictorCore):
         )
 
         # Base Parameters
-        self.data = data  # {qualitative_value : {hla:[peptides]}}
+        self.data = data  # EncodedDataset or {qualitative_value : {hla:[peptides]}}
         self.test_data = test_data  # {hla: {qualitative_value : [peptides]}}
         self.pseudocounts = pseudocounts
         self.hla_aligment = hla_aligment
@@ -64,6 +74,16 @@ class MotifMaker(PredictorCore):
         ]  # already implemented random models
         self.random_model = None
 
+        # Refinement Search Parameters (None means no limit)
+        self.max_similarity_drop = None
+        self.max_candidates = None
+        self.skip_duplicate_envs = False
+        self.search_stats = {}
+
+        # Percentile Rank Parameters (None means no rank tables are stored in the model)
+        self.rank_size = None
+        self.rank_reference_file = None
+
         # Mappings
         self.hla_to_env = self.extract_binding_environment(
             self.hla_aligment
@@ -94,13 +114,197 @@ class MotifMaker(PredictorCore):
     def set_data(self, data):
         self.data = data
 
+    def set_pseudocounts(self, pseudocounts):
+        self.pseudocounts = pseudocounts
+
+    def set_key_positions(self, key_positions, sim_weight):
+        # Changes the positions that define the environments (and their weights)
+        self.key_positions = key_positions
+        self.similarity_weight = sim_weight
+        self.hla_to_env = self.extract_binding_environment(self.hla_aligment)
+
+    def set_refinement_search(
+        self, max_similarity_drop=None, max_candidates=None, skip_duplicate_envs=False
+    ):
+        """
+        Configures how many fusion candidates are built and scored for each position during the refinement
+        :param max_similarity_drop: stop trying candidates once their similarity is this much lower than the
+        similarity of the HLA with itself (None tries all of them)
+        :param max_candidates: maximum number of candidates to build for each position (None tries all of them)
+        :param skip_duplicate_envs: Boolean, skip candidates whose environment at that position is identical
+        to the one of a candidate already evaluated
+        :return:
+        """
+        self.max_similarity_drop = max_similarity_drop
+        self.max_candidates = max_candidates
+        self.skip_duplicate_envs = skip_duplicate_envs
+
+    def set_rank_reference(self, size=RANK_REFERENCE_SIZE, reference_file=None):
+        """
+        Stores percentile rank tables in the refined model, computed from the scores of reference peptides
+        :param size: number of random peptides with the natural frequencies of the amino acids
+        :param reference_file: file with the reference peptides (first column) used instead of the random ones
+        :return:
+        """
+        self.rank_size = size
+        self.rank_reference_file = reference_file
+
+    def _rank_reference(self):
+        # Reference peptides of the percentile ranks (None if they are not enabled)
+        if self.rank_reference_file:
+            return ranks.reference_codes_from_file(
+                self.rank_reference_file, self.motif_length, self.valid_letters
+            )
+        if self.rank_size:
+            return ranks.reference_codes(
+                self.motif_length, self.rank_size, self.valid_letters
+            )
+        return None
+
+    @classmethod
+    def from_model(cls, model, update_state):
+        """
+        Recreates the builder of a trained model from the counts stored in it and the update state saved with
+        it, so the model can be updated with new data without parsing and counting all the data again
+        :param model: Scorer created by refine_model
+        :param update_state: dict returned by update_state when the model was trained
+        :return: MotifMaker with the counts and the fusions of the model
+        """
+        state = model.training_state
+        motif = cls(
+            data=None,
+            test_data=update_state["test_data"],
+            hla_list=list(state["hla_list"]),
+            motif_length=model.motif_length,
+            key_positions=model.key_positions,
+            sim_weight=model.similarity_weight,
+            hla_aligment=update_state["hla_aligment"],
+            valid_letters=model.valid_letters,
+            pseudocounts=state["pseudocounts"],
+        )
+        motif.set_random_model_type(state["random_model_type"])
+        motif.set_similarity_matrix(model.similarity_matrix)
+        motif.env_to_hla = copy.deepcopy(model.env_to_hla)
+        motif.count_matrix = state["count_matrix"].copy()
+        motif.random_model = state["background_counts"].copy()
+        return motif
+
+    def training_state(self):
+        # Returns the counts that from_model needs to update the model (stored in the model)
+        return {
+            "hla_list": list(self.hla_list),
+            "count_matrix": self.count_matrix,
+            "background_counts": self.random_model,
+            "random_model_type": self.random_model_type,
+            "pseudocounts": self.pseudocounts,
+        }
+
+    def update_state(self):
+        # Returns the data that from_model also needs, saved apart from the model so it does not grow
+        return {"hla_aligment": self.hla_aligment, "test_data": self.test_data}
+
+    def without_hla(self, hla):
+        """
+        Returns a copy of an initialized model without the data and the fusions of a given hla, used to evaluate
+        the deNovo prediction without training a new model. Note that the fusions of the other hlas
+        are not refined again.
+        :param hla: hla to remove
+        :return: MotifMaker without the hla
+        """
+        return self.with_hlas([x for x in self.hla_list if x != hla])
+
+    def with_hlas(self, hlas):
+        """
+        Returns a copy of an initialized model that only keeps the data and the fusions of the given hlas,
+        without counting the data again
+        :param hlas: hlas to keep
+        :return: MotifMaker with the given hlas
+        """
+        hla_set = set(hlas)
+        indexes = [self.hla_to_num[hla] for hla in self.hla_list if hla in hla_set]
+        motif = copy.copy(self)
+        motif.hla_list = [hla for hla in self.hla_list if hla in hla_set]
+        motif.total_hla = len(motif.hla_list)
+        motif.hla_to_num = {x: i for i, x in enumerate(motif.hla_list)}
+        motif.hla_aligment = {
+            x: sequence for x, sequence in self.hla_aligment.items() if x in hla_set
+        }
+        motif.test_data = {
+            x: data for x, data in self.test_data.items() if x in hla_set
+        }
+        motif.hla_to_env = {
+            position: {x: env for x, env in envs.items() if x in hla_set}
+            for position, envs in self.hla_to_env.items()
+        }
+        motif.env_to_hla = {
+            position: {
+                x: [fused for fused in fusions if fused in hla_set]
+                for x, fusions in position_fusions.items()
+                if x in hla_set
+            }
+            for position, position_fusions in self.env_to_hla.items()
+        }
+        motif.count_matrix = np.take(self.count_matrix, indexes, axis=1)
+        motif.random_model = np.take(self.random_model, indexes, axis=1)
+        return motif
+
+    def add_data(self, data):
+        """
+        Adds new data to the counts of an initialized model. Peptides already present with the same
+        qualitative value are ignored, and peptides present with a different one are removed from the
+        model (as the parser does with contradictory entries).
+        :param data: data to add {qualitative_value : {hla:[peptides]}}
+        :return: set of hlas whose data changed
+        """
+        to_add = {}
+        to_remove = {}
+        unknown_hlas = set()
+        for qualitative_value in data:
+            for hla, peptides in data[qualitative_value].items():
+                if hla not in self.hla_to_num:
+                    unknown_hlas.add(hla)
+                    continue
+                hla_data = self.test_data.setdefault(hla, {})
+                for peptide in peptides:
+                    known_values = [
+                        value
+                        for value, value_peptides in hla_data.items()
+                        if peptide in value_peptides
+                    ]
+                    if qualitative_value in known_values:
+                        continue
+                    elif known_values:
+                        for value in known_values:
+                            hla_data[value].remove(peptide)
+                            to_remove.setdefault(value, {}).setdefault(hla, []).append(
+                                peptide
+                            )
+                    else:
+                        hla_data.setdefault(qualitative_value, set()).add(peptide)
+                        to_add.setdefault(qualitative_value, {}).setdefault(
+                            hla, []
+                        ).append(peptide)
+        if unknown_hlas:
+            print(
+                "Warning: HLAs not present in the model (a full training is required to add them): ",
+                sorted(unknown_hlas),
+            )
+        self._count_data(to_add)
+        self._count_data(to_remove, value=-1)
+        changed_hlas = set()
+        for changes in (to_add, to_remove):
+            for qualitative_value in changes:
+                changed_hlas.update(changes[qualitative_value])
+        return changed_hlas
+
     def _compute_random_model(self):
         # Private method that computes the random model to use
         final_random_model = None
-        self.random_model += 1.0  # Add pseudocounts to avoid 0 division
+        # Add pseudocounts to avoid 0 division (on a copy, so building several times gives the same model)
+        random_model = self.random_model + 1.0
         if self.random_model_type in ["all", "negative"]:
             # Background model using all the data available
-            final_random_model = np.sum(self.random_model, axis=0)  # Add all positions
+            final_random_model = np.sum(random_model, axis=0)  # Add all positions
             final_random_model = np.sum(final_random_model, axis=0)  # Add all envs
             final_random_model /= np.sum(
                 final_random_model
@@ -108,7 +312,7 @@ class MotifMaker(PredictorCore):
 
         elif self.random_model_type == "unique":
             # Background model with only the frequencies for its HLA
-            final_random_model = np.sum(self.random_model, axis=0)
+            final_random_model = np.sum(random_model, axis=0)
             for hla_matrix in final_random_model:
                 hla_matrix /= np.sum(hla_matrix)
 
@@ -123,7 +327,7 @@ class MotifMaker(PredictorCore):
 
         elif self.random_model_type == "fused":
             # Background model using the frequencies of all the used HLA to build the model
-            final_random_model = np.sum(self.random_model, axis=0)
+            final_random_model = np.sum(random_model, axis=0)
             final_random_model_copy = copy.deepcopy(final_random_model)
             for hla in self.hla_list:
                 index_1 = self.hla_to_num[hla]
@@ -154,19 +358,79 @@ class MotifMaker(PredictorCore):
         # Method that initializes all the required numpy matrices
         self.count_matrix = self._create_matrix_skeleton()
         self.random_model = self._create_matrix_skeleton()
+        self._count_data(self.data)
+        # Empty the data to decrease RAM usage
+        self.data = None
 
+    def _count_data(self, data, value=1):
+        """
+        Private method that counts the signal and the background peptides used by the model
+        :param data: data to count {qualitative_value : {hla:[peptides]}} or EncodedDataset
+        :param value: value to add for each peptide (-1 removes previously counted peptides)
+        :return:
+        """
+        if isinstance(data, EncodedDataset):
+            self._count_dataset(data, value)
+            return
         if self.random_model_type in ["negative", "unique", "fused"]:
-            self._count(self.data[NEGATIVE], self.random_model)
+            self._count(data.get(NEGATIVE, {}), self.random_model, value=value)
 
         elif self.random_model_type in ["all"]:
-            all_data = []
-            for qualitative_value, data in self.data.items():
-                all_data += data
-            self._count(all_data, self.random_model)
+            for qualitative_value in data:
+                self._count(data[qualitative_value], self.random_model, value=value)
 
-        self._count(self.data[POSITIVE_HIGH], self.count_matrix, verbose=True)
-        # Empty the data to decrease RAM usage
-        self.data = None
+        self._count(
+            data.get(POSITIVE_HIGH, {}), self.count_matrix, verbose=True, value=value
+        )
+
+    def _count_dataset(self, dataset, value=1):
+        # Counts an EncodedDataset with one vectorized addition for each matrix (same rules as _count_data)
+        if self.random_model_type in ["negative", "unique", "fused"]:
+            background = dataset.labels == self._label_code(dataset, NEGATIVE)
+        elif self.random_model_type in ["all"]:
+            background = np.ones(len(dataset), dtype=bool)
+        else:
+            background = np.zeros(len(dataset), dtype=bool)
+        self._count_encoded(dataset, background, self.random_model, value=value)
+        signal = dataset.labels == self._label_code(dataset, POSITIVE_HIGH)
+        self._count_encoded(
+            dataset, signal, self.count_matrix, verbose=True, value=value
+        )
+
+    @staticmethod
+    def _label_code(dataset, label):
+        # Code of a qualitative value in the dataset (-1 if it is not present)
+        if label in dataset.label_names:
+            return dataset.label_names.index(label)
+        return -1
+
+    def _count_encoded(self, dataset, mask, matrix, verbose=False, value=1):
+        """
+        Private method that counts the entries of a dataset selected by a mask
+        :param dataset: EncodedDataset
+        :param mask: boolean array, entries to count
+        :param matrix: matrix to load the data into
+        :param verbose: Boolean, whether to print missing data warnings or not
+        :param value: value to add for each entry
+        :return:
+        """
+        allele_to_num = np.array(
+            [self.hla_to_num.get(hla, -1) for hla in dataset.allele_names] + [-1]
+        )
+        letter_to_num = np.array(
+            [self.letters_to_nums[letter] for letter in dataset.valid_letters]
+        )
+        hla_nums = allele_to_num[dataset.alleles[mask]]
+        known = hla_nums >= 0
+        if verbose and not np.all(known):
+            # Hla without enough data
+            hla_warnings = {
+                dataset.allele_names[x] for x in dataset.alleles[mask][~known]
+            }
+            print("Warning: Hlas without enough data: ", list(hla_warnings))
+        letters = letter_to_num[dataset.peptides[mask][known]]
+        positions = np.arange(dataset.length)[None, :]
+        np.add.at(matrix, (positions, hla_nums[known][:, None], letters), value)
 
     def _create_matrix_skeleton(self):
         # Private method that computes the size of the multidimensional array that will hold the data
@@ -176,12 +440,13 @@ class MotifMaker(PredictorCore):
         matrix = np.zeros(shape=(r_1, r_2, r_3), dtype=float)
         return matrix
 
-    def _count(self, data, matrix, verbose=False):
+    def _count(self, data, matrix, verbose=False, value=1):
         """
         Private method that counts the number of entries
         :param data: data to count
         :param matrix: matrix to load the data into
         :param verbose: Boolean, whether to print missing data warnings or not
+        :param value: value to add for each entry
         :return:
         """
         hla_warnings = set()
@@ -191,7 +456,7 @@ class MotifMaker(PredictorCore):
                     try:
                         matrix[i][self.hla_to_num[hla]][
                             self.letters_to_nums[letter]
-                        ] += 1
+                        ] += value
                     except KeyError:
                         # Hla without enough data
                         hla_warnings.add(hla)
@@ -229,25 +494,54 @@ class MotifMaker(PredictorCore):
             self.likelihood_matrix,
         )
 
-    def compare_all_envs(self):
-        # compares all the environments with each other
+    def compare_all_envs(self, hlas=None):
+        # compares all the environments with each other (or only the ones of the given hlas with all the others)
         hla_dict = {}
-        for hla in self.hla_list:
+        for hla in self.hla_list if hlas is None else hlas:
             hla_dict[hla] = self.compare_hla_envs(hla, self.compare_two_HLAs)
         return hla_dict
 
     def _compare_models(self, motif, hla, hla_dict, threshold=-1):
         # Builds and compares two models with different environments to select the best one
         good_fusions = {x: {} for x in range(self.motif_length)}
+        search_stats = {
+            "built": 0,
+            "similarity_stop": 0,
+            "candidate_cap": 0,
+            "duplicate_env": 0,
+        }
         refined_motif = copy.deepcopy(motif)
         original_model = motif.build()
         original_model.hla_list = [hla]
         MCC_1 = original_model.score_MCC(threshold, self.test_data)
         for i in range(self.motif_length):
             similarity = self.compare_two_HLAs(hla, hla, i)
+            evaluated_envs = set()
+            candidates = 0
             # self.env_to_hla = copy.deepcopy(old_env)
-            for similarity_tuple in hla_dict[hla][i]:
+            for n, similarity_tuple in enumerate(hla_dict[hla][i]):
                 new_similarity = similarity_tuple[0]
+                remaining = len(hla_dict[hla][i]) - n
+                # The list is sorted by similarity, so once a bound is hit no later candidate can pass it
+                if (
+                    self.max_similarity_drop is not None
+                    and similarity - new_similarity > self.max_similarity_drop
+                ):
+                    search_stats["similarity_stop"] += remaining
+                    break
+                if (
+                    self.max_candidates is not None
+                    and candidates >= self.max_candidates
+                ):
+                    search_stats["candidate_cap"] += remaining
+                    break
+                env_2 = self.hla_to_env[i][similarity_tuple[1]]
+                if self.skip_duplicate_envs and env_2 in evaluated_envs:
+                    search_stats["duplicate_env"] += 1
+                    continue
+                evaluated_envs.add(env_2)
+                candidates += 1
+                search_stats["built"] += 1
                 refined_motif.env_to_hla = copy.deepcopy(self.env_to_hla)
                 refined_motif.env_to_hla[i][hla].append(similarity_tuple[1])
                 refined_model = refined_motif.build()
@@ -261,26 +555,246 @@ class MotifMaker(PredictorCore):
                     )
                 else:
                     continue
-        return good_fusions
-
-    def refine_model(self, processors=1):
-        # Compares the HLA envs to determine which ones to fuse, based on a loss function
-        hla_dict = self.compare_all_envs()
-        pool = mp.Pool(processors)
-        workers = []
-        print("Refining Model")
-        for hla in self.hla_list:
-            workers.append(
-                pool.apply_async(
-                    self._compare_models, (copy.deepcopy(self), hla, hla_dict)
+        return good_fusions, search_stats
+
+    def _report_search_stats(self):
+        # Prints how many candidate models were built and how many were avoided by the search bounds
+        stats = {
+            key: self.search_stats.get(key, 0)
+            for key in ["built", "similarity_stop", "candidate_cap", "duplicate_env"]
+        }
+        avoided = (
+            stats["similarity_stop"] + stats["candidate_cap"] + stats["duplicate_env"]
+        )
+        print(
+            "Refinement: %s models built, %s avoided (similarity bound: %s, candidate cap: %s, "
+            "duplicate environments: %s)"
+            % (
+                stats["built"],
+                avoided,
+                stats["similarity_stop"],
+                stats["candidate_cap"],
+                stats["duplicate_env"],
+            )
+        )
+
+    def _compare_models_task(self, task):
+        # Unpacks a refinement task so it can be sent through Pool.imap_unordered
+        motif, hla, hla_dict = task
+        return hla, self._compare_models(motif, hla, hla_dict)
+
+    @staticmethod
+    def _file_name(hla):
+        # Name of an hla that can be used as a file name
+        return "".join(x if x.isalnum() else "_" for x in hla)
+
+    @staticmethod
+    def _fusions_checkpoint(checkpoint_dir, hla):
+        # Path of the checkpoint file with the accepted fusions of a given hla
+        return os.path.join(
+            checkpoint_dir, "fusions", "%s.pkl" % MotifMaker._file_name(hla)
+        )
+
+    def refinement_config(self):
+        """
+        Hash of everything that changes the fusions accepted by the refinement (counts, environments, similarity
+        matrix and search bounds), stored with the checkpoints and the queue jobs so they are only reused by
+        the same refinement
+        :return: hexadecimal string
+        """
+
+        def canonical(obj):
+            # Dicts as sorted lists, so the hash does not depend on the order of the keys
+            if isinstance(obj, dict):
+                return sorted((key, canonical(value)) for key, value in obj.items())
+            return obj
+
+        config = hashlib.sha1()
+        config.update(
+            repr(
+                (
+                    self.motif_length,
+                    list(self.hla_list),
+                    self.random_model_type,
+                    self.pseudocounts,
+                    self.max_similarity_drop,
+                    self.max_candidates,
+                    self.skip_duplicate_envs,
+                    canonical(self.similarity_matrix),
+                    canonical(self.similarity_weight),
+                    canonical(self.hla_to_env),
                 )
+            ).encode()
+        )
+        for matrix in (self.count_matrix, self.random_model):
+            if matrix is not None:
+                config.update(np.ascontiguousarray(matrix).tobytes())
+        return config.hexdigest()[:16]
+
+    def _refine_on_queue(
+        self, queue_dir, hlas, hla_dict, processors=1, pool=None, resume=False
+    ):
+        """
+        Refines the hlas through a work queue in a shared directory: the model and hla_dict are written once,
+        with one task for each hla, and the tasks are run by the workers of the pool (or by this process) and by
+        any worker started on other hosts with worker_NOAH.py. Then it waits for the tasks run by other workers,
+        taking the ones of the workers that die.
+        :param queue_dir: directory of the queue (shared by all the hosts)
+        :param hlas: hlas to refine
+        :param hla_dict: environments to compare (compare_all_envs)
+        :param processors: number of workers to start in the pool
+        :param pool: multiprocessing pool (None runs the tasks in this process)
+        :param resume: Boolean, keep the results of the previous job of the queue
+        :return: list of tuples (hla, (good_fusions, search_stats))
+        """
+        queue = work_queue.WorkQueue(queue_dir)
+        names = {self._file_name(hla): hla for hla in hlas}
+        job = queue.submit(
+            {"motif": self, "hla_dict": hla_dict},
+            {name: hla for name, hla in names.items()},
+            resume,
+            self.refinement_config(),
+        )
+        print(
+            "Refinement queue %s: %s HLAs to refine"
+            % (queue_dir, len(queue.pending(names, job)))
+        )
+        if pool is not None:
+            workers = [
+                pool.apply_async(refine_worker, (queue_dir,)) for _ in range(processors)
+            ]
+            for worker in workers:
+                worker.get()
+        while True:
+            # Also runs the tasks left by the workers that died
+            work_queue.run_worker(queue_dir, _refine_task)
+            pending = queue.pending(names, job)
+            if not pending:
+                break
+            print("Waiting for %s HLAs refined by other workers" % len(pending))
+            time.sleep(work_queue.POLL_INTERVAL)
+        return [(hla, queue.result(name, job)) for name, hla in names.items()]
+
+    def refine_model(
+        self,
+        processors=1,
+        checkpoint_dir=None,
+        resume=False,
+        hlas=None,
+        pool=None,
+        queue_dir=None,
+    ):
+        """
+        Compares the HLA envs to determine which ones to fuse, based on a loss function
+        :param processors: number of processors to use
+        :param checkpoint_dir: directory where the fusions accepted for each hla are saved as soon as they
+        are computed (None disables the checkpoints)
+        :param resume: Boolean, reuse the fusions already saved in checkpoint_dir instead of recomputing them
+        :param hlas: hlas to refine, their previous fusions are discarded and the fusions of the other hlas
+        are kept (None refines all of them)
+        :param pool: multiprocessing pool to use instead of creating a new one (it is not terminated)
+        :param queue_dir: directory shared by several hosts where the refinement tasks are written, so workers
+        started on other hosts (worker_NOAH.py) can run them (None runs them in this host)
+        :return: refined model
+        """
+        if hlas is None:
+            hlas_to_refine = self.hla_list
+        else:
+            hlas_to_refine = [hla for hla in self.hla_list if hla in hlas]
+            for hla in hlas_to_refine:
+                for i in range(self.motif_length):
+                    self.env_to_hla[i][hla] = [hla]
+        hla_dict = self.compare_all_envs(hlas_to_refine)
+        config = self.refinement_config()
+        results = {}  # {hla: (good_fusions, search_stats)}
+        if checkpoint_dir:
+            os.makedirs(os.path.join(checkpoint_dir, "fusions"), exist_ok=True)
+            if resume:
+                for hla in hlas_to_refine:
+                    checkpoint = utilities.load_checkpoint(
+                        self._fusions_checkpoint(checkpoint_dir, hla)
+                    )
+                    if checkpoint is None:
+                        continue
+                    if checkpoint["config"] != config:
+                        raise Exception(
+                            "Error: the fusions of %s in %s were refined with a different configuration\n"
+                            % (hla, checkpoint_dir)
+                        )
+                    results[hla] = checkpoint["result"]
+                print(
+                    "Resuming refinement: %s of %s HLAs already refined"
+                    % (len(results), len(hlas_to_refine))
+                )
+        own_pool = pool is None and processors > 1
+        if own_pool:
+            pool = mp.Pool(processors)
+        # The workers only need hla_dict, do not send them the similarity cache
+        similarity_cache = self.similarity_cache
+        self.similarity_cache = {}
+        try:
+            tasks = (
+                (copy.deepcopy(self), hla, hla_dict)
+                for hla in hlas_to_refine
+                if hla not in results
             )
-        for worker in workers:
-            good_fusions = worker.get()
+            print("Refining Model")
+            if queue_dir:
+                refined = self._refine_on_queue(
+                    queue_dir,
+                    [hla for hla in hlas_to_refine if hla not in results],
+                    hla_dict,
+                    processors,
+                    pool,
+                    resume,
+                )
+            elif pool is None:
+                # Run in this process (this also allows to refine models inside pool workers)
+                refined = map(self._compare_models_task, tasks)
+            else:
+                refined = pool.imap_unordered(self._compare_models_task, tasks)
+            for hla, result in refined:
+                if checkpoint_dir:
+                    utilities.save_checkpoint(
+                        {"config": config, "result": result},
+                        self._fusions_checkpoint(checkpoint_dir, hla),
+                    )
+                results[hla] = result
+        finally:
+            self.similarity_cache = similarity_cache
+            if own_pool:
+                pool.terminate()
+        self.search_stats = {}
+        for hla in hlas_to_refine:
+            good_fusions, search_stats = results[hla]
             for i in range(self.motif_length):
                 self.env_to_hla[i].update(good_fusions[i])
+            for key, value in search_stats.items():
+                self.search_stats[key] = self.search_stats.get(key, 0) + value
+        self._report_search_stats()
         print("building final model")
-        pool.terminate()
         model = self.build()
         model.set_similarity_matrix(self.similarity_matrix)
+        model.set_training_state(self.training_state())
+        rank_reference = self._rank_reference()
+        if rank_reference is not None:
+            print("computing percentile rank tables")
+            model.set_rank_reference(rank_reference)
+            model.compute_rank_tables()
         return model
+
+
+def _refine_task(state, hla):
+    # Refines an hla of a work queue with the shared model
+    motif = state["motif"]
+    return motif._compare_models(copy.deepcopy(motif), hla, state["hla_dict"])
+
+
+def refine_worker(queue_dir):
+    """
+    Runs the refinement tasks of a work queue (MotifMaker.refine_model with queue_dir) until there is no task
+    left to claim
+    :param queue_dir: directory of the queue
+    :return: number of hlas refined
+    """
+    return work_queue.run_worker(queue_dir, _refine_task)
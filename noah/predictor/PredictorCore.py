@@ -1,5 +1,6 @@
 import numpy as np
 from constants.constants import VALID_AMINOACIDS
+from utilities import diagnostics
 
 
 class PredictorCore:
@@ -29,6 +30,7 @@ class PredictorCore:
         self.similarity_matrix = None
         self.similarity_weight = sim_weight
         self.key_positions = key_positions
+        self.similarity_cache = {}  # {key positions: {(env_1, env_2): similarity}}
 
         # Mapping
         self.hla_to_env = None  # {pos:{hla:env}}  None for the abstract class
@@ -40,6 +42,11 @@ class PredictorCore:
 
     def set_similarity_matrix(self, matrix):
         self.similarity_matrix = matrix
+        self.similarity_cache = {}
+
+    def set_similarity_cache(self, similarity_cache):
+        # Shares the computed environment similarities with other models that use the same similarity matrix
+        self.similarity_cache = similarity_cache
 
     def compare_hla_envs(self, hla, function_to_use):
         """
@@ -74,20 +81,7 @@ class PredictorCore:
         similarity_list = []
         for hla in self.env_to_hla[position][hla_2]:
             env_2 = self.hla_to_env[position][hla]
-            similarity = np.array(
-                list(map(self.compare_one_letter, env_1, env_2)), dtype=np.float64
-            )
-            position_weight = np.array(
-                [
-                    self.similarity_weight[position][x]
-                    for x in self.key_positions[position]
-                ],
-                dtype=np.float64,
-            )
-            position_weight /= np.sum(position_weight)
-            similarity *= position_weight
-            similarity = np.sum(similarity)
-            similarity_list.append(similarity)
+            similarity_list.append(self.compare_environments(env_1, env_2, position))
         similarity = sum(similarity_list) / len(similarity_list)
         return similarity
 
@@ -102,16 +96,39 @@ class PredictorCore:
         """
         env_1 = self.hla_to_env[position][hla_1]
         env_2 = self.hla_to_env[position][hla_2]
+        return self.compare_environments(env_1, env_2, position)
+
+    def compare_environments(self, env_1, env_2, position):
+        """
+        Compares two binding environments of a given position.
+        The similarities are cached by key positions (and their weights), so HLAs with the same environment
+        and models of other lengths that share the key positions reuse them.
+        :param env_1: first environment (str)
+        :param env_2: second environment (str)
+        :param position: position of the motif of the environments
+        :return: similarity of the environments
+        """
+        if not env_1:
+            # Without key positions all the environments are equal
+            return 0.0
+        position_weight = [
+            self.similarity_weight[position][x] for x in self.key_positions[position]
+        ]
+        cache = self.similarity_cache.setdefault(
+            tuple(zip(self.key_positions[position], position_weight)), {}
+        )
+        try:
+            return cache[(env_1, env_2)]
+        except KeyError:
+            pass
         similarity = np.array(
             list(map(self.compare_one_letter, env_1, env_2)), dtype=np.float64
         )
-        position_weight = np.array(
-            [self.similarity_weight[position][x] for x in self.key_positions[position]],
-            dtype=np.float64,
-        )
+        position_weight = np.array(position_weight, dtype=np.float64)
         position_weight /= np.sum(position_weight)
         similarity *= position_weight
         similarity = np.sum(similarity)
+        cache[(env_1, env_2)] = similarity
         return similarity
 
     def compare_one_letter(self, letter_1, letter_2):
@@ -119,7 +136,12 @@ class PredictorCore:
         try:
             value = self.similarity_matrix[letter_1][letter_2]
         except KeyError:
-            print("WARNING UNKNOW LETTERS")
+            diagnostics.record(
+                diagnostics.UNKNOWN_LETTER,
+                None,
+                "unknown letters %s and %s in the similarity matrix, using 0"
+                % (letter_1, letter_2),
+            )
             value = 0
         return value
 
@@ -142,7 +164,8 @@ class PredictorCore:
         envs = {}
         for i in range(self.motif_length):
             env_string = ""
-            for key_position in self.key_positions[i]:
+            # positions without key positions (below the crystal evidence threshold) have an empty env
+            for key_position in self.key_positions.get(i, []):
                 env_string += sequence[key_position]
             envs[i] = env_string
         return envs
@@ -3,7 +3,12 @@ import sys
 
 import numpy as np
 from constants.constants import NEGATIVE, POSITIVE, POSITIVE_HIGH, POSITIVE_INTERMEDIATE
+from hlaizer.alignment_store import AlignmentStore
+from hlaizer.allele_index import AlleleIndex
+from predictor import ranks
+from predictor.compact import CompactLikelihoods
 from predictor.PredictorCore import PredictorCore
+from utilities import diagnostics, peptide_keys
 
 
 def rounder(function):
@@ -79,8 +84,54 @@ class Scorer(PredictorCore):
         self.hla_to_env = hla_to_env
         self.likelihood_matrix = likelyhood_matrix
         self.env_to_hla = env_to_hla
-        self.unknown_hlas = []
+        self.unknown_hlas = {}  # {pos:{hla:env}} loaded for the deNovo prediction
         self.unknown_hla_map = {}  # {hla: {position: likelyhood matrix}}
+        self.training_state = None  # counts and data used to update the model
+        self.alignment_store = None  # AlignmentStore used by the deNovo prediction
+        self.allele_index = None  # AlleleIndex of hla_list
+        self.rank_reference = None  # uint8 codes of the rank reference peptides
+        self.rank_tables = {}  # {hla: quantiles of the reference scores}
+        self.compact_likelihoods = None  # CompactLikelihoods used instead of the matrix
+
+    def __setstate__(self, state):
+        # Models pickled with older versions of NOAH lack the newer attributes
+        self.__dict__.update(state)
+        if not isinstance(self.unknown_hlas, dict):
+            self.unknown_hlas = {}
+        self.__dict__.setdefault("similarity_cache", {})
+        self.__dict__.setdefault("training_state", None)
+        self.__dict__.setdefault("alignment_store", None)
+        self.__dict__.setdefault("allele_index", None)
+        self.__dict__.setdefault("rank_reference", None)
+        self.__dict__.setdefault("rank_tables", {})
+        self.__dict__.setdefault("compact_likelihoods", None)
+
+    def get_likelihoods(self, position, hla_num):
+        # Likelihoods of an hla (its number in hla_to_num) at a position, from the matrix or the compact storage
+        if self.compact_likelihoods is not None:
+            return self.compact_likelihoods.profile(position, hla_num)
+        return self.likelihood_matrix[position][hla_num]
+
+    def compact(self, precision="float32"):
+        """
+        Replaces the likelihood matrix by a CompactLikelihoods (deduplicated profiles stored as float32, or int16
+        with a scale), which makes the model smaller. Only the profiles that the model reads are kept.
+        :param precision: float32 or int16 (see CompactLikelihoods for the accuracy of the scores)
+        :return:
+        """
+        if self.compact_likelihoods is not None:
+            matrix = self.compact_likelihoods.to_matrix()
+        else:
+            matrix = self.likelihood_matrix
+        used_rows = [
+            (i, self.hla_to_num[self.env_to_hla[i][hla][0]])
+            for i in range(self.motif_length)
+            for hla in self.hla_list
+        ]
+        self.compact_likelihoods = CompactLikelihoods.from_matrix(
+            matrix, used_rows, precision
+        )
+        self.likelihood_matrix = None
 
     def _score(self, peptide, hla, verb=True):
         """
@@ -94,13 +145,13 @@ class Scorer(PredictorCore):
         for i, letter in enumerate(peptide):
             hla_num = self.hla_to_num[self.env_to_hla[i][hla][0]]
             if letter in self.valid_letters:
-                score += self.likelihood_matrix[i][hla_num][
-                    self.letters_to_nums[letter]
-                ]
+                score += self.get_likelihoods(i, hla_num)[self.letters_to_nums[letter]]
             elif verb:
-                print(
-                    "WARNING: %s is not a valid character, skipping position %s of peptide %s"
-                    % (letter, i, peptide)
+                diagnostics.record(
+                    diagnostics.INVALID_RESIDUE,
+                    hla,
+                    "%s is not a valid character, skipping position %s of peptide %s"
+                    % (letter, i, peptide),
                 )
         return score
 
@@ -116,9 +167,11 @@ class Scorer(PredictorCore):
             if letter in self.valid_letters:
                 score += self.unknown_hla_map[hla][i][self.letters_to_nums[letter]]
             elif verb:
-                print(
-                    "WARNING: %s is not a valid character, skipping position %s of peptide %s"
-                    % (letter, i, peptide)
+                diagnostics.record(
+                    diagnostics.INVALID_RESIDUE,
+                    hla,
+                    "%s is not a valid character, skipping position %s of peptide %s"
+                    % (letter, i, peptide),
                 )
         return score
 
@@ -131,12 +184,28 @@ class Scorer(PredictorCore):
         :param hla: Hla for which the peptide has to be scored
         :return: loglikelihood score
         """
-        pept_template_list = []
-        extra_length = len(peptide) - self.motif_length
+        # now score each of the peptides
+        scores = []
+        for n_peptide in self._length_templates(peptide):
+            scores.append(self._score_rounded(n_peptide, hla, False))
+        return min(scores)
+
+    def _template_sources(self, length):
+        """
+        Positions of a peptide used by each template of the motif length (see _length_templates), based on a
+        sliding window that removes letters (or inserts X, which scores 0)
+        :param length: length of the peptide
+        :return: numpy array (templates, motif_length) with the position of the peptide used at each position
+        of the template (-1 for an inserted X). A peptide of the motif length is its only template.
+        """
+        if length == self.motif_length:
+            return np.arange(length).reshape(1, -1)
+        sources = []
+        extra_length = length - self.motif_length
         # create template peptides based on sliding window
-        lwindow = max(len(peptide), self.motif_length)
+        lwindow = max(length, self.motif_length)
         for position in range(lwindow):
-            new_peptide = list(peptide)
+            new_peptide = list(range(length))
             warp_count = 0
             alter_positions = []
             for i in range(abs(extra_length)):
@@ -147,18 +216,25 @@ class Scorer(PredictorCore):
                 alter_positions.append(pos)
             alter_positions.sort()
             if extra_length > 0:
-                new_peptide = list(peptide)
                 for j, alter in enumerate(alter_positions):
                     new_peptide.pop(alter - j)
             else:
                 for j, alter in enumerate(alter_positions):
-                    new_peptide.insert(alter, "X")
-            pept_template_list.append("".join(new_peptide))
-        # now score each of the peptides
-        scores = []
-        for n_peptide in pept_template_list:
-            scores.append(self._score_rounded(n_peptide, hla, False))
-        return min(scores)
+                    new_peptide.insert(alter, -1)
+            sources.append(new_peptide)
+        return np.array(sources, dtype=np.int64)
+
+    def _length_templates(self, peptide):
+        """
+        Creates the template peptides of the motif length of a peptide with a different length
+        (see _template_sources)
+        :param peptide: peptide
+        :return: list of template peptides
+        """
+        return [
+            "".join(peptide[i] if i >= 0 else "X" for i in template)
+            for template in self._template_sources(len(peptide))
+        ]
 
     @rounder
     def _score_rounded(self, peptide, hla, verb=True):
@@ -202,17 +278,61 @@ class Scorer(PredictorCore):
                                 TN += 1
         return TP, FP, TN, FN
 
+    def set_training_state(self, training_state):
+        self.training_state = training_state
+
     def save_pickle(self, name):
         print(name)
         with open(name, "wb") as inn:
             pickle.dump(self, inn)
 
+    def get_allele_index(self):
+        # Index of the modeled hla names, built the first time it is used
+        if self.allele_index is None:
+            self.allele_index = AlleleIndex(self.hla_list)
+        return self.allele_index
+
+    def resolve_hla(self, hla, required=True):
+        """
+        Finds the hlas to score for a requested hla: the modeled hla with that name, all the modeled hlas that
+        start with it (for example HLA-A*02) or its aliases (A*02:01, HLA-A0201...). If no modeled hla matches
+        it, the hla is prepared for the deNovo prediction.
+        :param hla: hla name, prefix or alias
+        :param required: Boolean, exit if the hla has to be predicted deNovo and its sequence is not loaded
+        (if False an empty list is returned instead)
+        :return: list of hlas
+        """
+        if hla in self.unknown_hla_map:
+            return [hla]
+        hlas = self.get_allele_index().resolve(hla)
+        if not hlas:
+            if not required and not self.has_sequence(hla):
+                return []
+            diagnostics.record(
+                diagnostics.UNKNOWN_HLA,
+                hla,
+                "HLA %s not known, making deNovo prediction" % hla,
+            )
+            self._prepare_for_denovo(hla)
+            hlas = [hla]
+        return hlas
+
+    def has_sequence(self, hla):
+        # Whether the sequence of an hla is loaded (or can be read) for the deNovo prediction
+        return hla in self.unknown_hlas.get(0, {}) or (
+            self.alignment_store is not None and hla in self.alignment_store
+        )
+
+    def is_resolved(self, hla):
+        # Whether an exact hla name is modeled or already prepared for the deNovo prediction
+        return hla in self.unknown_hla_map or hla in self.get_allele_index()
+
     def score_peptide(self, sequence, *args):
         """
         Main method to score peptides.
         It can predict peptides individually and for multiple HLA at the same time.
-        If an exact hla name is provided it computes the score for that hla, if a substring is provided,
-        all the matching HLA will be used.
+        If an exact hla name is provided it computes the score for that hla, if a prefix (or an alias) is provided,
+        all the matching HLA will be used (see resolve_hla).
         :param sequence: sequence to predict
         :param args: HLA's to use
         :return: dictionary with {hla:peptide:score}
@@ -224,39 +344,258 @@ class Scorer(PredictorCore):
                 continue
             else:
                 hla_to_evaluate.append(hla)
-        for hla in hla_to_evaluate:
-            unknow_hla = True
-            for valid_hla in self.hla_list:
-                if hla in valid_hla:
-                    unknow_hla = False
-            if unknow_hla:
-                print("HLA %s not known\nMaking deNovo prediction" % hla)
-                self._prepare_for_denovo(hla)
-        if len(hla_to_evaluate) == 1:
-            result = {}
-            if len(sequence) == self.motif_length:
-                score = self._score_rounded(sequence, hla_to_evaluate[0])
-            else:
-                score = self._diffsize_score(sequence, hla_to_evaluate[0])
-            result.setdefault(hla_to_evaluate[0], {}).setdefault(sequence, score)
-            return result
-        elif len(hla_to_evaluate) > 1:
-            results = {}
-            for hla in hla_to_evaluate:
+        if not hla_to_evaluate:
+            diagnostics.record(
+                diagnostics.NO_HLA, None, "No HLAs provided for peptide %s" % sequence
+            )
+            return {}
+        results = {}
+        for query in hla_to_evaluate:
+            for hla in self.resolve_hla(query):
                 if len(sequence) == self.motif_length:
                     score = self._score_rounded(sequence, hla)
                 else:
                     score = self._diffsize_score(sequence, hla)
                 results.setdefault(hla, {}).setdefault(sequence, score)
-            return results
-        else:
-            print("No HLAs Provided")
-            return {}
+        return results
+
+    def compile_profiles(self, hlas):
+        """
+        Stacks the likelihoods used to score each hla, so many peptides can be scored for many hlas at once
+        :param hlas: list of hlas (modeled or already prepared for the deNovo prediction)
+        :return: numpy array (hlas, motif_length, letters + 1), the last letter (invalid characters) scores 0
+        """
+        profiles = np.zeros((len(hlas), self.motif_length, len(self.valid_letters) + 1))
+        for n, hla in enumerate(hlas):
+            for i in range(self.motif_length):
+                if hla in self.unknown_hla_map:
+                    profiles[n, i, :-1] = self.unknown_hla_map[hla][i]
+                else:
+                    hla_num = self.hla_to_num[self.env_to_hla[i][hla][0]]
+                    profiles[n, i, :-1] = self.get_likelihoods(i, hla_num)
+        return profiles
+
+    def score_profiles(self, profiles, peptides):
+        """
+        Scores peptides with compiled profiles. Peptides of a different length are scored with their best
+        sliding window template, as in score_peptide.
+        :param profiles: numpy array created by compile_profiles
+        :param peptides: list of peptides
+        :return: numpy array (peptides, hlas) with the scores
+        """
+        templates = []
+        owners = []
+        for n, peptide in enumerate(peptides):
+            if len(peptide) == self.motif_length:
+                templates.append(peptide)
+                owners.append(n)
+            else:
+                peptide_templates = self._length_templates(peptide)
+                templates += peptide_templates
+                owners += [n] * len(peptide_templates)
+        # Every peptide is encoded once and scored for all the hlas
+        codes = peptide_keys.letter_codes(
+            templates, self.motif_length, self.valid_letters
+        )
+        template_scores = self._score_codes(profiles, codes)
+        scores = np.full((len(peptides), len(profiles)), np.inf)
+        np.minimum.at(scores, np.array(owners, dtype=np.int64), template_scores)
+        return np.round(scores, 3)
+
+    @staticmethod
+    def _score_codes(profiles, codes):
+        # Scores encoded peptides (peptides, motif_length) with compiled profiles, returns (peptides, hlas)
+        scores = np.zeros((len(codes), len(profiles)))
+        for i in range(codes.shape[1]):
+            scores += profiles[:, i, codes[:, i]].T
+        return scores
+
+    def score_pairs(self, data):
+        """
+        Scores (peptide, hla) pairs. The peptides requested for each hla are scored at once with the compiled
+        profiles, with the same result as score_peptide for each pair.
+        :param data: list of tuples (peptide, hla), the hla can be a name, a prefix or an alias (see resolve_hla)
+        :return: dict {hla: {peptide: score}}
+        """
+        queries = {}  # {requested hla: [peptides]}
+        for peptide, hla in data:
+            queries.setdefault(hla, []).append(peptide)
+        valid = set(self.valid_letters)
+        results = {}
+        for query, peptides in queries.items():
+            hlas = self.resolve_hla(query)
+            invalid = [x for x in peptides if not valid.issuperset(x)]
+            if invalid:
+                # The invalid characters are skipped (they score 0), as in score_peptide
+                diagnostics.record(
+                    diagnostics.INVALID_RESIDUE,
+                    query,
+                    "peptide %s has characters that are not valid, skipping them"
+                    % invalid[0],
+                    len(invalid),
+                )
+            scores = self.score_profiles(self.compile_profiles(hlas), peptides)
+            for column, hla in enumerate(hlas):
+                for n, peptide in enumerate(peptides):
+                    results.setdefault(hla, {}).setdefault(peptide, scores[n, column])
+        return results
+
+    def score_mutations(self, peptides, offsets, alts, genotype):
+        """
+        Scores wild type peptides and the mutant peptides that differ from them in one position.
+        Each different wild type peptide is scored once for each template, and the score of its mutants is
+        derived adding the difference between the likelihoods of the mutant and the wild type letters at the
+        position of each template that uses the mutated letter.
+        :param peptides: list of wild type peptides of the same length
+        :param offsets: position of the mutation in each peptide (0-based)
+        :param alts: mutant letter of each peptide
+        :param genotype: list of hlas (names, prefixes or aliases, see resolve_hla)
+        :return: hlas, wild type scores and mutant scores (numpy arrays (peptides, hlas))
+        """
+        hlas = []
+        for query in genotype:
+            for hla in self.resolve_hla(query):
+                if hla not in hlas:
+                    hlas.append(hla)
+        profiles = self.compile_profiles(hlas)
+        shape = (len(peptides), len(hlas))
+        if not len(peptides) or not hlas:
+            return hlas, np.zeros(shape), np.zeros(shape)
+        length = len(peptides[0])
+        sources = self._template_sources(length)
+        unique_peptides, inverse = np.unique(
+            np.array(peptides, dtype=str), return_inverse=True
+        )
+        inverse = inverse.ravel()
+        codes = peptide_keys.letter_codes(
+            unique_peptides.tolist(), length, self.valid_letters
+        )
+        # Inserted X of the templates use the invalid letter, which scores 0
+        codes = np.hstack(
+            [codes, np.full((len(codes), 1), len(self.valid_letters), dtype=np.uint8)]
+        )
+        offsets = np.asarray(offsets, dtype=np.int64)
+        ref_codes = codes[inverse, offsets]
+        alt_codes = peptide_keys.letter_codes(list(alts), 1, self.valid_letters)[:, 0]
+        wt_scores = np.full(shape, np.inf)
+        mut_scores = np.full(shape, np.inf)
+        for template in sources:
+            template_scores = self._score_codes(profiles, codes[:, template])[inverse]
+            wt_scores = np.minimum(wt_scores, template_scores)
+            # Position of the template that uses the mutated letter (if any)
+            used = template[None, :] == offsets[:, None]
+            delta = np.zeros(shape)
+            mutated, position = np.nonzero(used)
+            delta[mutated] = (
+                profiles[:, position, alt_codes[mutated]]
+                - profiles[:, position, ref_codes[mutated]]
+            ).T
+            mut_scores = np.minimum(mut_scores, template_scores + delta)
+        return hlas, np.round(wt_scores, 3), np.round(mut_scores, 3)
+
+    def score_genotype(self, peptides, genotype, rank=False):
+        """
+        Scores peptides for all the hlas of a genotype at once
+        :param peptides: list of peptides
+        :param genotype: list of hlas (names, prefixes or aliases, see resolve_hla)
+        :param rank: Boolean, also compute the percentile ranks and use them to choose the best hla
+        :return: dict with the scored hlas ("hlas"), the scores of each peptide for each hla ("scores",
+        numpy array (peptides, hlas)), and the best hla and score of each peptide ("best_hla", "best_score").
+        With rank, also the ranks ("ranks") and the rank of the best hla ("best_rank")
+        """
+        hlas = []
+        for query in genotype:
+            for hla in self.resolve_hla(query):
+                if hla not in hlas:
+                    hlas.append(hla)
+        scores = self.score_profiles(self.compile_profiles(hlas), peptides)
+        peptide_ranks = None
+        if rank:
+            peptide_ranks = np.zeros(scores.shape)
+            for n, hla in enumerate(hlas):
+                peptide_ranks[:, n] = self.percentile_rank(hla, scores[:, n])
+        return self._genotype_result(hlas, scores, peptide_ranks)
+
+    @staticmethod
+    def _genotype_result(hlas, scores, peptide_ranks=None):
+        # Packs the scores of a genotype with the best hla of each peptide (lower is better)
+        result = {"hlas": hlas, "scores": scores, "best_hla": [], "best_score": []}
+        if peptide_ranks is not None:
+            result["ranks"] = peptide_ranks
+            result["best_rank"] = []
+        if not hlas:
+            return result
+        best = np.argmin(scores if peptide_ranks is None else peptide_ranks, axis=1)
+        result["best_hla"] = [hlas[x] for x in best]
+        result["best_score"] = scores[np.arange(len(best)), best]
+        if peptide_ranks is not None:
+            result["best_rank"] = peptide_ranks[np.arange(len(best)), best]
+        return result
+
+    def get_model(self, length):
+        # Model to use for peptides of the given length (same interface as ScorerBundle)
+        return self
+
+    def set_rank_reference(self, reference):
+        """
+        Sets the reference peptides used to compute the percentile ranks
+        :param reference: uint8 array (peptides, motif_length) with the index of each letter in valid_letters
+        :return:
+        """
+        self.rank_reference = reference
+        self.rank_tables = {}
+
+    def compute_rank_tables(self, hlas=None):
+        """
+        Scores the reference peptides for each hla and stores the quantiles of their scores
+        :param hlas: hlas to compute (default all the modeled hlas)
+        :return:
+        """
+        if self.rank_reference is None:
+            self.set_rank_reference(
+                ranks.reference_codes(
+                    self.motif_length, valid_letters=self.valid_letters
+                )
+            )
+        if hlas is None:
+            hlas = self.hla_list
+        # hlas scored at once, so the score matrix stays around 50M values
+        batch = max(1, int(5e7 // max(1, len(self.rank_reference))))
+        for start in range(0, len(hlas), batch):
+            batch_hlas = hlas[start : start + batch]
+            scores = self._score_codes(
+                self.compile_profiles(batch_hlas), self.rank_reference
+            )
+            for hla, table in zip(batch_hlas, ranks.quantile_tables(scores)):
+                self.rank_tables[hla] = table
+
+    def percentile_rank(self, hla, scores):
+        """
+        Percentile rank of scores of an hla among the scores of the reference peptides (lower is better)
+        :param hla: hla (modeled or prepared for the deNovo prediction)
+        :param scores: score or numpy array of scores
+        :return: rank or numpy array of ranks
+        """
+        if hla not in self.rank_tables:
+            # Models trained without ranks compute the table the first time it is needed
+            self.compute_rank_tables([hla])
+        return ranks.percentile_rank(self.rank_tables[hla], scores)
 
     def _prepare_for_denovo(self, hla):
         # Loads and prepares the model to be able to do deNovo predictions
-        if hla in self.unknown_hlas[0]:
-            self.hla_list.append(hla)
+        if (
+            hla not in self.unknown_hlas.get(0, {})
+            and self.alignment_store is not None
+            and hla in self.alignment_store
+        ):
+            self.load_sequences({hla: self.alignment_store.get(hla)})
+        if hla in self.unknown_hlas.get(0, {}):
+            # hla_to_env is shared with the MotifMaker that built the model, the unknown hla is added to a copy
+            self.hla_to_env = {
+                position: dict(envs) for position, envs in self.hla_to_env.items()
+            }
+            for position in range(self.motif_length):
+                self.hla_to_env[position][hla] = self.unknown_hlas[position][hla]
             similarities = self.compare_hla_envs(
                 hla, self.compare_two_global_environemnts
             )
@@ -264,31 +603,50 @@ class Scorer(PredictorCore):
                 hla, self._create_unknownhla_matrix_skeleton()
             )
             for position in range(self.motif_length):
+                # Average of the most similar known hlas
                 bestscore = similarities[position][0][0]
                 score = similarities[position][0][0]
                 count = 0
                 while bestscore == score:
                     hla_num = self.hla_to_num[
-                        self.env_to_hla[position][similarities[position][0][1]][0]
+                        self.env_to_hla[position][similarities[position][count][1]][0]
                     ]
-                    self.unknown_hla_map[hla][position] += self.likelihood_matrix[
-                        position
-                    ][hla_num]
+                    self.unknown_hla_map[hla][position] += self.get_likelihoods(
+                        position, hla_num
+                    )
                     count += 1
                     try:
                         score = similarities[position][count][0]
-                    except:
+                    except IndexError:
                         break
                 self.unknown_hla_map[hla][position] /= count
+            if self.rank_reference is not None:
+                self.compute_rank_tables([hla])
         else:
             sys.stderr.write("Error no sequence provided for HLA %s\n" % hla)
             sys.stderr.write("Please load a file with the sequences in Selex format\n")
             exit(1)
         return
 
-    def load_sequences(self, aligment_dict):
-        # loads new HLAs for the deNovo prediction
-        self.unknown_hlas += self.extract_binding_environment(aligment_dict)
+    def load_sequences(self, aligment, hlas=None):
+        """
+        Loads new HLAs for the deNovo prediction
+        :param aligment: dict {hla: sequence} or AlignmentStore
+        :param hlas: only load these hlas (names or prefixes). If it is not given and aligment is an AlignmentStore,
+        the sequences are read from it when an unknown hla is scored
+        :return:
+        """
+        if isinstance(aligment, AlignmentStore):
+            if hlas is None:
+                self.alignment_store = aligment
+                return
+            aligment_dict = aligment.select(hlas)
+        elif hlas is not None:
+            aligment_dict = AlignmentStore.select_from_dict(aligment, hlas)
+        else:
+            aligment_dict = aligment
+        for position, envs in self.extract_binding_environment(aligment_dict).items():
+            self.unknown_hlas.setdefault(position, {}).update(envs)
 
     def _create_unknownhla_matrix_skeleton(self):
         # Private method that computes the size of the multidimensional array that will hold the data
@@ -296,3 +654,312 @@ class Scorer(PredictorCore):
         r_2 = len(self.valid_letters)
         matrix = np.zeros(shape=(r_1, r_2), dtype=float)
         return matrix
+
+
+class ScorerBundle:
+    """
+    Group of trained models built with peptides of different lengths.
+    Each peptide is scored with the model of its length, or with the model of the closest length if there is
+    no model for it.
+    """
+
+    def __init__(self, models):
+        """
+        :param models: dict {length: Scorer}
+        """
+        self.models = models
+        self.motif_lengths = sorted(models)
+
+    @property
+    def valid_letters(self):
+        # All the models are trained with the same amino acids
+        return self.models[self.motif_lengths[0]].valid_letters
+
+    def get_model(self, length):
+        # Returns the model to use for peptides of the given length
+        closest_length = min(self.motif_lengths, key=lambda x: (abs(x - length), x))
+        return self.models[closest_length]
+
+    def score_peptide(self, sequence, *args):
+        """
+        Scores a peptide with the model of its length (see Scorer.score_peptide)
+        :param sequence: sequence to predict
+        :param args: HLA's to use
+        :return: dictionary with {hla:peptide:score}
+        """
+        return self.get_model(len(sequence)).score_peptide(sequence, *args)
+
+    def score_pairs(self, data):
+        """
+        Scores (peptide, hla) pairs, each peptide with the model of its length (see Scorer.score_pairs)
+        :param data: list of tuples (peptide, hla)
+        :return: dict {hla: {peptide: score}}
+        """
+        groups = {}
+        for element in data:
+            length = self.get_model(len(element[0])).motif_length
+            groups.setdefault(length, []).append(element)
+        results = {}
+        for length, group in groups.items():
+            for hla, scores in self.models[length].score_pairs(group).items():
+                for peptide, score in scores.items():
+                    results.setdefault(hla, {}).setdefault(peptide, score)
+        return results
+
+    def score_genotype(self, peptides, genotype, rank=False):
+        """
+        Scores peptides for all the hlas of a genotype, each peptide with the model of its length
+        (see Scorer.score_genotype)
+        :param peptides: list of peptides
+        :param genotype: list of hlas
+        :param rank: Boolean, also compute the percentile ranks and use them to choose the best hla
+        :return: dict with the hlas, the scores, the best hla and the best score of each peptide
+        """
+        groups = {}
+        for n, peptide in enumerate(peptides):
+            groups.setdefault(self.get_model(len(peptide)).motif_length, []).append(n)
+        hlas = []
+        group_results = {}
+        for length, indexes in groups.items():
+            result = self.models[length].score_genotype(
+                [peptides[n] for n in indexes], genotype, rank
+            )
+            group_results[length] = result
+            hlas += [hla for hla in result["hlas"] if hla not in hlas]
+        scores = np.full((len(peptides), len(hlas)), np.inf)
+        peptide_ranks = np.full((len(peptides), len(hlas)), np.inf) if rank else None
+        for length, indexes in groups.items():
+            result = group_results[length]
+            columns = [hlas.index(hla) for hla in result["hlas"]]
+            scores[np.ix_(indexes, columns)] = result["scores"]
+            if rank:
+                peptide_ranks[np.ix_(indexes, columns)] = result["ranks"]
+        return Scorer._genotype_result(hlas, scores, peptide_ranks)
+
+    def load_sequences(self, aligment, hlas=None):
+        # loads new HLAs for the deNovo prediction in all the models (see Scorer.load_sequences)
+        for model in self.models.values():
+            model.load_sequences(aligment, hlas)
+
+    def compact(self, precision="float32"):
+        # Stores the likelihoods of all the models in compact form (see Scorer.compact)
+        for model in self.models.values():
+            model.compact(precision)
+
+    def save_pickle(self, name):
+        print(name)
+        with open(name, "wb") as inn:
+            pickle.dump(self, inn)
+
+
+class ScorerEnsemble:
+    """
+    Group of models trained on the same peptides with different parameters (for example different backgrounds
+    or similarity matrices). The compiled profiles of the models are stacked along a model axis, so the
+    peptides are encoded once and scored for every model and hla in one pass, and the scores of the models
+    are aggregated (mean, min or number of models that call the peptide a binder).
+    """
+
+    AGGREGATIONS = ["mean", "min", "vote"]
+
+    def __init__(self, models, names=None):
+        """
+        :param models: list of Scorer or ScorerBundle
+        :param names: name of each model (default model_0, model_1...)
+        """
+        self.models = list(models)
+        if names is None:
+            names = ["model_%s" % n for n in range(len(self.models))]
+        self.names = list(names)
+        if len({tuple(model.valid_letters) for model in self.models}) > 1:
+            raise Exception(
+                "Error: the models of an ensemble must use the same amino acids\n"
+            )
+        self.valid_letters = self.models[0].valid_letters
+
+    def resolve_hlas(self, genotype):
+        """
+        Finds the hlas to score (see Scorer.resolve_hla) in all the models, and prepares the deNovo prediction
+        of the hlas that are not modeled by some of them. An hla that a model can not predict (not modeled
+        and without a loaded sequence) is reported and scored only by the other models, the run only stops
+        if no model can predict it.
+        :param genotype: list of hlas (names, prefixes or aliases)
+        :return: list of hlas
+        """
+        hlas = []
+        scorers = self._scorers()
+        for query in genotype:
+            found = []
+            for name, scorer in scorers:
+                if query in scorer.unknown_hla_map:
+                    found.append(query)
+                found += scorer.get_allele_index().resolve(query)
+            # Names that no model knows are predicted deNovo by all of them
+            for hla in found if found else [query]:
+                if hla not in hlas:
+                    hlas.append(hla)
+        for hla in hlas:
+            resolved = False
+            for name, scorer in scorers:
+                if scorer.is_resolved(hla) or hla in scorer.resolve_hla(
+                    hla, required=False
+                ):
+                    resolved = True
+                else:
+                    diagnostics.record(
+                        diagnostics.UNRESOLVED_HLA,
+                        hla,
+                        "HLA %s can not be predicted by model %s (not modeled and no sequence loaded), "
+                        "using the other models" % (hla, name),
+                    )
+            if not resolved:
+                sys.stderr.write("Error no model can predict HLA %s\n" % hla)
+                sys.stderr.write(
+                    "Please load a file with the sequences in Selex format\n"
+                )
+                exit(1)
+        return hlas
+
+    def _scorers(self):
+        # Name and Scorer of all the models of the ensemble (the models of the bundles are listed one by one)
+        scorers = []
+        for name, model in zip(self.names, self.models):
+            if isinstance(model, ScorerBundle):
+                scorers += [
+                    ("%s (length %s)" % (name, length), model.models[length])
+                    for length in model.motif_lengths
+                ]
+            else:
+                scorers.append((name, model))
+        return scorers
+
+    def score_models(self, peptides, hlas):
+        """
+        Scores peptides with all the models. The models with the same motif length for a peptide length
+        are scored together with their stacked profiles.
+        :param peptides: list of peptides
+        :param hlas: list of hlas already resolved (see resolve_hlas)
+        :return: numpy array (models, peptides, hlas), nan for the hlas that a model can not predict
+        """
+        scores = np.full((len(self.models), len(peptides), len(hlas)), np.inf)
+        groups = {}  # {peptide length: [peptide indexes]}
+        for n, peptide in enumerate(peptides):
+            groups.setdefault(len(peptide), []).append(n)
+        for length, indexes in groups.items():
+            stacks = {}  # {motif length: [model indexes]}
+            for n, model in enumerate(self.models):
+                stacks.setdefault(model.get_model(length).motif_length, []).append(n)
+            for model_indexes in stacks.values():
+                scorers = [self.models[n].get_model(length) for n in model_indexes]
+                # The hlas that a model can not predict get an empty profile and a nan score
+                available = np.array(
+                    [[scorer.is_resolved(hla) for hla in hlas] for scorer in scorers],
+                    dtype=bool,
+                ).reshape(len(scorers), len(hlas))
+                profiles = np.zeros(
+                    (
+                        len(scorers) * len(hlas),
+                        scorers[0].motif_length,
+                        len(self.valid_letters) + 1,
+                    )
+                )
+                for k, scorer in enumerate(scorers):
+                    columns = np.flatnonzero(available[k])
+                    profiles[k * len(hlas) + columns] = scorer.compile_profiles(
+                        [hlas[x] for x in columns]
+                    )
+                stacked_scores = (
+                    scorers[0]
+                    .score_profiles(profiles, [peptides[n] for n in indexes])
+                    .reshape(len(indexes), len(model_indexes), len(hlas))
+                )
+                stacked_scores[:, ~available] = np.nan
+                for k, n in enumerate(model_indexes):
+                    scores[n][indexes] = stacked_scores[:, k, :]
+        return scores
+
+    @staticmethod
+    def aggregate_scores(scores, aggregate="mean", threshold=-1):
+        """
+        Aggregates the scores of the models, ignoring the nan scores of the models that can not predict an hla
+        :param scores: numpy array (models, peptides, hlas)
+        :param aggregate: mean, min (best score of the models) or vote (number of models with a score lower
+        or equal than the threshold)
+        :param threshold: binding threshold of the vote
+        :return: numpy array (peptides, hlas)
+        """
+        if aggregate == "mean":
+            return np.round(np.nanmean(scores, axis=0), 3)
+        if aggregate == "min":
+            return np.nanmin(scores, axis=0)
+        if aggregate == "vote":
+            return np.sum(scores <= threshold, axis=0)
+        raise Exception(
+            "Error: aggregation %s not found. Valid aggregations: %s\n"
+            % (aggregate, " ".join(ScorerEnsemble.AGGREGATIONS))
+        )
+
+    def score_genotype(self, peptides, genotype, aggregate="mean", threshold=-1):
+        """
+        Scores peptides for all the hlas of a genotype with all the models
+        :param peptides: list of peptides
+        :param genotype: list of hlas (names, prefixes or aliases)
+        :param aggregate: how the scores of the models are aggregated (see aggregate_scores)
+        :param threshold: binding threshold of the vote
+        :return: dict with the scored hlas ("hlas"), the scores of each model ("model_scores", numpy array
+        (models, peptides, hlas)), the aggregated scores ("scores") and the best hla and aggregated score of
+        each peptide ("best_hla", "best_score"). With vote the best hla has the most votes, and ties are broken
+        by the mean score.
+        """
+        hlas = self.resolve_hlas(genotype)
+        model_scores = self.score_models(peptides, hlas)
+        scores = self.aggregate_scores(model_scores, aggregate, threshold)
+        result = {
+            "hlas": hlas,
+            "model_scores": model_scores,
+            "scores": scores,
+            "best_hla": [],
+            "best_score": [],
+        }
+        if not hlas or not len(peptides):
+            return result
+        if aggregate == "vote":
+            mean_scores = np.nanmean(model_scores, axis=0)
+            best = np.lexsort((mean_scores, -scores), axis=-1)[:, 0]
+        else:
+            best = np.argmin(scores, axis=1)
+        result["best_hla"] = [hlas[x] for x in best]
+        result["best_score"] = scores[np.arange(len(best)), best]
+        return result
+
+    def score_pairs(self, data, aggregate="mean", threshold=-1):
+        """
+        Scores (peptide, hla) pairs with all the models, the peptides of each hla are scored at once
+        :param data: list of tuples (peptide, hla)
+        :param aggregate: how the scores of the models are aggregated (see aggregate_scores)
+        :param threshold: binding threshold of the vote
+        :return: dicts {hla: {peptide: aggregated score}} and {hla: {peptide: [score of each model]}}
+        """
+        queries = {}  # {requested hla: [peptides]}
+        for peptide, hla in data:
+            queries.setdefault(hla, []).append(peptide)
+        aggregated = {}
+        model_scores = {}
+        for query, peptides in queries.items():
+            hlas = self.resolve_hlas([query])
+            scores = self.score_models(peptides, hlas)
+            query_aggregated = self.aggregate_scores(scores, aggregate, threshold)
+            for column, hla in enumerate(hlas):
+                for n, peptide in enumerate(peptides):
+                    aggregated.setdefault(hla, {}).setdefault(
+                        peptide, query_aggregated[n, column]
+                    )
+                    model_scores.setdefault(hla, {}).setdefault(
+                        peptide, scores[:, n, column].tolist()
+                    )
+        return aggregated, model_scores
+
+    def load_sequences(self, aligment, hlas=None):
+        # loads new HLAs for the deNovo prediction in all the models (see Scorer.load_sequences)
+        for model in self.models:
+            model.load_sequences(aligment, hlas)
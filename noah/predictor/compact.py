@@ -0,0 +1,107 @@
+import numpy as np
+
+PRECISIONS = ["float32", "int16"]
+INT16_MAX = np.iinfo(np.int16).max
+
+
+class CompactLikelihoods:
+    """
+    Compact storage of the likelihoods of a trained model. Each different (position, hla) profile is stored
+    once as a row of a table, and an index gives the row of each position and hla (-1 for the rows that the
+    model never reads, reading them raises an error). The table is stored as float32, or as int16 with a scale
+    (the likelihoods that are not finite are always stored as float32).
+
+    Accuracy: each int16 value differs at most scale / 2 from the original one, so the score of a peptide of
+    length L differs at most L * scale / 2 (scale = largest absolute likelihood / 32767, around 1e-4 for the
+    usual likelihoods). float32 values differ at most largest * 2^-24. Once rounded to 3 decimals, the scores
+    are the same or differ in 0.001 when the error crosses a rounding boundary.
+    """
+
+    def __init__(self, rows, index, scale=None):
+        """
+        :param rows: numpy array (rows, letters) float32 or int16
+        :param index: int32 numpy array (positions, hlas) with the row of each position and hla number
+        :param scale: value of one int16 unit (None for float32 rows)
+        """
+        self.rows = rows
+        self.index = index
+        self.scale = scale
+
+    @property
+    def precision(self):
+        return str(self.rows.dtype)
+
+    @property
+    def nbytes(self):
+        # Memory used by the table and the index
+        return self.rows.nbytes + self.index.nbytes
+
+    @property
+    def error_bound(self):
+        # Largest difference between a score (before rounding) and the score computed with the original likelihoods
+        if self.scale is None:
+            largest = float(np.max(np.abs(self.rows))) if self.rows.size else 0.0
+            return self.index.shape[0] * largest * 2.0**-24
+        return self.index.shape[0] * self.scale / 2
+
+    @classmethod
+    def from_matrix(cls, likelihood_matrix, used_rows, precision="float32"):
+        """
+        Builds the compact storage of a likelihood matrix
+        :param likelihood_matrix: numpy array (positions, hlas, letters)
+        :param used_rows: iterable of tuples (position, hla number) that the model reads
+        :param precision: float32 or int16
+        :return: CompactLikelihoods
+        """
+        if precision not in PRECISIONS:
+            raise Exception(
+                "Error: precision %s not found. Valid precisions: %s\n"
+                % (precision, " ".join(PRECISIONS))
+            )
+        matrix = np.asarray(likelihood_matrix, dtype=np.float64)
+        positions = np.array(sorted(set(used_rows)), dtype=np.int64).reshape(-1, 2)
+        values = matrix[positions[:, 0], positions[:, 1]]
+        scale = None
+        if precision == "int16" and not np.all(np.isfinite(values)):
+            # Infinite likelihoods (no pseudocounts) can not be scaled to int16
+            print(
+                "Warning: the likelihoods are not finite, storing them as float32 instead of int16"
+            )
+            precision = "float32"
+        if precision == "int16":
+            largest = np.max(np.abs(values)) if len(values) else 0.0
+            scale = float(largest / INT16_MAX) if largest > 0 else 1.0
+            values = np.round(values / scale).astype(np.int16)
+        else:
+            values = values.astype(np.float32)
+        # Identical profiles (for example the ones of fused hlas) share one row
+        rows, inverse = np.unique(values, axis=0, return_inverse=True)
+        index = np.full(matrix.shape[:2], -1, dtype=np.int32)
+        index[positions[:, 0], positions[:, 1]] = inverse.ravel()
+        return cls(rows, index, scale)
+
+    def profile(self, position, hla_num):
+        """
+        Likelihoods of an hla at a position
+        :param position: position of the motif
+        :param hla_num: number of the hla (hla_to_num)
+        :return: float64 numpy array (letters,)
+        """
+        row_number = self.index[position, hla_num]
+        if row_number < 0:
+            raise Exception(
+                "Error: the likelihoods of the hla number %s at position %s are not stored\n"
+                % (hla_num, position)
+            )
+        row = self.rows[row_number].astype(np.float64)
+        if self.scale is not None:
+            row *= self.scale
+        return row
+
+    def to_matrix(self):
+        # Rebuilds the likelihood matrix (positions, hlas, letters), the rows that are not stored are 0
+        matrix = self.rows[self.index].astype(np.float64)
+        if self.scale is not None:
+            matrix *= self.scale
+        matrix[self.index < 0] = 0
+        return matrix
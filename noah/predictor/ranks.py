@@ -0,0 +1,72 @@
+import numpy as np
+from constants.constants import (
+    AMINOACID_FREQUENCIES,
+    RANK_LEVELS,
+    RANK_REFERENCE_SIZE,
+    VALID_AMINOACIDS,
+)
+from utilities import peptide_keys, utilities
+
+
+def rank_levels():
+    # Percentiles of the quantiles stored for each hla
+    return np.linspace(0.0, 100.0, RANK_LEVELS)
+
+
+def reference_codes(
+    length, size=RANK_REFERENCE_SIZE, valid_letters=VALID_AMINOACIDS, seed=0
+):
+    """
+    Samples random peptides with the natural frequencies of the amino acids
+    :param length: length of the peptides
+    :param size: number of peptides
+    :param valid_letters: list of valid amino acids
+    :param seed: seed of the random generator
+    :return: uint8 array (size, length) with the index of each letter in valid_letters
+    """
+    frequencies = np.array(
+        [AMINOACID_FREQUENCIES.get(letter, 0.0) for letter in valid_letters]
+    )
+    generator = np.random.default_rng(seed)
+    codes = generator.choice(
+        len(valid_letters), size=(size, length), p=frequencies / np.sum(frequencies)
+    )
+    return codes.astype(np.uint8)
+
+
+def reference_codes_from_file(file_path, length, valid_letters=VALID_AMINOACIDS):
+    """
+    Loads the reference peptides of a file (first column), keeping the ones of the given length
+    without invalid letters
+    :param file_path: file with the peptides
+    :param length: length of the peptides
+    :param valid_letters: list of valid amino acids
+    :return: uint8 array (peptides, length) with the index of each letter in valid_letters
+    """
+    peptides = [
+        peptide
+        for peptide in utilities.load_peptides(file_path)
+        if len(peptide) == length
+    ]
+    codes = peptide_keys.letter_codes(peptides, length, valid_letters)
+    return codes[np.all(codes < len(valid_letters), axis=1)]
+
+
+def quantile_tables(scores):
+    """
+    Computes the quantiles of the scores of each hla
+    :param scores: numpy array (peptides, hlas)
+    :return: float32 array (hlas, RANK_LEVELS)
+    """
+    return np.quantile(scores, rank_levels() / 100.0, axis=0).T.astype(np.float32)
+
+
+def percentile_rank(table, scores):
+    """
+    Percentage of the reference peptides with a score lower or equal than the given scores
+    (lower ranks are better binders), found with a binary search on the quantiles of the hla
+    :param table: quantiles of an hla
+    :param scores: score or numpy array of scores
+    :return: rank or numpy array of ranks
+    """
+    return np.round(np.interp(scores, table, rank_levels()), 3)
@@ -0,0 +1,102 @@
+import numpy as np
+from utilities import diagnostics
+
+
+def variant_windows(variants, proteins, lengths):
+    """
+    Creates the wild type windows of each length that overlap each missense variant
+    :param variants: list of tuples (protein, position, ref, alt), the position is 1-based
+    :param proteins: dict {protein: sequence}
+    :param lengths: list of window lengths
+    :return: list of tuples (variant, start, wild type peptide, mutant peptide, offset of the mutation)
+    """
+    windows = []
+    for variant in variants:
+        protein, position, ref, alt = variant
+        sequence = proteins.get(protein)
+        if sequence is None:
+            diagnostics.record(
+                diagnostics.SKIPPED_VARIANT,
+                None,
+                "protein %s not found, skipping" % protein,
+            )
+            continue
+        index = position - 1
+        if index < 0 or index >= len(sequence) or sequence[index] != ref:
+            diagnostics.record(
+                diagnostics.SKIPPED_VARIANT,
+                None,
+                "position %s of protein %s is not %s, skipping"
+                % (position, protein, ref),
+            )
+            continue
+        if len(alt) != 1 or alt == ref:
+            diagnostics.record(
+                diagnostics.SKIPPED_VARIANT,
+                None,
+                "%s %s%s%s is not a missense variant, skipping"
+                % (protein, ref, position, alt),
+            )
+            continue
+        for length in lengths:
+            for start in range(
+                max(0, index - length + 1), min(index, len(sequence) - length) + 1
+            ):
+                peptide = sequence[start : start + length]
+                offset = index - start
+                mutant = peptide[:offset] + alt + peptide[offset + 1 :]
+                windows.append((variant, start, peptide, mutant, offset))
+    return windows
+
+
+def score_variants(scorer, variants, proteins, genotype, lengths, rank=False):
+    """
+    Scores the wild type and the mutant windows of missense variants for all the hlas of a genotype.
+    The wild type windows are scored once and the mutant scores are derived from them (see Scorer.score_mutations),
+    each window with the model of its length.
+    :param scorer: Scorer or ScorerBundle
+    :param variants: list of tuples (protein, position, ref, alt), the position is 1-based
+    :param proteins: dict {protein: sequence}
+    :param genotype: list of hlas
+    :param lengths: list of window lengths
+    :param rank: Boolean, also compute the percentile ranks of the scores
+    :return: dict with the windows ("windows", see variant_windows), the hlas ("hlas") and the wild type
+    and mutant scores ("wt_scores", "mut_scores", numpy arrays (windows, hlas)). With rank, also "wt_ranks"
+    and "mut_ranks"
+    """
+    windows = variant_windows(variants, proteins, lengths)
+    groups = {}  # {window length: [window indexes]}
+    for n, window in enumerate(windows):
+        groups.setdefault(len(window[2]), []).append(n)
+    group_results = {}
+    hlas = []
+    for length, indexes in groups.items():
+        model = scorer.get_model(length)
+        group_hlas, wt_scores, mut_scores = model.score_mutations(
+            [windows[n][2] for n in indexes],
+            [windows[n][4] for n in indexes],
+            [windows[n][0][3] for n in indexes],
+            genotype,
+        )
+        group_results[length] = (model, group_hlas, wt_scores, mut_scores)
+        hlas += [hla for hla in group_hlas if hla not in hlas]
+    result = {"windows": windows, "hlas": hlas}
+    names = ["wt_scores", "mut_scores"]
+    if rank:
+        names += ["wt_ranks", "mut_ranks"]
+    for name in names:
+        result[name] = np.full((len(windows), len(hlas)), np.inf)
+    for length, indexes in groups.items():
+        model, group_hlas, wt_scores, mut_scores = group_results[length]
+        for column, hla in enumerate(group_hlas):
+            n = hlas.index(hla)
+            result["wt_scores"][indexes, n] = wt_scores[:, column]
+            result["mut_scores"][indexes, n] = mut_scores[:, column]
+            if rank:
+                result["wt_ranks"][indexes, n] = model.percentile_rank(
+                    hla, wt_scores[:, column]
+                )
+                result["mut_ranks"][indexes, n] = model.percentile_rank(
+                    hla, mut_scores[:, column]
+                )
+    return result
@@ -1,12 +1,87 @@
+import argparse
+import multiprocessing as mp
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from test import tests
 
-import predictor.Scorer as scorer
 from constants.constants import GRANTHAMS, HLA_ALIGMENT_FILE, IEDB_DATA_FILE, TEST_DATA
 from hlaizer.parser import Parser
-from utilities import utilities
+from utilities import bootstrap, evaluation, utilities
 
 
-def main(runIEDB, rundeNovo, runIndividual, processors, similarity_tuple, output):
+def _save_model_results(
+    model,
+    results,
+    data_qual,
+    hla_predicted,
+    bootstrap_replicates,
+    pool,
+    out,
+    threshold_out,
+):
+    """
+    Computes the MCCs of one model and writes them to the output files
+    :param model: name of the model
+    :param results: dict {hla: {peptide: score}}
+    :param data_qual: dict {hla: {peptide: qualitative_value}}
+    :param hla_predicted: hlas of the columns of the output
+    :param bootstrap_replicates: number of bootstrap replicates (0 to skip them)
+    :param pool: multiprocessing pool used to compute the bootstrap
+    :param out: file with one row of MCCs for each model
+    :param threshold_out: file with the thresholds report of each hla
+    :return: set of hlas without predictions
+    """
+    hla_with_errors = set()
+    # One sort per hla gives the MCC at every threshold
+    evaluation_dict = evaluation.evaluate_predictions(results, data_qual)
+    bootstrap_dict = {}
+    if bootstrap_replicates:
+        bootstrap_dict = bootstrap.bootstrap_predictions(
+            results, data_qual, -1, bootstrap_replicates, seed=0, pool=pool
+        )
+    MCC_dict = {}
+    for hla in hla_predicted:
+        if hla in evaluation_dict:
+            MCC_dict[hla] = evaluation.mcc_at_threshold(evaluation_dict[hla], -1)
+        else:
+            print("Model %s does not have data for HLA %s" % (model, hla))
+            hla_with_errors.add(hla)
+            MCC_dict[hla] = 0
+    MCC_string = ";".join([str(round(MCC_dict[hla], 3)) for hla in hla_predicted])
+    out.write("%s;%s\n" % (model, MCC_string))
+
+    for hla in hla_predicted:
+        if hla not in evaluation_dict:
+            continue
+        result = evaluation_dict[hla]
+        MCC, low, high = bootstrap_dict.get(hla, (MCC_dict[hla], None, None))
+        threshold_out.write(
+            "%s;%s;%s;%s;%s;%s;%s;%s;%s\n"
+            % (
+                model,
+                hla,
+                round(MCC_dict[hla], 3),
+                low if low is None else round(low, 3),
+                high if high is None else round(high, 3),
+                result["best_threshold"],
+                round(result["best_MCC"], 3),
+                round(result["ROC_AUC"], 3),
+                round(result["PR_AUC"], 3),
+            )
+        )
+    return hla_with_errors
+
+
+def main(
+    runIEDB,
+    rundeNovo,
+    runIndividual,
+    processors,
+    similarity_tuple,
+    output,
+    fast_deNovo=False,
+    bootstrap_replicates=1000,
+):
     """
     Script that creates and runs models to test their performance.
     :param runIEDB: test models using the IEDB data
@@ -15,6 +90,12 @@ def main(runIEDB, rundeNovo, runIndividual, processors, similarity_tuple, output
     :param processors: number of processors to run
     :param similarity_tuple: similarity tuple to use
     :param output: file to save the results
+    :param fast_deNovo: derive the deNovo models from one model trained with all the HLAs
+    instead of training new models for each HLA (see tests.fast_deNovo_prediction_test)
+    :param bootstrap_replicates: number of bootstrap replicates used to compute the 95% confidence
+    intervals of the MCCs (0 to skip them)
+    The selected tests run at the same time sharing one pool of workers, and the results of each
+    test are saved as soon as it and the tests before it finish, so the rows keep the order of the tests.
     :return:
     """
 
@@ -26,97 +107,117 @@ def main(runIEDB, rundeNovo, runIndividual, processors, similarity_tuple, output
         length=9,
     )
     similarity_matrix = parser.load_csv_matrix(similarity_tuple[0], similarity_tuple[1])
+    parser.set_processors(processors)
     parser.set_minimum_data_background(10)
     parser.set_minimum_data_signal(50)
     data, test_data, hla_list, hla_aligment, key_positions, sim_weight = (
         parser.parse_all()
     )
     data_to_score, data_qual = utilities.load_data(TEST_DATA)
-    predictions = []
 
+    scenarios = []
     if runIEDB:
-        pred_fused, pred_unique = tests.IEDB_prediction_test(
-            data,
-            test_data,
-            hla_list,
-            hla_aligment,
-            key_positions,
-            sim_weight,
-            data_to_score,
-            processors,
-            HLA_ALIGMENT_FILE,
-            similarity_matrix,
-        )
-        predictions.append(("IEDB Fused Background", pred_fused))
-        predictions.append(("IEDB Unique Background", pred_unique))
-
+        scenarios.append(("IEDB", tests.IEDB_prediction_test))
     if rundeNovo:
-        pred_fused, pred_unique = tests.deNovo_prediction_test(
-            data,
-            test_data,
-            hla_list,
-            hla_aligment,
-            key_positions,
-            sim_weight,
-            data_to_score,
-            processors,
-            HLA_ALIGMENT_FILE,
-            similarity_matrix,
-        )
-        predictions.append(("deNovo Fused Background", pred_fused))
-        predictions.append(("deNovo Unique Background", pred_unique))
-
+        if fast_deNovo:
+            scenarios.append(("deNovo", tests.fast_deNovo_prediction_test))
+        else:
+            scenarios.append(("deNovo", tests.deNovo_prediction_test))
     if runIndividual:
-        pred_fused, pred_unique = tests.Individual_prediction_test(
-            data,
-            test_data,
-            hla_list,
-            hla_aligment,
-            key_positions,
-            sim_weight,
-            data_to_score,
-            processors,
-            HLA_ALIGMENT_FILE,
-            similarity_matrix,
-        )
-        predictions.append(("Individual Fused Background", pred_fused))
-        predictions.append(("Individual Unique Background", pred_unique))
+        scenarios.append(("Individual", tests.Individual_prediction_test))
+    if not scenarios:
+        print("No test selected")
+        return
 
-    MCC_dict = {}
-    hla_predicted = [hla for hla in sorted(predictions[0][1])]
+    # The columns are the hlas predicted by the first scenario, known when it finishes
+    hla_predicted = None
     set_hla_with_errors = set()
-    print("Computing MCCs")
-    for prediction in predictions:
-        model = prediction[0]
-        results = prediction[1]
-        for hla in hla_predicted:
-            try:
-                TP, FP, TN, FN, count = scorer.confusion_matrix_from_predictet_data(
-                    results[hla], data_qual[hla], -1
+    threshold_output = "%s_thresholds.csv" % os.path.splitext(output)[0]
+    # All the scenarios share one pool of workers, the threads only wait for their results
+    pool = mp.Pool(int(processors))
+    with open(output, "w") as out, open(threshold_output, "w") as threshold_out:
+        # Best threshold of each hla, areas under the ROC and precision-recall curves
+        # and 95% confidence interval of the MCC
+        threshold_out.write(
+            "MODEL;HLA;MCC;MCC_LOW;MCC_HIGH;BEST_THRESHOLD;BEST_MCC;ROC_AUC;PR_AUC\n"
+        )
+        with ThreadPoolExecutor(len(scenarios)) as executor:
+            workers = {}
+            for n, (name, scenario) in enumerate(scenarios):
+                worker = executor.submit(
+                    scenario,
+                    data,
+                    test_data,
+                    hla_list,
+                    hla_aligment,
+                    key_positions,
+                    sim_weight,
+                    data_to_score,
+                    processors,
+                    HLA_ALIGMENT_FILE,
+                    similarity_matrix,
+                    pool,
                 )
-                MCC = scorer.score_MCC(TP, FP, TN, FN)
-                MCC_dict.setdefault(model, {}).setdefault(hla, MCC)
-            except KeyError:
-                print("Model %s does not have data for HLA %s" % (model, hla))
-                set_hla_with_errors.add(hla)
-                MCC_dict.setdefault(model, {}).setdefault(hla, 0)
+                workers[worker] = n
+            # Results of the finished scenarios waiting for the ones before them
+            finished = {}
+            saved = 0
+            for worker in as_completed(workers):
+                finished[workers[worker]] = worker.result()
+                while saved in finished:
+                    name = scenarios[saved][0]
+                    pred_fused, pred_unique = finished.pop(saved)
+                    saved += 1
+                    if hla_predicted is None:
+                        hla_predicted = sorted(pred_fused)
+                        out.write("MODEL;%s\n" % ";".join(hla_predicted))
+                    print("Computing MCCs of %s test" % name)
+                    for model, results in (
+                        ("%s Fused Background" % name, pred_fused),
+                        ("%s Unique Background" % name, pred_unique),
+                    ):
+                        set_hla_with_errors.update(
+                            _save_model_results(
+                                model,
+                                results,
+                                data_qual,
+                                hla_predicted,
+                                bootstrap_replicates,
+                                pool,
+                                out,
+                                threshold_out,
+                            )
+                        )
+                    out.flush()
+                    threshold_out.flush()
+    pool.terminate()
     if set_hla_with_errors:
         print("HLA without data:", set_hla_with_errors)
 
-    print("Saving results")
-    with open(output, "w") as inn:
-        hla_string = ";".join(hla_predicted)
-        inn.write("MODEL;%s\n" % hla_string)
-        for model in MCC_dict:
-            MCC_string = ";".join(
-                [str(round(MCC_dict[model][hla], 3)) for hla in hla_predicted]
-            )
-            inn.write("%s;%s\n" % (model, MCC_string))
-
     print("Test finished")
 
 
+def parse_args():
+    """
+    Parse command line arguments
+    :returns:
+    """
+    desc = """Script that creates and runs models to test their performance. The tests and their parameters
+    are set at the bottom of the script."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        "-fastDeNovo",
+        action="store_true",
+        help="Derive the deNovo models from one model trained with all the HLAs instead of training new models "
+        "for each HLA. Much faster, but the fusions of the other HLAs are not refined again, so the MCCs can "
+        "differ slightly from the standard deNovo test",
+    )
+    args = parser.parse_args()
+    return args.fastDeNovo
+
+
 if __name__ == "__main__":
+    fast_deNovo = parse_args()
     # Valid similarity_matrices = BLOSUM62, PAM250, GRANTHAMS, SNEATH
     main(
         runIEDB=True,
@@ -125,4 +226,5 @@ if __name__ == "__main__":
         processors=2,
         similarity_tuple=GRANTHAMS,
         output="csv_results_prova.csv",
+        fast_deNovo=fast_deNovo,
     )
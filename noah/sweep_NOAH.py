@@ -0,0 +1,330 @@
+import argparse
+import copy
+import itertools
+import multiprocessing as mp
+import os
+import sys
+
+import predictor.Scorer as scorer
+from constants.constants import DATA_PATH, SIMILARITY_DICT, TEST_DATA
+from hlaizer.parser import Parser
+from predictor.Model_builder import MotifMaker
+from utilities import utilities
+
+
+def parse_args():
+    """
+    Parse command line arguments
+    :returns:
+    """
+    desc = """Script that trains and tests models with all the combinations of the given parameters.
+    The data is parsed and counted only once and the combinations are run in parallel."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        "-o", required=True, help="Output file with the MCC of each combination.\n"
+    )
+    parser.add_argument(
+        "--length", default=9, type=int, help="Length of the peptides to use.\n"
+    )
+    parser.add_argument(
+        "--iedb",
+        default=os.path.join(DATA_PATH, "IEDB_data.csv"),
+        help="Path to the IEDB data file.\n",
+    )
+    parser.add_argument(
+        "--data",
+        default=None,
+        help="Path to an additional data file (peptide;hla;qualitative_Value).\n",
+    )
+    parser.add_argument(
+        "--alignment",
+        default=os.path.join(DATA_PATH, "HLA.pfam"),
+        help="Path to the file with the HLAs aligment (Selex format)\n",
+    )
+    parser.add_argument(
+        "--test",
+        default=TEST_DATA,
+        help="File with the peptides used to compute the MCC (peptide,hla,qualitative_Value).\n",
+    )
+    parser.add_argument(
+        "--processors", default=1, type=int, help="Number of processors to use.\n"
+    )
+    parser.add_argument(
+        "-b",
+        "--background",
+        default=["fused"],
+        nargs="+",
+        help="Background models to test (random, all, negative, unique, fused).\n",
+    )
+    parser.add_argument(
+        "--simMatrix",
+        default=["sneath"],
+        nargs="+",
+        help="Similarity matrices to test (blosum62, pam250, granthams, sneath).\n",
+    )
+    parser.add_argument(
+        "--threshold",
+        default=[None],
+        type=int,
+        nargs="+",
+        help="Minimum crystal evidence of the key positions to test. "
+        "Default uses the one in constants.THRESHOLD.\n",
+    )
+    parser.add_argument(
+        "--pseudocounts",
+        default=[1],
+        type=float,
+        nargs="+",
+        help="Pseudocounts to test.\n",
+    )
+    parser.add_argument(
+        "--signal",
+        default=[50],
+        type=int,
+        nargs="+",
+        help="Minimum number of binding peptides of the modeled HLAs to test.\n",
+    )
+    parser.add_argument(
+        "--noise",
+        default=[10],
+        type=int,
+        nargs="+",
+        help="Minimum number of non-binding peptides of the modeled HLAs to test.\n",
+    )
+    parser.add_argument(
+        "--noRefine",
+        action="store_true",
+        help="Do not refine the models (test the individual models only).\n",
+    )
+    args = parser.parse_args()
+    return (
+        args.o,
+        args.length,
+        args.iedb,
+        args.data,
+        args.alignment,
+        args.test,
+        args.processors,
+        args.background,
+        args.simMatrix,
+        args.threshold,
+        args.pseudocounts,
+        args.signal,
+        args.noise,
+        not args.noRefine,
+    )
+
+
+_sweep = (
+    {}
+)  # data shared by the combinations, received once by each worker (see _init_worker)
+
+
+def _init_worker(shared):
+    # Keeps the counted models, the similarity caches and the data to score in the worker
+    _sweep.update(shared)
+
+
+def _configured_motif(configuration):
+    # Derives the model of one combination of parameters from the counted models of the worker
+    background, matrix_name, threshold, pseudocount, signal, noise = configuration
+    motif = _sweep["motifs"][(_sweep["count_types"][background], threshold)]
+    motif = motif.with_hlas(_sweep["hla_lists"][(signal, noise)])
+    motif.set_random_model_type(background)
+    motif.set_pseudocounts(pseudocount)
+    motif.set_similarity_matrix(_sweep["similarity_matrices"][matrix_name])
+    motif.set_similarity_cache(_sweep["similarity_caches"][matrix_name])
+    return motif
+
+
+def _run_configuration(configuration):
+    """
+    Builds and tests the model of one combination of parameters (run inside the pool workers)
+    :param configuration: tuple (background, matrix, threshold, pseudocounts, signal, noise)
+    :return: configuration and dict {hla: MCC}
+    """
+    motif = _configured_motif(configuration)
+    if _sweep["refine"]:
+        model = motif.refine_model(1)
+    else:
+        model = motif.build()
+    signal, noise = configuration[4:]
+    results = model.score_pairs(_sweep["data_to_score"][(signal, noise)])
+    MCC_dict = {}
+    for hla in sorted(results):
+        TP, FP, TN, FN, count = scorer.confusion_matrix_from_predictet_data(
+            results[hla], _sweep["data_qual"][hla], -1
+        )
+        MCC_dict[hla] = scorer.score_MCC(TP, FP, TN, FN)
+    return configuration, MCC_dict
+
+
+def main(
+    output,
+    motif_length,
+    iedb_data,
+    data,
+    aligment_file,
+    test_file,
+    processors,
+    backgrounds,
+    similarity_matrices,
+    thresholds,
+    pseudocounts,
+    signals,
+    noises,
+    refine=True,
+):
+    """
+    Trains and tests models with all the combinations of the given parameters.
+    The data is parsed and counted once, the environments similarities are computed once for
+    each similarity matrix and threshold and the combinations are run in parallel.
+    :return:
+    """
+    parser = Parser(
+        IEDB_file=iedb_data,
+        csv_file=data,
+        aligment_file=aligment_file,
+        length=motif_length,
+    )
+    parser.set_processors(processors)
+    # Parse all the HLAs with data, the minimum data requirements are applied for each combination
+    parser.set_minimum_data_signal(min(signals))
+    parser.set_minimum_data_background(min(noises))
+    data, test_data, hla_list, hla_aligment, key_positions, sim_weight = (
+        parser.parse_all()
+    )
+    data_to_score, data_qual = utilities.load_data(test_file)
+
+    # The counts only depend on which data is used as background
+    print("Counting data")
+    count_types = {
+        background: "all" if background == "all" else "negative"
+        for background in backgrounds
+    }
+    base_motifs = {}
+    for count_type in set(count_types.values()):
+        motif = MotifMaker(
+            data=data,
+            test_data=test_data,
+            hla_list=hla_list,
+            motif_length=motif_length,
+            key_positions=key_positions,
+            sim_weight=sim_weight,
+            hla_aligment=hla_aligment,
+        )
+        motif.set_random_model_type(count_type)
+        motif.initialize()
+        base_motifs[count_type] = motif
+
+    # The environments and their similarities only depend on the key positions and the matrix
+    print("Computing environment similarities")
+    threshold_motifs = {}
+    for threshold in thresholds:
+        threshold_key_positions, threshold_sim_weight = parser.parse_key_position_file(
+            threshold=threshold
+        )
+        for count_type, base_motif in base_motifs.items():
+            motif = copy.copy(base_motif)
+            motif.set_key_positions(threshold_key_positions, threshold_sim_weight)
+            threshold_motifs[(count_type, threshold)] = motif
+    similarity_caches = {}
+    similarity_matrices_dict = {}
+    for matrix_name in similarity_matrices:
+        similarity_tuple = SIMILARITY_DICT[matrix_name]
+        similarity_matrices_dict[matrix_name] = parser.load_csv_matrix(
+            similarity_tuple[0], similarity_tuple[1]
+        )
+        similarity_caches[matrix_name] = {}
+        for threshold in thresholds:
+            motif = copy.copy(
+                threshold_motifs[(count_types[backgrounds[0]], threshold)]
+            )
+            motif.set_similarity_matrix(similarity_matrices_dict[matrix_name])
+            motif.set_similarity_cache(similarity_caches[matrix_name])
+            motif.compare_all_envs()
+
+    hla_lists = {}
+    hla_data_to_score = {}
+    for signal, noise in itertools.product(signals, noises):
+        hla_lists[(signal, noise)] = parser.select_hlas(data, signal, noise)
+        hla_set = set(hla_lists[(signal, noise)])
+        hla_data_to_score[(signal, noise)] = [
+            element for element in data_to_score if element[1] in hla_set
+        ]
+
+    configurations = itertools.product(
+        backgrounds,
+        similarity_matrices,
+        thresholds,
+        pseudocounts,
+        signals,
+        noises,
+    )
+    # The models, the similarity caches and the data are sent once to each worker, the tasks only
+    # send the parameters of their combination
+    shared = {
+        "motifs": threshold_motifs,
+        "count_types": count_types,
+        "hla_lists": hla_lists,
+        "similarity_matrices": similarity_matrices_dict,
+        "similarity_caches": similarity_caches,
+        "data_to_score": hla_data_to_score,
+        "data_qual": data_qual,
+        "refine": refine,
+    }
+
+    print("Running combinations")
+    with mp.Pool(processors, _init_worker, (shared,)) as pool:
+        with open(output, "w") as out:
+            out.write("BACKGROUND;MATRIX;THRESHOLD;PSEUDOCOUNTS;SIGNAL;NOISE;HLA;MCC\n")
+            for configuration, MCC_dict in pool.imap_unordered(
+                _run_configuration, configurations
+            ):
+                configuration_string = ";".join([str(x) for x in configuration])
+                for hla, MCC in MCC_dict.items():
+                    out.write("%s;%s;%s\n" % (configuration_string, hla, round(MCC, 3)))
+                out.flush()
+    print("Sweep finished")
+    return 0
+
+
+if __name__ == "__main__":
+    (
+        output,
+        motif_length,
+        iedb_data,
+        data,
+        aligment_file,
+        test_file,
+        processors,
+        backgrounds,
+        similarity_matrices,
+        thresholds,
+        pseudocounts,
+        signals,
+        noises,
+        refine,
+    ) = parse_args()
+    for matrix_name in similarity_matrices:
+        if matrix_name not in SIMILARITY_DICT:
+            sys.stderr.write("Error: Invalid similarity matrix %s\n" % matrix_name)
+            sys.stderr.write("Valid similarity matrices are:\n")
+            sys.stderr.write("%s\n" % " | ".join(SIMILARITY_DICT.keys()))
+            exit(1)
+    main(
+        output,
+        motif_length,
+        iedb_data,
+        data,
+        aligment_file,
+        test_file,
+        processors,
+        backgrounds,
+        similarity_matrices,
+        thresholds,
+        pseudocounts,
+        signals,
+        noises,
+        refine,
+    )
@@ -1,4 +1,5 @@
 import copy
+import multiprocessing as mp
 
 from hlaizer.parser import Parser
 from predictor.Model_builder import MotifMaker
@@ -16,6 +17,7 @@ def IEDB_prediction_test(
     processors,
     hla_seq,
     similarity_matrix,
+    pool=None,
 ):
     """
     Test performance of the model
@@ -29,6 +31,7 @@ def IEDB_prediction_test(
     :param processors: processors to use
     :param hla_seq: file with the sequences of the HLAs
     :param similarity_matrix: similarity matrix to use to compare binding environments
+    :param pool: multiprocessing pool to use instead of creating new ones (it is not terminated)
     :return: predictions
     """
     parser = Parser()
@@ -46,7 +49,7 @@ def IEDB_prediction_test(
     motif.set_random_model_type("fused")
     motif.initialize()
     motif.build()
-    model_fused = motif.refine_model(int(processors))
+    model_fused = motif.refine_model(int(processors), pool=pool)
     print("Making Model with Fused background")
     motif.set_random_model_type("unique")
     model_unique = motif.build()
@@ -55,10 +58,10 @@ def IEDB_prediction_test(
     model_fused.load_sequences(hla_align)
     model_unique.load_sequences(hla_align)
     prediction_negative = utilities.score_peptides_paralleled(
-        processors, data_to_score, model_fused
+        processors, data_to_score, model_fused, pool
     )
     prediction_unique = utilities.score_peptides_paralleled(
-        processors, data_to_score, model_unique
+        processors, data_to_score, model_unique, pool
     )
     return prediction_negative, prediction_unique
 
@@ -74,6 +77,7 @@ def deNovo_prediction_test(
     processors,
     hla_seq,
     similarity_matrix,
+    pool=None,
 ):
     """
     Test deNovo performance of the model
@@ -87,6 +91,7 @@ def deNovo_prediction_test(
     :param processors: processors to use
     :param hla_seq: file with the sequences of the HLAs
     :param similarity_matrix: similarity matrix to use to compare binding environments
+    :param pool: multiprocessing pool to use instead of creating new ones (it is not terminated)
     :return: predictions
     """
     deNovo_fused = {}
@@ -102,11 +107,9 @@ def deNovo_prediction_test(
             print("HLA  %s not present in the scoring list, skipping allele" % hla)
             continue
         print("Making deNovo Motif for HLA: %s" % hla)
-        tmp_data = copy.deepcopy(data)
+        tmp_data = data.without_hlas([hla])
         tmp_test_data = copy.deepcopy(test_data)
         tmp_hla_list = copy.deepcopy(hla_list)
-        for qualvalue in tmp_data:
-            tmp_data[qualvalue].pop(hla, None)
         tmp_test_data[hla].pop(hla, None)
         tmp_hla_list.remove(hla)
         motif = MotifMaker(
@@ -122,7 +125,7 @@ def deNovo_prediction_test(
         motif.set_random_model_type("fused")
         motif.initialize()
         motif.build()
-        model_fused = motif.refine_model(int(processors))
+        model_fused = motif.refine_model(int(processors), pool=pool)
         motif = MotifMaker(
             data=tmp_data,
             test_data=tmp_test_data,
@@ -136,17 +139,17 @@ def deNovo_prediction_test(
         motif.set_random_model_type("unique")
         motif.initialize()
         motif.build()
-        model_unique = motif.refine_model(int(processors))
+        model_unique = motif.refine_model(int(processors), pool=pool)
         print("Making deNovo prediction for HLA: %s" % hla)
         parser = Parser()
         hla_align = parser.parse_aligment_file(hla_seq)
         model_fused.load_sequences(hla_align)
         model_unique.load_sequences(hla_align)
         prediction_fused = utilities.score_peptides_paralleled(
-            processors, data_to_score_formated[hla], model_fused
+            processors, data_to_score_formated[hla], model_fused, pool
         )
         prediction_unique = utilities.score_peptides_paralleled(
-            processors, data_to_score_formated[hla], model_unique
+            processors, data_to_score_formated[hla], model_unique, pool
         )
         deNovo_fused.setdefault(hla, prediction_fused[hla])
         deNovo_unique.setdefault(hla, prediction_unique[hla])
@@ -154,6 +157,118 @@ def deNovo_prediction_test(
     return deNovo_fused, deNovo_unique
 
 
+def fast_deNovo_prediction_test(
+    data,
+    test_data,
+    hla_list,
+    hla_aligment,
+    key_positions,
+    sim_weight,
+    data_to_score,
+    processors,
+    hla_seq,
+    similarity_matrix,
+    pool=None,
+):
+    """
+    Faster version of deNovo_prediction_test. The counts and the fusions are computed only once using all the HLAs,
+    and the model of each left out HLA is derived by removing its counts and its fusions (the fusions of the other
+    HLAs are not refined again). The left out HLAs are predicted in parallel.
+    :param data: data to use to build the model
+    :param test_data: test data to use to build the model
+    :param hla_list: list of hlas for which the model will be build
+    :param hla_aligment: hla aligment
+    :param key_positions: dict with the sequences positions that define the binding environment
+    :param sim_weight: weight that each position of the binding environment has
+    :param data_to_score: data to score to test performance
+    :param processors: processors to use
+    :param hla_seq: file with the sequences of the HLAs
+    :param similarity_matrix: similarity matrix to use to compare binding environments
+    :param pool: multiprocessing pool to use instead of creating new ones (it is not terminated)
+    :return: predictions
+    """
+    deNovo_predictions = {"fused": {}, "unique": {}}
+    data_to_score_formated = {}
+    for element in data_to_score:
+        hla = element[1]
+        data_to_score_formated.setdefault(hla, []).append(element)
+    parser = Parser()
+    hla_align = parser.parse_aligment_file(hla_seq)
+    own_pool = pool is None
+    if own_pool:
+        pool = mp.Pool(int(processors))
+    similarity_cache = {}
+    motifs = {}
+    for background in deNovo_predictions:
+        print("Making Motif with %s background" % background)
+        motif = MotifMaker(
+            data=data,
+            test_data=test_data,
+            hla_list=hla_list,
+            motif_length=9,
+            key_positions=key_positions,
+            sim_weight=sim_weight,
+            hla_aligment=hla_aligment,
+        )
+        motif.set_similarity_matrix(similarity_matrix)
+        motif.set_similarity_cache(similarity_cache)
+        motif.set_random_model_type(background)
+        motif.initialize()
+        motif.build()
+        motif.refine_model(int(processors), pool=pool)
+        motifs[background] = motif
+    print("Making deNovo predictions")
+    left_out = []
+    for hla in hla_list:
+        if hla not in data_to_score_formated:
+            print("HLA  %s not present in the scoring list, skipping allele" % hla)
+            continue
+        left_out.append(hla)
+    # Each task predicts a group of hlas, so each model (with its similarity cache) is sent once per group
+    # instead of once per hla
+    groups = [left_out[i :: int(processors)] for i in range(int(processors))]
+    workers = []
+    for background, motif in motifs.items():
+        for group in groups:
+            if not group:
+                continue
+            worker = pool.apply_async(
+                _left_out_predictions,
+                (
+                    motif,
+                    group,
+                    hla_align,
+                    {hla: data_to_score_formated[hla] for hla in group},
+                ),
+            )
+            workers.append((background, worker))
+    for background, worker in workers:
+        for hla, prediction in worker.get().items():
+            deNovo_predictions[background].setdefault(hla, prediction)
+    # The hlas are added in the order of hla_list, as the other tests do
+    for background in deNovo_predictions:
+        deNovo_predictions[background] = {
+            hla: deNovo_predictions[background][hla]
+            for hla in left_out
+            if hla in deNovo_predictions[background]
+        }
+    if own_pool:
+        pool.terminate()
+    return deNovo_predictions["fused"], deNovo_predictions["unique"]
+
+
+def _left_out_predictions(motif, hlas, hla_align, data_to_score):
+    # Predicts the data of each hla with a model derived from motif without that hla
+    predictions = {}
+    for hla in hlas:
+        model = motif.without_hla(hla).build()
+        model.set_similarity_matrix(motif.similarity_matrix)
+        model.set_similarity_cache(motif.similarity_cache)
+        model.load_sequences(hla_align)
+        predictions[hla] = utilities.process_peptides(model, data_to_score[hla])[hla]
+    return predictions
+
+
 def Individual_prediction_test(
     data,
     test_data,
@@ -165,6 +280,7 @@ def Individual_prediction_test(
     processors,
     hla_seq,
     similarity_matrix,
+    pool=None,
 ):
     """
     Test performance of the model without merging environments
@@ -178,6 +294,7 @@ def Individual_prediction_test(
     :param processors: processors to use
     :param hla_seq: file with the sequences of the HLAs
     :param similarity_matrix: similarity matrix to use to compare binding environments
+    :param pool: multiprocessing pool to use instead of creating new ones (it is not terminated)
     :return: predictions
     """
     print("Making Individual Model with Fused background")
@@ -214,9 +331,9 @@ def Individual_prediction_test(
     model_fused.load_sequences(hla_align)
     model_unique.load_sequences(hla_align)
     prediction_fused = utilities.score_peptides_paralleled(
-        processors, data_to_score, model_fused
+        processors, data_to_score, model_fused, pool
     )
     prediction_unique = utilities.score_peptides_paralleled(
-        processors, data_to_score, model_unique
+        processors, data_to_score, model_unique, pool
     )
     return prediction_fused, prediction_unique
@@ -1,10 +1,15 @@
 import argparse
+import multiprocessing as mp
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from constants.constants import DATA_PATH, SIMILARITY_DICT
+from constants.constants import DATA_PATH, RANK_REFERENCE_SIZE, SIMILARITY_DICT
 from hlaizer.parser import Parser
 from predictor.Model_builder import *
+from predictor.compact import PRECISIONS
+from predictor.Scorer import ScorerBundle
+from utilities import diagnostics, utilities
 
 
 def parse_args():
@@ -18,7 +23,12 @@ def parse_args():
         "-o", required=True, help="Name for the output model (without file extension)"
     )
     parser.add_argument(
-        "--length", required=True, type=int, help="Length of the peptides to use.\n"
+        "--length",
+        required=True,
+        type=int,
+        nargs="+",
+        help="Length of the peptides to use. If more than one length is given the data is parsed "
+        "once and the models of all the lengths are built at the same time into one bundle.\n",
     )
     parser.add_argument(
         "--iedb",
@@ -66,6 +76,72 @@ def parse_args():
         type=str,
         help="Similarity matrix to use. Options are: [blosum62, pam250, granthams, sneath]",
     )
+    parser.add_argument(
+        "--maxSimilarityDrop",
+        default=None,
+        type=float,
+        help="Stop trying fusion candidates for a position once their similarity is this much lower "
+        "than the similarity of the HLA with itself. Default tries all of them.\n",
+    )
+    parser.add_argument(
+        "--maxCandidates",
+        default=None,
+        type=int,
+        help="Maximum number of fusion candidates to build for each HLA and position. "
+        "Default tries all of them.\n",
+    )
+    parser.add_argument(
+        "--skipDuplicateEnvs",
+        action="store_true",
+        help="Skip fusion candidates whose environment at that position is identical to the one of "
+        "an already evaluated candidate.\n",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Directory where the parsed data and the fusions of each refined HLA are saved "
+        "as soon as they are computed.\n",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted training from the --checkpoint directory, skipping the "
+        "parsing and the HLAs that were already refined.\n",
+    )
+    parser.add_argument(
+        "--queue",
+        default=None,
+        help="Directory shared by several hosts where the refinement tasks (one per HLA) are written, so "
+        "workers started on any host with worker_NOAH.py help to refine the model. With --resume the HLAs "
+        "already refined through the queue are kept.\n",
+    )
+    parser.add_argument(
+        "--update",
+        default=None,
+        help="Path to a trained model to update with the data of --data instead of training "
+        "a new model. Only the HLAs whose data changed are refined again.\n",
+    )
+    parser.add_argument(
+        "--rankSize",
+        default=None,
+        type=int,
+        help="Store percentile rank tables in the model, computed from this number of random peptides "
+        "with the natural frequencies of the amino acids (%s is a good value).\n"
+        % RANK_REFERENCE_SIZE,
+    )
+    parser.add_argument(
+        "--rankReference",
+        default=None,
+        help="Store percentile rank tables in the model, computed from the peptides of this file "
+        "(first column, for example peptides from the human proteome) instead of random ones.\n",
+    )
+    parser.add_argument(
+        "--compact",
+        default=None,
+        choices=PRECISIONS,
+        help="Store the likelihoods of the model deduplicated and with reduced precision (float32, or int16 "
+        "with a scale), which makes the model smaller. Updated models keep the precision of the original one.\n",
+    )
     args = parser.parse_args()
     return (
         args.o,
@@ -78,6 +154,16 @@ def parse_args():
         args.signal,
         args.noise,
         args.simMatrix,
+        args.maxSimilarityDrop,
+        args.maxCandidates,
+        args.skipDuplicateEnvs,
+        args.checkpoint,
+        args.resume,
+        args.update,
+        args.rankSize,
+        args.rankReference,
+        args.compact,
+        args.queue,
     )
 
 
@@ -92,34 +178,212 @@ def main(
     signal,
     noise,
     similarity_tuple,
+    max_similarity_drop=None,
+    max_candidates=None,
+    skip_duplicate_envs=False,
+    checkpoint_dir=None,
+    resume=False,
+    rank_size=None,
+    rank_reference=None,
+    precision=None,
+    queue_dir=None,
 ):
+    lengths = motif_length if isinstance(motif_length, list) else [motif_length]
     parser = Parser(
         IEDB_file=iedb_data,
         csv_file=data,
         aligment_file=aligment_file,
-        length=motif_length,
+        length=lengths[0],
     )
+    # The key positions of every length are checked before the (long) parsing starts
+    for length in lengths:
+        if not os.path.isfile(parser.key_position_file(length)):
+            sys.stderr.write(
+                "Error: there are no key positions for peptides of length %s (%s not found)\n"
+                % (length, parser.key_position_file(length))
+            )
+            exit(1)
+    parser.set_processors(processors)
     parser.set_minimum_data_background(noise)
     parser.set_minimum_data_signal(signal)
     similarity_matrix = parser.load_csv_matrix(similarity_tuple[0], similarity_tuple[1])
-    data, test_data, hla_list, hla_aligment, key_positions, sim_weight = (
-        parser.parse_all()
-    )
-    motif = MotifMaker(
-        data=data,
-        test_data=test_data,
-        hla_list=hla_list,
-        motif_length=motif_length,
-        key_positions=key_positions,
-        sim_weight=sim_weight,
-        hla_aligment=hla_aligment,
-    )
-    motif.set_random_model_type(background_model)
-    motif.set_similarity_matrix(similarity_matrix)
-    motif.initialize()
-    motif.build()
-    model = motif.refine_model(int(processors))
+
+    # Everything that changes the parsed data or the accepted fusions
+    config = {
+        "length": lengths,
+        "iedb": iedb_data,
+        "data": data,
+        "alignment": aligment_file,
+        "background": background_model,
+        "signal": signal,
+        "noise": noise,
+        "similarity": similarity_tuple,
+        "search": (max_similarity_drop, max_candidates, skip_duplicate_envs),
+    }
+    dataset = None
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        dataset_file = os.path.join(checkpoint_dir, "dataset.pkl")
+        if resume:
+            dataset = utilities.load_checkpoint(dataset_file)
+            if dataset is None:
+                print(
+                    "No checkpoint found in %s, starting from scratch" % checkpoint_dir
+                )
+                resume = False
+            elif dataset["config"] != config:
+                sys.stderr.write(
+                    "Error: checkpoint %s was created with different arguments\n"
+                    % checkpoint_dir
+                )
+                exit(1)
+            else:
+                print("Loading parsed data from checkpoint %s" % dataset_file)
+    if dataset is None:
+        dataset = {"config": config, "parsed": parser.parse_all_lengths(lengths)}
+        if checkpoint_dir:
+            utilities.save_checkpoint(dataset, dataset_file)
+
+    # The models of all the lengths share the similarities and the pool of workers
+    similarity_cache = {}
+    motifs = {}
+    for length in lengths:
+        data, test_data, hla_list, hla_aligment, key_positions, sim_weight = dataset[
+            "parsed"
+        ][length]
+        motif = MotifMaker(
+            data=data,
+            test_data=test_data,
+            hla_list=hla_list,
+            motif_length=length,
+            key_positions=key_positions,
+            sim_weight=sim_weight,
+            hla_aligment=hla_aligment,
+        )
+        motif.set_random_model_type(background_model)
+        motif.set_similarity_matrix(similarity_matrix)
+        motif.set_similarity_cache(similarity_cache)
+        motif.set_refinement_search(
+            max_similarity_drop, max_candidates, skip_duplicate_envs
+        )
+        if rank_size or rank_reference:
+            motif.set_rank_reference(rank_size, rank_reference)
+        motif.initialize()
+        motif.build()
+        motifs[length] = motif
+
+    pool = mp.Pool(int(processors))
+    workers = {}
+    with ThreadPoolExecutor(len(lengths)) as executor:
+        for length in lengths:
+            length_checkpoint = checkpoint_dir
+            if checkpoint_dir and len(lengths) > 1:
+                length_checkpoint = os.path.join(checkpoint_dir, "length_%s" % length)
+            length_queue = queue_dir
+            if queue_dir and len(lengths) > 1:
+                length_queue = os.path.join(queue_dir, "length_%s" % length)
+            workers[length] = executor.submit(
+                motifs[length].refine_model,
+                int(processors),
+                length_checkpoint,
+                resume,
+                None,
+                pool,
+                length_queue,
+            )
+        models = {length: workers[length].result() for length in lengths}
+    pool.terminate()
+
+    if precision:
+        for model in models.values():
+            model.compact(precision)
+    if len(lengths) == 1:
+        models[lengths[0]].save_pickle("%s.pkl" % output)
+    else:
+        ScorerBundle(models).save_pickle("%s.pkl" % output)
+    utilities.save_checkpoint(
+        {length: motifs[length].update_state() for length in lengths},
+        update_state_file("%s.pkl" % output),
+    )
+    diagnostics.collector.print_summary()
+    return 0
+
+
+def update_state_file(model_file):
+    # File with the data needed to update a model, saved next to it (model_name.update.pkl)
+    if model_file.endswith(".pkl"):
+        model_file = model_file[: -len(".pkl")]
+    return "%s.update.pkl" % model_file
+
+
+def update(
+    output,
+    motif_length,
+    model_file,
+    processors,
+    delta_file,
+    max_similarity_drop=None,
+    max_candidates=None,
+    skip_duplicate_envs=False,
+    precision=None,
+    queue_dir=None,
+):
+    """
+    Updates a trained model with new data, without parsing and counting again the data used to train it
+    :param output: name for the output model (without file extension)
+    :param motif_length: length of the peptides of the model
+    :param model_file: path to the model to update
+    :param processors: number of processors to use
+    :param delta_file: file with the new data (peptide;hla;qualitative_value)
+    :param precision: compact precision of the updated model (default the one of the original model)
+    :param queue_dir: directory of the work queue shared with the workers of other hosts (None refines in this host)
+    :return:
+    """
+    model = utilities.load_model(model_file)
+    if getattr(model, "training_state", None) is None:
+        sys.stderr.write(
+            "Error: model %s does not store its training counts, "
+            "it has to be trained again from scratch\n" % model_file
+        )
+        exit(1)
+    if model.motif_length != motif_length:
+        sys.stderr.write(
+            "Error: model %s was trained with peptides of length %s\n"
+            % (model_file, model.motif_length)
+        )
+        exit(1)
+    update_state = utilities.load_checkpoint(update_state_file(model_file))
+    if update_state is None or motif_length not in update_state:
+        sys.stderr.write(
+            "Error: update state %s of model %s not found, "
+            "it has to be trained again from scratch\n"
+            % (update_state_file(model_file), model_file)
+        )
+        exit(1)
+    parser = Parser(length=motif_length)
+    print("Parsing new data")
+    delta = parser.parse_delta_data(delta_file)
+    motif = MotifMaker.from_model(model, update_state[motif_length])
+    motif.set_refinement_search(
+        max_similarity_drop, max_candidates, skip_duplicate_envs
+    )
+    changed_hlas = motif.add_data(delta)
+    print("HLAs with new data: %s" % len(changed_hlas))
+    rank_reference = model.rank_reference
+    if precision is None and model.compact_likelihoods is not None:
+        precision = model.compact_likelihoods.precision
+    model = motif.refine_model(int(processors), hlas=changed_hlas, queue_dir=queue_dir)
+    if rank_reference is not None:
+        # The updated model keeps the rank tables with the same reference peptides
+        model.set_rank_reference(rank_reference)
+        model.compute_rank_tables()
+    if precision:
+        model.compact(precision)
     model.save_pickle("%s.pkl" % output)
+    utilities.save_checkpoint(
+        {motif_length: motif.update_state()}, update_state_file("%s.pkl" % output)
+    )
+    diagnostics.collector.print_summary()
     return 0
 
 
@@ -135,6 +399,16 @@ if __name__ == "__main__":
         signal,
         noise,
         simMatrix,
+        max_similarity_drop,
+        max_candidates,
+        skip_duplicate_envs,
+        checkpoint_dir,
+        resume,
+        update_model,
+        rank_size,
+        rank_reference,
+        precision,
+        queue_dir,
     ) = parse_args()
     try:
         sim_tuple = SIMILARITY_DICT[simMatrix]
@@ -143,15 +417,44 @@ if __name__ == "__main__":
         sys.stderr.write("Valid similarity matrices are:\n")
         sys.stderr.write("%s\n" % " | ".join(SIMILARITY_DICT.keys()))
         exit(1)
-    main(
-        output,
-        motif_length,
-        iedb_data,
-        processors,
-        data,
-        aligment_file,
-        background_model,
-        signal,
-        noise,
-        sim_tuple,
-    )
+    if update_model:
+        if len(motif_length) > 1:
+            sys.stderr.write("Error: --update only supports one length\n")
+            exit(1)
+        if not data:
+            sys.stderr.write("Error: --update requires the new data file (--data)\n")
+            exit(1)
+        update(
+            output,
+            motif_length[0],
+            update_model,
+            processors,
+            data,
+            max_similarity_drop,
+            max_candidates,
+            skip_duplicate_envs,
+            precision,
+            queue_dir,
+        )
+    else:
+        main(
+            output,
+            motif_length,
+            iedb_data,
+            processors,
+            data,
+            aligment_file,
+            background_model,
+            signal,
+            noise,
+            sim_tuple,
+            max_similarity_drop,
+            max_candidates,
+            skip_duplicate_envs,
+            checkpoint_dir,
+            resume,
+            rank_size,
+            rank_reference,
+            precision,
+            queue_dir,
+        )
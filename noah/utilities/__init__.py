@@ -1,6 +1,12 @@
 from .utilities import (
+    load_checkpoint,
     load_data,
+    load_data_batches,
+    load_fasta,
     load_model,
+    load_peptides,
+    load_variants,
     process_peptides,
+    save_checkpoint,
     score_peptides_paralleled,
 )
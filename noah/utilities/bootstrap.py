@@ -0,0 +1,92 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from utilities import evaluation
+
+
+def bootstrap_mcc(predictions, labels, replicates=1000, confidence=0.95, seed=None):
+    """
+    Computes the MCC and its bootstrap confidence interval.
+    Resampling the peptides with replacement only changes how many of them fall in each cell of the
+    confusion matrix, so the counts of all the replicates are drawn at once from a multinomial distribution
+    with the frequencies of the cells (which is equivalent to resampling the peptides one by one).
+    :param predictions: boolean array, True for the peptides predicted as binders
+    :param labels: boolean array, True for the binding peptides
+    :param replicates: number of bootstrap replicates
+    :param confidence: confidence level of the interval
+    :param seed: seed of the random generator (or a numpy SeedSequence)
+    :return: tuple (MCC, lower bound, upper bound)
+    """
+    predictions = np.asarray(predictions, dtype=bool)
+    labels = np.asarray(labels, dtype=bool)
+    total = len(labels)
+    # TP, FP, TN, FN
+    cells = np.array(
+        [
+            np.sum(predictions & labels),
+            np.sum(predictions & ~labels),
+            np.sum(~predictions & ~labels),
+            np.sum(~predictions & labels),
+        ],
+        dtype=np.float64,
+    )
+    MCC = float(evaluation.mcc_arrays(*cells))
+    if total == 0:
+        return MCC, MCC, MCC
+    generator = np.random.default_rng(seed)
+    counts = generator.multinomial(total, cells / total, size=replicates)
+    replicate_MCC = evaluation.mcc_arrays(
+        counts[:, 0], counts[:, 1], counts[:, 2], counts[:, 3]
+    )
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.quantile(replicate_MCC, [alpha, 1.0 - alpha])
+    return MCC, float(lower), float(upper)
+
+
+def _bootstrap_hla(task):
+    # Unpacks the bootstrap of one hla so it can be sent through Pool.map
+    hla, predictions, labels, replicates, confidence, seed = task
+    return hla, bootstrap_mcc(predictions, labels, replicates, confidence, seed)
+
+
+def bootstrap_predictions(
+    results,
+    data_qual,
+    threshold=-1,
+    replicates=1000,
+    confidence=0.95,
+    seed=None,
+    processors=1,
+    pool=None,
+):
+    """
+    Computes the MCC of each hla of a prediction with its bootstrap confidence interval
+    :param results: dict {hla: {peptide: score}}
+    :param data_qual: dict {hla: {peptide: qualitative_value}}
+    :param threshold: peptides with a score lower or equal than the threshold are predicted as binders
+    :param replicates: number of bootstrap replicates
+    :param confidence: confidence level of the intervals
+    :param seed: seed of the random generator, each hla gets its own stream so the results do not depend
+    on the number of processors
+    :param processors: number of processors to use
+    :param pool: multiprocessing pool to use instead of creating a new one (it is not terminated)
+    :return: dict {hla: (MCC, lower bound, upper bound)}
+    """
+    hlas = sorted(hla for hla in results if hla in data_qual)
+    seeds = np.random.SeedSequence(seed).spawn(len(hlas))
+    tasks = []
+    for hla, hla_seed in zip(hlas, seeds):
+        scores, labels = evaluation.labelled_scores(results[hla], data_qual[hla])
+        tasks.append(
+            (hla, scores <= threshold, labels, replicates, confidence, hla_seed)
+        )
+    if pool is not None:
+        bootstrap = dict(pool.map(_bootstrap_hla, tasks))
+    elif processors > 1:
+        pool = mp.Pool(processors)
+        bootstrap = dict(pool.map(_bootstrap_hla, tasks))
+        pool.terminate()
+    else:
+        bootstrap = dict(map(_bootstrap_hla, tasks))
+    return bootstrap
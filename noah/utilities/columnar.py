@@ -0,0 +1,248 @@
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+# Extensions of the binary columnar files: numpy archives and Arrow IPC files (Feather v2)
+FORMATS = {".npz": "npz", ".arrow": "arrow", ".feather": "arrow"}
+# Columns of a table: peptide (str), hla (int32 code of each row) with hlas (the dictionary of the codes),
+# score and rank (float32)
+FLOAT_COLUMNS = ["score", "rank"]
+
+
+def file_format(file_path):
+    # npz, arrow or None for text files
+    return FORMATS.get(os.path.splitext(file_path)[1])
+
+
+def is_columnar(file_path):
+    return file_format(file_path) is not None
+
+
+def _import_pyarrow(file_path):
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise Exception(
+            "Error: reading or writing %s requires the pyarrow package "
+            "(pip install pyarrow)\n" % file_path
+        )
+    return pyarrow
+
+
+def pairs_table(output_data, ranks=None):
+    """
+    Builds a table from the scores of (hla, peptide) pairs
+    :param output_data: dict {hla: {peptide: score}}
+    :param ranks: dict {hla: {peptide: rank}} or None
+    :return: dict of columns
+    """
+    hlas = list(output_data)
+    peptides = [peptide for hla in hlas for peptide in output_data[hla]]
+    table = {
+        "peptide": np.array(peptides, dtype=str),
+        "hla": np.repeat(
+            np.arange(len(hlas), dtype=np.int32),
+            [len(output_data[hla]) for hla in hlas],
+        ),
+        "hlas": np.array(hlas, dtype=str),
+        "score": np.array(
+            [output_data[hla][peptide] for hla in hlas for peptide in output_data[hla]],
+            dtype=np.float32,
+        ),
+    }
+    if ranks is not None:
+        table["rank"] = np.array(
+            [ranks[hla][peptide] for hla in hlas for peptide in output_data[hla]],
+            dtype=np.float32,
+        )
+    return table
+
+
+def table_rows(table):
+    return len(table["peptide"])
+
+
+def table_pairs(table):
+    """
+    (peptide, hla) pairs of a table
+    :param table: dict of columns with peptide, hla and hlas
+    :return: list of tuples (peptide, hla)
+    """
+    if "hla" not in table:
+        raise Exception("Error: the input table has no hla column\n")
+    hlas = np.asarray(table["hlas"]).tolist()
+    return [
+        (peptide, hlas[code])
+        for peptide, code in zip(
+            np.asarray(table["peptide"]).tolist(), np.asarray(table["hla"]).tolist()
+        )
+    ]
+
+
+def slice_table(table, start, end):
+    # Rows start to end of a table (the dictionary of the hlas is kept)
+    return {
+        name: column if name == "hlas" else column[start:end]
+        for name, column in table.items()
+    }
+
+
+def concat_tables(tables, unique_pairs=False):
+    """
+    Concatenates tables, encoding their hlas with one dictionary
+    :param tables: list of tables
+    :param unique_pairs: Boolean, keep only the first row of each (hla, peptide) pair
+    :return: table
+    """
+    index = {}
+    codes = []
+    for table in tables:
+        mapping = np.array(
+            [index.setdefault(hla, len(index)) for hla in np.asarray(table["hlas"])],
+            dtype=np.int32,
+        )
+        codes.append(mapping[np.asarray(table["hla"])] if len(mapping) else [])
+    merged = {
+        "peptide": np.concatenate(
+            [np.asarray(table["peptide"]) for table in tables]
+        ).astype(str),
+        "hla": np.concatenate(codes).astype(np.int32),
+        "hlas": np.array(list(index), dtype=str),
+    }
+    for name in FLOAT_COLUMNS:
+        if tables and all(name in table for table in tables):
+            merged[name] = np.concatenate(
+                [np.asarray(table[name]) for table in tables]
+            ).astype(np.float32)
+    if unique_pairs:
+        seen = set()
+        keep = np.zeros(table_rows(merged), dtype=bool)
+        for i, pair in enumerate(
+            zip(merged["hla"].tolist(), merged["peptide"].tolist())
+        ):
+            if pair not in seen:
+                seen.add(pair)
+                keep[i] = True
+        merged = {
+            name: column if name == "hlas" else column[keep]
+            for name, column in merged.items()
+        }
+    return merged
+
+
+def _read_npz(file_path):
+    # Maps the arrays stored without compression (np.savez), the compressed ones are loaded
+    arrays = {}
+    with zipfile.ZipFile(file_path) as archive:
+        members = archive.infolist()
+    with open(file_path, "rb") as inn:
+        for member in members:
+            name = member.filename[: -len(".npy")]
+            if member.compress_type != zipfile.ZIP_STORED:
+                with np.load(file_path, allow_pickle=False) as data:
+                    arrays[name] = data[name]
+                continue
+            # The data of a member starts after its local header (30 bytes, the name and the extra field)
+            inn.seek(member.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", inn.read(4))
+            inn.seek(member.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(inn)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(inn)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(inn)
+            if dtype.hasobject:
+                raise Exception(
+                    "Error: %s stores python objects, not supported\n" % file_path
+                )
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    file_path,
+                    dtype=dtype,
+                    mode="r",
+                    offset=inn.tell(),
+                    shape=shape,
+                    order="F" if fortran else "C",
+                )
+    return arrays
+
+
+def _read_arrow(file_path):
+    pa = _import_pyarrow(file_path)
+    with pa.memory_map(file_path, "r") as source:
+        data = pa.ipc.open_file(source).read_all()
+    table = {}
+    for name in data.column_names:
+        column = data.column(name).combine_chunks()
+        if name == "hla":
+            if pa.types.is_dictionary(column.type):
+                table["hla"] = column.indices.to_numpy(zero_copy_only=False).astype(
+                    np.int32
+                )
+                table["hlas"] = np.array(column.dictionary.to_pylist(), dtype=str)
+            else:
+                table["hlas"], table["hla"] = np.unique(
+                    np.array(column.to_pylist(), dtype=str), return_inverse=True
+                )
+                table["hla"] = table["hla"].ravel().astype(np.int32)
+        elif name == "peptide":
+            table["peptide"] = np.array(column.to_pylist(), dtype=str)
+        elif name in FLOAT_COLUMNS:
+            table[name] = column.to_numpy(zero_copy_only=False).astype(np.float32)
+    return table
+
+
+def read_table(file_path):
+    """
+    Reads a columnar file. The columns of uncompressed npz files and of Arrow files are memory mapped,
+    so only the rows that are used are read from the disk.
+    :param file_path: path to the file (.npz, .arrow or .feather)
+    :return: dict of columns (peptide, and hla with hlas, score and rank if present)
+    """
+    if not os.path.isfile(file_path):
+        raise Exception("Error: input file not found\n")
+    if file_format(file_path) == "npz":
+        table = _read_npz(file_path)
+    else:
+        table = _read_arrow(file_path)
+    if "peptide" not in table:
+        raise Exception("Error: %s has no peptide column\n" % file_path)
+    if "hla" in table and "hlas" not in table:
+        raise Exception(
+            "Error: %s has no hlas column with the dictionary of the hla codes\n"
+            % file_path
+        )
+    return table
+
+
+def write_table(file_path, table):
+    """
+    Writes a table in one operation
+    :param file_path: path to the file (.npz, .arrow or .feather)
+    :param table: dict of columns
+    :return:
+    """
+    if file_format(file_path) == "npz":
+        # Without compression, so the columns can be memory mapped when they are read
+        with open(file_path, "wb") as out:
+            np.savez(out, **table)
+        return
+    pa = _import_pyarrow(file_path)
+    columns = {"peptide": pa.array(np.asarray(table["peptide"]).tolist(), pa.string())}
+    if "hla" in table:
+        columns["hla"] = pa.DictionaryArray.from_arrays(
+            pa.array(table["hla"], pa.int32()),
+            pa.array(np.asarray(table["hlas"]).tolist(), pa.string()),
+        )
+    for name in FLOAT_COLUMNS:
+        if name in table:
+            columns[name] = pa.array(table[name], pa.float32())
+    data = pa.table(columns)
+    with pa.OSFile(file_path, "wb") as sink:
+        with pa.ipc.new_file(sink, data.schema) as writer:
+            writer.write_table(data)
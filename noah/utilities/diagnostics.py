@@ -0,0 +1,175 @@
+import json
+import sys
+import threading
+
+# Types of events
+INVALID_RESIDUE = "invalid_residue"
+UNKNOWN_HLA = "unknown_hla"
+UNRESOLVED_HLA = "unresolved_hla"
+UNKNOWN_LETTER = "unknown_letter"
+NO_HLA = "no_hla"
+SKIPPED_VARIANT = "skipped_variant"
+SCORING_ERROR = "scoring_error"
+# Events of each type printed as they happen, the rest are only counted
+SAMPLES = 3
+# Alleles of each type of event listed in the summary
+SUMMARY_ALLELES = 5
+
+
+class Diagnostics:
+    """
+    Collects the warnings and errors of the scoring instead of printing each one: the events are counted by
+    type and allele, the first samples of each type are printed, and a summary (and optionally a JSON report)
+    is written at the end. It can be used from several threads, and the events recorded in worker processes
+    are sent back with take and added with merge.
+    """
+
+    def __init__(self, samples=SAMPLES, stream=sys.stderr):
+        """
+        :param samples: events of each type printed as they happen
+        :param stream: where the samples and the summary are written
+        """
+        self.samples = samples
+        self.stream = stream
+        self.counts = {}  # {event: {allele: count}}
+        self.examples = {}  # {event: [messages]}
+        self.lock = threading.Lock()
+
+    def record(self, event, allele=None, message=None, count=1):
+        """
+        Records events
+        :param event: type of event
+        :param allele: hla of the events (None if they do not depend on an hla)
+        :param message: description of the event, printed if it is one of the first samples of its type
+        :param count: number of events
+        :return:
+        """
+        with self.lock:
+            alleles = self.counts.setdefault(event, {})
+            alleles[allele] = alleles.get(allele, 0) + count
+            examples = self.examples.setdefault(event, [])
+            if message is None or len(examples) >= self.samples:
+                return
+            examples.append(message)
+            self.stream.write("WARNING: %s\n" % message)
+            if len(examples) == self.samples:
+                self.stream.write(
+                    "WARNING: further %s events are counted and reported at the end\n"
+                    % event
+                )
+
+    def error(self, error, allele=None, message=None):
+        """
+        Records an exception as a scoring error of its class
+        :param error: exception
+        :param allele: hla that was being scored
+        :param message: description of what was being done
+        :return:
+        """
+        description = "%s: %s" % (type(error).__name__, error)
+        if message:
+            description = "%s (%s)" % (message, description)
+        self.record(
+            "%s:%s" % (SCORING_ERROR, type(error).__name__), allele, description
+        )
+
+    def total(self, event=None):
+        # Number of events (of a type or of all of them)
+        events = [event] if event is not None else list(self.counts)
+        return sum(sum(self.counts.get(x, {}).values()) for x in events)
+
+    def report(self):
+        # Dict with the count, the alleles and the samples of each type of event
+        with self.lock:
+            return {
+                event: {
+                    "total": sum(alleles.values()),
+                    "alleles": {
+                        str(allele): count for allele, count in alleles.items()
+                    },
+                    "samples": list(self.examples.get(event, [])),
+                }
+                for event, alleles in sorted(self.counts.items())
+            }
+
+    def take(self):
+        # Returns the events recorded (see merge) and forgets them
+        with self.lock:
+            taken = (self.counts, self.examples)
+            self.counts = {}
+            self.examples = {}
+        return taken
+
+    def merge(self, taken):
+        """
+        Adds the events returned by take in another process (their samples are not printed again)
+        :param taken: tuple (counts, examples)
+        :return:
+        """
+        counts, examples = taken
+        with self.lock:
+            for event, alleles in counts.items():
+                own = self.counts.setdefault(event, {})
+                for allele, count in alleles.items():
+                    own[allele] = own.get(allele, 0) + count
+            for event, messages in examples.items():
+                own = self.examples.setdefault(event, [])
+                own += messages[: max(0, self.samples - len(own))]
+
+    def summary(self):
+        """
+        Summary of the events, one line for each type with the alleles with more events
+        :return: list of strings
+        """
+        lines = []
+        for event, data in self.report().items():
+            alleles = sorted(data["alleles"].items(), key=lambda x: (-x[1], x[0]))
+            listed = ", ".join(
+                "%s: %s" % (allele, count)
+                for allele, count in alleles[:SUMMARY_ALLELES]
+                if allele != "None"
+            )
+            if len(alleles) > SUMMARY_ALLELES:
+                listed += ", ... (%s alleles)" % len(alleles)
+            lines.append(
+                "%s: %s%s" % (event, data["total"], " (%s)" % listed if listed else "")
+            )
+        return lines
+
+    def print_summary(self):
+        # Writes the summary if there are events
+        lines = self.summary()
+        if lines:
+            self.stream.write("Diagnostics summary:\n")
+            for line in lines:
+                self.stream.write("    %s\n" % line)
+
+    def write_report(self, file_path):
+        # Writes the report as JSON
+        with open(file_path, "w") as out:
+            json.dump(self.report(), out, indent=2)
+
+    def reset(self):
+        self.take()
+
+
+# Collector used by the scoring code
+collector = Diagnostics()
+
+
+def record(event, allele=None, message=None, count=1):
+    # Records events in the default collector (see Diagnostics.record)
+    collector.record(event, allele, message, count)
+
+
+def run_collected(function, *args):
+    """
+    Runs a function in a worker process and collects its events, so the parent can add them with
+    collector.merge (the events copied from the parent when the worker started are discarded)
+    :param function: function to run
+    :param args: arguments of the function
+    :return: tuple (result, events)
+    """
+    collector.take()
+    result = function(*args)
+    return result, collector.take()
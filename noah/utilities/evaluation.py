@@ -0,0 +1,140 @@
+import numpy as np
+from constants.constants import NEGATIVE, POSITIVE_HIGH, POSITIVE_INTERMEDIATE
+
+
+def labelled_scores(data_scored, data_qual):
+    """
+    Pairs the predicted scores of an hla with their experimental labels.
+    Only the binding (Positive-High, Positive-Intermediate) and non-binding (Negative) peptides are used,
+    as in Scorer.confusion_matrix_from_predictet_data.
+    :param data_scored: dict {peptide: score}
+    :param data_qual: dict {peptide: qualitative_value}
+    :return: numpy arrays with the scores and the labels (True for the binding peptides)
+    """
+    scores = []
+    labels = []
+    for peptide, score in data_scored.items():
+        qualitative_value = data_qual.get(peptide)
+        if qualitative_value in [POSITIVE_HIGH, POSITIVE_INTERMEDIATE]:
+            labels.append(True)
+        elif qualitative_value == NEGATIVE:
+            labels.append(False)
+        else:
+            continue
+        scores.append(score)
+    return np.array(scores, dtype=np.float64), np.array(labels, dtype=bool)
+
+
+def mcc_arrays(TP, FP, TN, FN):
+    """
+    Computes the MCC of several confusion matrices at once
+    (0 where the MCC is not defined, like Scorer.score_MCC)
+    :return: numpy array with the MCCs
+    """
+    TP, FP, TN, FN = [np.asarray(x, dtype=np.float64) for x in (TP, FP, TN, FN)]
+    denominator = np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+    numerator = (TP * TN) - (FP * FN)
+    return np.divide(
+        numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0
+    )
+
+
+def _area(x, y):
+    # Area under a curve using the trapezoidal rule
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2.0))
+
+
+def threshold_sweep(scores, labels):
+    """
+    Computes the confusion matrix at every distinct threshold with one sort of the scores.
+    As in the rest of NOAH, peptides with a score lower or equal to the threshold are predicted as binders.
+    :param scores: array with the predicted scores
+    :param labels: boolean array, True for the binding peptides
+    :return: dict with the arrays of thresholds, TP, FP, TN, FN, MCC, TPR, FPR and precision (one value for
+    each threshold), the threshold with the best MCC, its MCC, and the areas under the ROC and
+    precision-recall curves
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    order = np.argsort(scores, kind="mergesort")
+    scores = scores[order]
+    labels = labels[order]
+    positives = int(np.sum(labels))
+    negatives = len(labels) - positives
+
+    # Last peptide of each group of equal scores, all of them are predicted at that threshold
+    distinct = np.append(scores[1:] != scores[:-1], True)
+    thresholds = scores[distinct]
+    TP = np.cumsum(labels)[distinct]
+    FP = np.cumsum(~labels)[distinct]
+    FN = positives - TP
+    TN = negatives - FP
+    MCC = mcc_arrays(TP, FP, TN, FN)
+    TPR = TP / positives if positives else np.zeros(len(TP))
+    FPR = FP / negatives if negatives else np.zeros(len(FP))
+    precision = TP / (TP + FP)
+
+    if len(thresholds):
+        best = int(np.argmax(MCC))
+        best_threshold = float(thresholds[best])
+        best_MCC = float(MCC[best])
+        ROC_AUC = _area(np.append(0.0, FPR), np.append(0.0, TPR))
+        # Average precision: precision weighted by the recall gained at each threshold
+        PR_AUC = float(np.sum(np.diff(np.append(0.0, TPR)) * precision))
+    else:
+        best_threshold, best_MCC, ROC_AUC, PR_AUC = None, 0.0, 0.0, 0.0
+
+    return {
+        "thresholds": thresholds,
+        "TP": TP,
+        "FP": FP,
+        "TN": TN,
+        "FN": FN,
+        "MCC": MCC,
+        "TPR": TPR,
+        "FPR": FPR,
+        "precision": precision,
+        "best_threshold": best_threshold,
+        "best_MCC": best_MCC,
+        "ROC_AUC": ROC_AUC,
+        "PR_AUC": PR_AUC,
+    }
+
+
+def mcc_at_threshold(sweep, threshold):
+    # MCC of a threshold_sweep result at a given threshold (using a binary search)
+    index = np.searchsorted(sweep["thresholds"], threshold, side="right") - 1
+    if index < 0:
+        TP, FP = 0, 0
+    else:
+        TP, FP = sweep["TP"][index], sweep["FP"][index]
+    positives = sweep["TP"][-1] + sweep["FN"][-1] if len(sweep["TP"]) else 0
+    negatives = sweep["FP"][-1] + sweep["TN"][-1] if len(sweep["FP"]) else 0
+    return float(mcc_arrays(TP, FP, negatives - FP, positives - TP))
+
+
+def evaluate_predictions(predictions, data_qual):
+    """
+    Runs threshold_sweep for each hla of a prediction
+    :param predictions: dict {hla: {peptide: score}}
+    :param data_qual: dict {hla: {peptide: qualitative_value}}
+    :return: dict {hla: threshold_sweep result}
+    """
+    evaluation = {}
+    for hla in predictions:
+        if hla not in data_qual:
+            continue
+        scores, labels = labelled_scores(predictions[hla], data_qual[hla])
+        evaluation[hla] = threshold_sweep(scores, labels)
+    return evaluation
+
+
+def calibrate_thresholds(predictions, data_qual):
+    """
+    Finds the threshold with the best MCC for each hla
+    :param predictions: dict {hla: {peptide: score}}
+    :param data_qual: dict {hla: {peptide: qualitative_value}}
+    :return: dict {hla: threshold}
+    """
+    evaluation = evaluate_predictions(predictions, data_qual)
+    return {hla: result["best_threshold"] for hla, result in evaluation.items()}
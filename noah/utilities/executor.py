@@ -0,0 +1,234 @@
+import multiprocessing as mp
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utilities import diagnostics
+
+EXECUTORS = ["auto", "inprocess", "thread", "process"]
+# Jobs up to this number of pairs are always scored in this process
+SMALL_JOB = 2000
+# Pairs scored (in this process and with threads) to measure the speed of each executor
+CALIBRATION_SIZE = 500
+_pool_startup = {}  # {processors: seconds to start a pool}, measured once per process
+_worker_scorer = None  # model of a worker process, received once when the worker starts
+
+
+def _score_chunk(scorer, data):
+    # Scores a chunk of pairs (in a thread or a worker process)
+    return scorer.score_pairs(data)
+
+
+def _init_worker(scorer):
+    # Keeps the model in the worker and discards the events copied from the parent
+    global _worker_scorer
+    _worker_scorer = scorer
+    diagnostics.collector.take()
+
+
+def _score_worker_chunk(data):
+    # Scores a chunk with the model of the worker, sending back its warnings with the scores
+    return diagnostics.run_collected(_score_chunk, _worker_scorer, data)
+
+
+def _merge(output_data, result):
+    # Adds the scores of a chunk keeping the first score of each pair
+    for hla in result:
+        for peptide in result[hla]:
+            output_data.setdefault(hla, {}).setdefault(peptide, result[hla][peptide])
+
+
+def _chunks(data, parts):
+    # Splits a list in parts of (almost) the same size
+    size = -(-len(data) // max(1, parts))
+    return [data[i : i + size] for i in range(0, len(data), max(1, size))]
+
+
+def prepare_hlas(scorer, data):
+    """
+    Resolves the hlas of the pairs (and prepares the deNovo ones) in this process, so the threads only read
+    the model and the worker processes receive it ready
+    :param scorer: Scorer or ScorerBundle
+    :param data: list of tuples (peptide, hla)
+    :return: set of tuples (motif_length, hla) prepared for the deNovo prediction by this call
+    """
+    resolved = set()
+    prepared = set()
+    for peptide, hla in data:
+        model = scorer.get_model(len(peptide))
+        if (model.motif_length, hla) not in resolved:
+            resolved.add((model.motif_length, hla))
+            known = hla in model.unknown_hla_map
+            model.resolve_hla(hla)
+            if not known and hla in model.unknown_hla_map:
+                prepared.add((model.motif_length, hla))
+    return prepared
+
+
+def _pool_startup_time(processors):
+    # Seconds needed to start a pool of workers and run a task in each one
+    if processors not in _pool_startup:
+        start = time.perf_counter()
+        pool = mp.Pool(processors)
+        pool.map(abs, range(processors))
+        pool.terminate()
+        _pool_startup[processors] = time.perf_counter() - start
+    return _pool_startup[processors]
+
+
+def calibrate(scorer, data, processors, output_data):
+    """
+    Measures the speed of each executor scoring the first pairs of the job (their scores are added to
+    output_data, so the calibration is not wasted)
+    :param scorer: Scorer or ScorerBundle
+    :param data: list of tuples (peptide, hla)
+    :param processors: number of processors to use
+    :param output_data: dict {hla: {peptide: score}} where the scored pairs are added
+    :return: dict with the seconds per pair in this process ("inprocess") and with threads ("thread"),
+    the seconds to start the worker processes ("pool") and to send them the model ("model"), and the
+    number of pairs already scored ("scored")
+    """
+    sample = data[:CALIBRATION_SIZE]
+    start = time.perf_counter()
+    _merge(output_data, _score_chunk(scorer, sample))
+    inprocess = (time.perf_counter() - start) / max(1, len(sample))
+
+    thread_sample = data[len(sample) : len(sample) + CALIBRATION_SIZE * processors]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(processors) as executor:
+        for result in executor.map(
+            lambda chunk: _score_chunk(scorer, chunk),
+            _chunks(thread_sample, processors),
+        ):
+            _merge(output_data, result)
+    thread = (time.perf_counter() - start) / max(1, len(thread_sample))
+
+    start = time.perf_counter()
+    pickle.dumps(scorer)
+    model = time.perf_counter() - start
+    return {
+        "inprocess": inprocess,
+        "thread": thread,
+        "pool": _pool_startup_time(processors),
+        "model": model,
+        "scored": len(sample) + len(thread_sample),
+    }
+
+
+def choose_executor(pairs, processors, calibration):
+    """
+    Chooses the executor with the lowest estimated time
+    :param pairs: number of pairs to score
+    :param processors: number of processors to use
+    :param calibration: measures returned by calibrate
+    :return: inprocess, thread or process
+    """
+    # Each worker receives a copy of the model and scores its part at the in-process speed,
+    # as long as there are cores for all of them
+    workers = max(1, min(processors, mp.cpu_count()))
+    estimates = {
+        "inprocess": pairs * calibration["inprocess"],
+        "thread": pairs * calibration["thread"],
+        "process": calibration["pool"]
+        + processors * calibration["model"]
+        + pairs * calibration["inprocess"] / workers,
+    }
+    return min(["inprocess", "thread", "process"], key=lambda x: estimates[x])
+
+
+class PairExecutor:
+    """
+    Scores batches of (peptide, hla) pairs of the same job choosing once how to run the work: small jobs are
+    scored in this process, medium jobs with a pool of threads (the batch scoring releases the GIL inside
+    NumPy) and large jobs with worker processes. With auto, the executor is chosen with the first batch
+    (calibrated with its first pairs if it is bigger than SMALL_JOB), and the pool of threads or processes
+    is started once and used for all the batches.
+    """
+
+    def __init__(self, scorer, processors=1, executor="auto"):
+        """
+        :param scorer: Scorer or ScorerBundle
+        :param processors: number of processors to use
+        :param executor: auto, inprocess, thread or process
+        """
+        self.scorer = scorer
+        self.processors = processors
+        self.executor = executor
+        self.threads = None
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # Stops the pool of threads or processes
+        if self.threads is not None:
+            self.threads.shutdown()
+            self.threads = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def _process_pool(self, prepared):
+        # Workers with the current model, started again if hlas were prepared since they received it
+        if self.pool is not None and prepared:
+            self.pool.terminate()
+            self.pool = None
+        if self.pool is None:
+            self.pool = mp.Pool(self.processors, _init_worker, (self.scorer,))
+        return self.pool
+
+    def score(self, data):
+        """
+        Scores a batch of pairs
+        :param data: list of tuples (peptide, hla)
+        :return: dict {hla: {peptide: score}}
+        """
+        output_data = {}
+        data = list(data)
+        prepared = prepare_hlas(self.scorer, data)
+        if self.executor == "auto":
+            if self.processors <= 1 or len(data) <= SMALL_JOB:
+                self.executor = "inprocess"
+            else:
+                calibration = calibrate(self.scorer, data, self.processors, output_data)
+                data = data[calibration["scored"] :]
+                self.executor = choose_executor(len(data), self.processors, calibration)
+        print("Scoring %s pairs (%s executor)" % (len(data), self.executor))
+        if self.executor == "inprocess" or not data:
+            _merge(output_data, _score_chunk(self.scorer, data))
+        elif self.executor == "thread":
+            if self.threads is None:
+                self.threads = ThreadPoolExecutor(self.processors)
+            for result in self.threads.map(
+                lambda chunk: _score_chunk(self.scorer, chunk),
+                _chunks(data, self.processors),
+            ):
+                _merge(output_data, result)
+        else:
+            pool = self._process_pool(prepared)
+            workers = [
+                pool.apply_async(_score_worker_chunk, (chunk,))
+                for chunk in _chunks(data, self.processors)
+            ]
+            for worker in workers:
+                result, events = worker.get()
+                diagnostics.collector.merge(events)
+                _merge(output_data, result)
+        return output_data
+
+
+def score_pairs(scorer, data, processors=1, executor="auto"):
+    """
+    Scores (peptide, hla) pairs choosing how to run the work (see PairExecutor)
+    :param scorer: Scorer or ScorerBundle
+    :param data: list of tuples (peptide, hla)
+    :param processors: number of processors to use
+    :param executor: auto, inprocess, thread or process
+    :return: dict {hla: {peptide: score}}
+    """
+    with PairExecutor(scorer, processors, executor) as pairs:
+        return pairs.score(data)
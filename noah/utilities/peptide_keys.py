@@ -0,0 +1,180 @@
+import numpy as np
+from constants.constants import VALID_AMINOACIDS
+
+# Each residue uses 5 bits (index in valid_letters + 1, 0 is empty) and the 4 highest bits keep the length,
+# so peptides of up to 12 residues fit in one uint64 and keys sort by length and then alphabetically
+BITS = 5
+MAX_LENGTH = 12
+LENGTH_SHIFT = 60
+INVALID_KEY = np.uint64(np.iinfo(np.uint64).max)
+
+
+def letter_codes(peptides, length, valid_letters=VALID_AMINOACIDS):
+    """
+    Encodes peptides of the same length as a matrix of letter indexes
+    :param peptides: list of peptides
+    :param length: length of the peptides
+    :param valid_letters: list of valid amino acids
+    :return: uint8 array (N, length), letters not in valid_letters get the index len(valid_letters)
+    """
+    table = np.full(256, len(valid_letters), dtype=np.uint8)
+    for i, letter in enumerate(valid_letters):
+        table[ord(letter)] = i
+    # Non ascii letters are replaced by "?" so every letter keeps one byte
+    buffer = "".join(peptides).encode("ascii", "replace")
+    return table[np.frombuffer(buffer, dtype=np.uint8)].reshape(-1, length)
+
+
+def encode_codes(codes, valid_letters=VALID_AMINOACIDS):
+    """
+    Packs a matrix of letter indexes into keys
+    :param codes: array (N, length) with the index of each letter in valid_letters
+    :param valid_letters: list of valid amino acids
+    :return: uint64 array (N,), INVALID_KEY for the peptides with invalid letters or too long
+    """
+    codes = np.asarray(codes)
+    total, length = codes.shape
+    if length > MAX_LENGTH or len(valid_letters) >= (1 << BITS):
+        return np.full(total, INVALID_KEY, dtype=np.uint64)
+    keys = np.full(total, np.uint64(length) << np.uint64(LENGTH_SHIFT), dtype=np.uint64)
+    for i in range(length):
+        shift = np.uint64(BITS * (length - 1 - i))
+        keys |= (codes[:, i].astype(np.uint64) + np.uint64(1)) << shift
+    keys[np.any(codes >= len(valid_letters), axis=1)] = INVALID_KEY
+    return keys
+
+
+def encode_peptides(peptides, valid_letters=VALID_AMINOACIDS):
+    """
+    Packs peptides (of any length) into keys
+    :param peptides: list of peptides
+    :param valid_letters: list of valid amino acids
+    :return: uint64 array, INVALID_KEY for the peptides with invalid letters or too long
+    """
+    keys = np.full(len(peptides), INVALID_KEY, dtype=np.uint64)
+    lengths = np.array([len(peptide) for peptide in peptides], dtype=np.int64)
+    for length in np.unique(lengths):
+        if length == 0 or length > MAX_LENGTH:
+            continue
+        index = np.flatnonzero(lengths == length)
+        codes = letter_codes([peptides[i] for i in index], int(length), valid_letters)
+        keys[index] = encode_codes(codes, valid_letters)
+    return keys
+
+
+def unique_keys(keys, return_index=False, return_inverse=False, return_counts=False):
+    # Sorted unique keys (same options as numpy.unique)
+    return np.unique(
+        np.asarray(keys, dtype=np.uint64),
+        return_index=return_index,
+        return_inverse=return_inverse,
+        return_counts=return_counts,
+    )
+
+
+def unique_pairs(data, valid_letters=VALID_AMINOACIDS):
+    """
+    Removes the repeated (peptide, hla) pairs keeping the first appearance of each one
+    :param data: list of tuples (peptide, hla)
+    :param valid_letters: list of valid amino acids
+    :return: list of tuples (peptide, hla)
+    """
+    if not len(data):
+        return list(data)
+    keys = encode_peptides([element[0] for element in data], valid_letters)
+    _, hla_codes = np.unique(
+        np.array([element[1] for element in data], dtype=str), return_inverse=True
+    )
+    hla_codes = hla_codes.ravel()
+    # Stable sort, the first element of each group of repeated pairs is its first appearance
+    order = np.lexsort((hla_codes, keys))
+    sorted_keys = keys[order]
+    sorted_hlas = hla_codes[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (
+        sorted_hlas[1:] != sorted_hlas[:-1]
+    )
+    # Peptides that can not be packed are compared as strings
+    first[sorted_keys == INVALID_KEY] = False
+    keep = np.zeros(len(data), dtype=bool)
+    keep[order[first]] = True
+    seen = set()
+    for i in np.flatnonzero(keys == INVALID_KEY):
+        pair = (data[i][0], data[i][1])
+        if pair not in seen:
+            seen.add(pair)
+            keep[i] = True
+    return [data[i] for i in np.flatnonzero(keep)]
+
+
+class SeenPairs:
+    """
+    Remembers the (peptide, hla) pairs already seen in a stream of batches. Each pair is stored as the key of
+    its peptide in sorted uint64 arrays of its hla (8 bytes per pair), which are merged like the digits of a
+    binary counter, so each lookup searches a few arrays and each key is merged a logarithmic number of times.
+    The peptides that can not be packed are kept as strings.
+    """
+
+    def __init__(self, valid_letters=VALID_AMINOACIDS):
+        """
+        :param valid_letters: list of valid amino acids
+        """
+        self.valid_letters = valid_letters
+        # {hla: [sorted uint64 arrays, from the biggest to the smallest]}
+        self.runs = {}
+        self.unpacked = set()  # pairs whose peptide can not be packed
+
+    def __len__(self):
+        return sum(len(run) for runs in self.runs.values() for run in runs) + len(
+            self.unpacked
+        )
+
+    def _seen(self, hla, keys):
+        # Which keys are already stored for an hla
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs.get(hla, []):
+            index = np.searchsorted(run, keys)
+            index[index == len(run)] = 0
+            found |= run[index] == keys
+        return found
+
+    def _add(self, hla, keys):
+        # Stores new keys of an hla, merging the arrays that are not bigger than the new one
+        if not len(keys):
+            return
+        runs = self.runs.setdefault(hla, [])
+        run = np.sort(keys)
+        while runs and len(runs[-1]) <= len(run):
+            run = np.sort(np.concatenate([runs.pop(), run]), kind="stable")
+        runs.append(run)
+
+    def filter(self, data):
+        """
+        Removes the repeated pairs and the pairs already seen, and remembers the rest
+        :param data: list of tuples (peptide, hla)
+        :return: list of tuples (peptide, hla) in the order of data
+        """
+        data = unique_pairs(data, self.valid_letters)
+        if not data:
+            return data
+        keys = encode_peptides([element[0] for element in data], self.valid_letters)
+        hlas, hla_codes = np.unique(
+            np.array([element[1] for element in data], dtype=str), return_inverse=True
+        )
+        keep = np.ones(len(data), dtype=bool)
+        packed = np.flatnonzero(keys != INVALID_KEY)
+        order = packed[np.argsort(hla_codes.ravel()[packed], kind="stable")]
+        bounds = np.searchsorted(hla_codes.ravel()[order], np.arange(len(hlas) + 1))
+        for code, hla in enumerate(hlas.tolist()):
+            index = order[bounds[code] : bounds[code + 1]]
+            if not len(index):
+                continue
+            keep[index] = ~self._seen(hla, keys[index])
+            self._add(hla, keys[index[keep[index]]])
+        for i in np.flatnonzero(keys == INVALID_KEY):
+            pair = (data[i][0], data[i][1])
+            if pair in self.unpacked:
+                keep[i] = False
+            else:
+                self.unpacked.add(pair)
+        return [data[i] for i in np.flatnonzero(keep)]
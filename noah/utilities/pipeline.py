@@ -0,0 +1,86 @@
+import queue
+import threading
+
+# Pairs read, scored and written at a time
+BATCH_SIZE = 100000
+# Batches that can wait between two stages, bounds the memory used when one stage is slower than the others
+QUEUE_SIZE = 4
+_END = None  # marks the end of the batches
+_TIMEOUT = 0.1  # seconds between the checks of a stage waiting for a queue
+
+
+def run_pipeline(batches, process, write, queue_size=QUEUE_SIZE):
+    """
+    Runs a reader, a processing and a writer stage at the same time, connected by bounded queues: the batches
+    are read (and decompressed) in a thread, processed in this thread and written (and compressed) in another
+    thread, so the I/O of a batch overlaps the processing of the next one. If a stage fails the others stop
+    and the error is raised here.
+    :param batches: iterable of batches (iterated in the reader thread)
+    :param process: function(batch) that returns the result of a batch
+    :param write: function(result) that writes the result of a batch (called in the writer thread, in order)
+    :param queue_size: maximum number of batches waiting between two stages
+    :return:
+    """
+    to_process = queue.Queue(queue_size)
+    to_write = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(target, item):
+        # Waits for room in a queue, returns False if the pipeline stopped
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(source):
+        # Waits for an item of a queue, returns _END if the pipeline stopped and the queue is empty
+        while True:
+            try:
+                return source.get(timeout=_TIMEOUT)
+            except queue.Empty:
+                if stop.is_set():
+                    return _END
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+
+    def read():
+        try:
+            for batch in batches:
+                if not put(to_process, batch):
+                    return
+        except BaseException as error:
+            fail(error)
+        put(to_process, _END)
+
+    def write_results():
+        try:
+            while True:
+                result = get(to_write)
+                if result is _END:
+                    return
+                write(result)
+        except BaseException as error:
+            fail(error)
+
+    reader = threading.Thread(target=read, daemon=True)
+    writer = threading.Thread(target=write_results, daemon=True)
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            batch = get(to_process)
+            if batch is _END or not put(to_write, process(batch)):
+                break
+    except BaseException as error:
+        fail(error)
+    put(to_write, _END)
+    reader.join()
+    writer.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import os
+import sys
+
+from hlaizer import iedb_reader
+from utilities import columnar, streams
+
+MANIFEST_VERSION = 2
+# Bytes read at once to hash the content of a file
+HASH_BLOCK = 1 << 20
+
+
+def parse_shard(spec):
+    """
+    Parses a shard specification
+    :param spec: string i/N, shard i (1-based) of N
+    :return: tuple (i, N) or None if the specification is not valid
+    """
+    try:
+        index, shards = [int(x) for x in spec.split("/")]
+    except ValueError:
+        return None
+    if shards < 1 or not 1 <= index <= shards:
+        return None
+    return index, shards
+
+
+def shard_range(file_path, shard):
+    """
+    Byte range of the lines of a shard. The file is split in N ranges of the same size that begin at the start
+    of a line, so every node computes the same ranges reading only the line around each boundary.
+    Compressed files can not be split by bytes, their shards take one line of every N (see read_lines), and
+    columnar files are split by rows (see read_table).
+    :param file_path: input file
+    :param shard: tuple (i, N)
+    :return: tuple (start, end), (None, None) for compressed and columnar files
+    """
+    if streams.is_compressed(file_path) or columnar.is_columnar(file_path):
+        return None, None
+    index, shards = shard
+    ranges = iedb_reader.line_ranges(file_path, 0, shards)
+    if index > len(ranges):
+        # Files with fewer lines than shards leave the last shards empty
+        size = os.path.getsize(file_path)
+        return size, size
+    return ranges[index - 1]
+
+
+def read_lines(file_path, shard=None):
+    """
+    Reads the lines of a file, or only the lines of one shard of it
+    :param file_path: input file
+    :param shard: tuple (i, N) or None to read the whole file
+    :return: iterator over the lines
+    """
+    if shard is None or streams.is_compressed(file_path):
+        with streams.open_text(file_path, "r") as inn:
+            for n, line in enumerate(inn):
+                # Every node decompresses the whole file and keeps the lines of its shard
+                if shard is None or n % shard[1] == shard[0] - 1:
+                    yield line
+        return
+    start, end = shard_range(file_path, shard)
+    with open(file_path, "rb") as inn:
+        inn.seek(start)
+        for line in inn.read(end - start).decode("utf-8").splitlines(True):
+            yield line
+
+
+def read_table(file_path, shard=None):
+    """
+    Reads a columnar file, or only the rows of one shard of it (N blocks of consecutive rows of the same size)
+    :param file_path: input file (.npz, .arrow or .feather)
+    :param shard: tuple (i, N) or None to read the whole file
+    :return: dict of columns (see utilities.columnar)
+    """
+    table = columnar.read_table(file_path)
+    if shard is None:
+        return table
+    rows = columnar.table_rows(table)
+    return columnar.slice_table(
+        table, rows * (shard[0] - 1) // shard[1], rows * shard[0] // shard[1]
+    )
+
+
+def _split_extension(file_path):
+    # Splits the compression or the columnar extension of a file
+    base, extension = streams.split_compression(file_path)
+    if not extension and columnar.is_columnar(file_path):
+        base, extension = os.path.splitext(file_path)
+    return base, extension
+
+
+def shard_output(output, shard):
+    # Name of the output file of a shard (with the format of the output)
+    base, extension = _split_extension(output)
+    return "%s.shard-%s-of-%s%s" % (base, shard[0], shard[1], extension)
+
+
+def _count_lines(file_path):
+    # Lines of a text file or rows of a columnar file
+    if columnar.is_columnar(file_path):
+        return columnar.table_rows(columnar.read_table(file_path))
+    with streams.open_text(file_path, "r") as inn:
+        return sum(1 for _ in inn)
+
+
+def content_key(file_path, whole=False):
+    """
+    Identifies the content of a file by its size and a hash of its first and last bytes (or of all its bytes),
+    without its path or its modification time, so the copies of a file on other nodes get the same key
+    :param file_path: path to the file
+    :param whole: Boolean, hash all the bytes of the file
+    :return: string
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as inn:
+        if whole:
+            for block in iter(lambda: inn.read(HASH_BLOCK), b""):
+                digest.update(block)
+        else:
+            digest.update(inn.read(iedb_reader.HASHED_BYTES))
+            if size > iedb_reader.HASHED_BYTES:
+                inn.seek(max(size - iedb_reader.HASHED_BYTES, iedb_reader.HASHED_BYTES))
+                digest.update(inn.read())
+    return "%s:%s" % (size, digest.hexdigest())
+
+
+def write_manifest(output, shard, input_file, models, header, unique_pairs):
+    """
+    Writes the manifest of a finished shard next to its output (shard_output(output, shard).json)
+    :param output: final output file (the shard output is shard_output(output, shard))
+    :param shard: tuple (i, N)
+    :param input_file: input file
+    :param models: list of paths to the models
+    :param header: Boolean, the first line of the output is a header
+    :param unique_pairs: Boolean, the lines are (hla, peptide, ...) pairs that are unique in each shard and have to
+    be unique in the merged output
+    :return:
+    """
+    shard_file = shard_output(output, shard)
+    start, end = shard_range(input_file, shard)
+    lines = _count_lines(shard_file)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "shard": shard[0],
+        "shards": shard[1],
+        "input": os.path.abspath(input_file),
+        "input_key": content_key(input_file),
+        "start": start,
+        "end": end,
+        "models": [os.path.abspath(model) for model in models],
+        "model_keys": [content_key(model, whole=True) for model in models],
+        "output": os.path.basename(shard_file),
+        "lines": lines,
+        "header": header,
+        "unique_pairs": unique_pairs,
+    }
+    tmp_file = "%s.json.tmp" % shard_file
+    with open(tmp_file, "w") as out:
+        json.dump(manifest, out, indent=2)
+    os.replace(tmp_file, "%s.json" % shard_file)
+
+
+def load_manifests(output, shards=None):
+    """
+    Loads the manifests of the shards of an output and checks that they are complete and belong to the same job
+    :param output: final output file
+    :param shards: number of shards (default read from the manifests)
+    :return: list of manifests in shard order, or None (after printing the problems) if they can not be merged
+    """
+    directory = os.path.dirname(os.path.abspath(output))
+    base, extension = _split_extension(os.path.basename(output))
+    prefix = "%s.shard-" % base
+    suffix = "%s.json" % extension
+    if shards is None:
+        found = set()
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith(suffix):
+                found.add(name[len(prefix) : -len(suffix)].split("-of-")[-1])
+        if len(found) != 1:
+            sys.stderr.write(
+                "Error: expected the manifests of one job for %s, found %s\n"
+                % (output, len(found))
+            )
+            return None
+        shards = int(found.pop())
+    manifests = []
+    problems = []
+    for index in range(1, shards + 1):
+        manifest_file = "%s.json" % shard_output(output, (index, shards))
+        if not os.path.exists(manifest_file):
+            problems.append("shard %s/%s has no manifest" % (index, shards))
+            continue
+        with open(manifest_file, "r") as inn:
+            manifest = json.load(inn)
+        if manifest.get("version") != MANIFEST_VERSION:
+            problems.append(
+                "shard %s/%s was written by another version of NOAH" % (index, shards)
+            )
+            continue
+        manifests.append(manifest)
+    if manifests:
+        first = manifests[0]
+        end = 0
+        for manifest in manifests:
+            # The paths of the files are not compared, each node can mount them in a different place
+            for key in ["version", "input_key", "model_keys", "header", "unique_pairs"]:
+                if manifest[key] != first[key]:
+                    problems.append(
+                        "shard %s/%s has a different %s"
+                        % (manifest["shard"], shards, key)
+                    )
+            # The shards of compressed inputs are lines of the whole file, they have no byte range
+            if manifest["start"] is not None:
+                if manifest["start"] != end and manifest["start"] != manifest["end"]:
+                    problems.append(
+                        "shard %s/%s does not start where the previous one ends"
+                        % (manifest["shard"], shards)
+                    )
+                end = max(end, manifest["end"])
+            shard_file = os.path.join(directory, manifest["output"])
+            if not os.path.exists(shard_file):
+                problems.append("output %s not found" % shard_file)
+            elif _count_lines(shard_file) != manifest["lines"]:
+                problems.append("output %s is incomplete" % shard_file)
+    if problems:
+        for problem in problems:
+            sys.stderr.write("Error: %s\n" % problem)
+        return None
+    return manifests
+
+
+def _merge_text(directory, manifests, tmp_file):
+    # Concatenates the text outputs of the shards, returns the number of lines written
+    header = None
+    seen = set()
+    written = 0
+    with streams.open_text(tmp_file, "w") as out:
+        for manifest in manifests:
+            shard_file = os.path.join(directory, manifest["output"])
+            with streams.open_text(shard_file, "r") as inn:
+                for n, line in enumerate(inn):
+                    if n == 0 and manifest["header"]:
+                        if header is not None:
+                            continue
+                        header = line
+                    elif manifest["unique_pairs"]:
+                        pair = tuple(line.split("\t", 2)[:2])
+                        if pair in seen:
+                            continue
+                        seen.add(pair)
+                    out.write(line)
+                    written += 1
+    return written
+
+
+def merge_shards(output, shards=None, remove=False):
+    """
+    Merges the outputs of the shards of a job in shard order. The header of each shard is written once, and
+    with unique pairs only the first line of each (hla, peptide) is kept, so the result does not depend on the
+    machine that ran each shard or the order in which they finished.
+    :param output: final output file
+    :param shards: number of shards (default read from the manifests)
+    :param remove: Boolean, remove the shard outputs and manifests once they are merged
+    :return: number of lines written, or None if the shards can not be merged
+    """
+    manifests = load_manifests(output, shards)
+    if manifests is None:
+        return None
+    directory = os.path.dirname(os.path.abspath(output))
+    base, extension = _split_extension(output)
+    tmp_file = "%s.tmp%s" % (base, extension)
+    if columnar.is_columnar(output):
+        table = columnar.concat_tables(
+            [
+                columnar.read_table(os.path.join(directory, manifest["output"]))
+                for manifest in manifests
+            ],
+            manifests[0]["unique_pairs"],
+        )
+        columnar.write_table(tmp_file, table)
+        os.replace(tmp_file, output)
+        written = columnar.table_rows(table)
+    else:
+        written = _merge_text(directory, manifests, tmp_file)
+        os.replace(tmp_file, output)
+    if remove:
+        for manifest in manifests:
+            shard_file = os.path.join(directory, manifest["output"])
+            os.remove(shard_file)
+            os.remove("%s.json" % shard_file)
+    return written
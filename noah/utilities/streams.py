@@ -0,0 +1,47 @@
+import gzip
+import os
+
+# Extensions of the compressed files that are read and written directly
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+# gzip level of the written files (the one of the gzip command, much faster than the maximum of python)
+GZIP_LEVEL = 6
+
+
+def split_compression(file_path):
+    """
+    Splits the compression extension of a file
+    :param file_path: path to the file
+    :return: tuple (path without the compression extension, extension or "")
+    """
+    base, extension = os.path.splitext(file_path)
+    if extension in COMPRESSIONS:
+        return base, extension
+    return file_path, ""
+
+
+def is_compressed(file_path):
+    return split_compression(file_path)[1] != ""
+
+
+def open_text(file_path, mode="r"):
+    """
+    Opens a text file, compressed with gzip (.gz) or zstd (.zst) or not compressed
+    :param file_path: path to the file
+    :param mode: r, w or a
+    :return: file object
+    """
+    compression = COMPRESSIONS.get(split_compression(file_path)[1])
+    if compression == "gzip":
+        if mode == "r":
+            return gzip.open(file_path, "rt")
+        return gzip.open(file_path, "%st" % mode, compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(
+                "Error: reading or writing %s requires the zstandard package "
+                "(pip install zstandard)\n" % file_path
+            )
+        return zstandard.open(file_path, "%st" % mode)
+    return open(file_path, mode)
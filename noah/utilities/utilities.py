@@ -1,8 +1,10 @@
 import multiprocessing as mp
+import os
 import pickle
 import sys
 
 import numpy as np
+from utilities import columnar, diagnostics, peptide_keys, pipeline, shards, streams
 
 
 def load_model(file_path):
@@ -20,22 +22,46 @@ def load_model(file_path):
         )
 
 
-def load_data(file_path):
+def save_checkpoint(obj, file_path):
+    """
+    Pickles an object to a checkpoint file. The object is written to a temporary file that then replaces
+    the final one, so an interrupted job never leaves a half written checkpoint behind.
+    :param obj: object to save
+    :param file_path: path of the checkpoint file
+    :return:
+    """
+    tmp_path = "%s.tmp" % file_path
+    with open(tmp_path, "wb") as out:
+        pickle.dump(obj, out)
+    os.replace(tmp_path, file_path)
+
+
+def load_checkpoint(file_path):
+    # Loads a checkpoint file, returns None if it does not exist
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, "rb") as inn:
+        return pickle.load(inn)
+
+
+def load_data(file_path, shard=None):
+    if columnar.is_columnar(file_path):
+        return columnar.table_pairs(shards.read_table(file_path, shard))
     data = []
     data_qual = {}
     try:
-        with open(file_path, "r") as inn:
-            for line in inn:
-                if line.startswith("peptide,HLA"):
-                    continue
-                line = line.rstrip()
-                line = line.split(",")
-                peptide = line[0]
-                hla = line[1]
-                data.append((peptide, hla))
-                if len(line) == 3:
-                    qualitativeValue = line[2]
-                    data_qual.setdefault(hla, {}).setdefault(peptide, qualitativeValue)
+        for line in shards.read_lines(file_path, shard):
+            if line.startswith("peptide,HLA"):
+                continue
+            line = line.rstrip()
+            # comma separated, or tab separated like the TEST_DATA file
+            line = line.split(",") if "," in line else line.split()
+            peptide = line[0]
+            hla = line[1]
+            data.append((peptide, hla))
+            if len(line) == 3:
+                qualitativeValue = line[2]
+                data_qual.setdefault(hla, {}).setdefault(peptide, qualitativeValue)
     except IOError:
         raise Exception("Error: input file not found\n")
     if data_qual:
@@ -44,6 +70,108 @@ def load_data(file_path):
         return data
 
 
+def load_data_batches(file_path, shard=None, size=pipeline.BATCH_SIZE):
+    """
+    Loads the (peptide, hla) pairs of a file in batches, so the first ones can be scored while the rest
+    of the file is read
+    :param file_path: path to the file (it can be compressed with gzip or zstd, or a columnar file)
+    :param shard: tuple (i, N) to load only the lines of one shard of the file, or None
+    :param size: number of pairs of each batch
+    :return: iterator over lists of tuples (peptide, hla)
+    """
+    if columnar.is_columnar(file_path):
+        table = shards.read_table(file_path, shard)
+        for start in range(0, columnar.table_rows(table), size):
+            yield columnar.table_pairs(columnar.slice_table(table, start, start + size))
+        return
+    batch = []
+    try:
+        for line in shards.read_lines(file_path, shard):
+            if line.startswith("peptide,HLA"):
+                continue
+            line = line.rstrip()
+            line = line.split(",") if "," in line else line.split()
+            if len(line) < 2:
+                continue
+            batch.append((line[0], line[1]))
+            if len(batch) == size:
+                yield batch
+                batch = []
+    except IOError:
+        raise Exception("Error: input file not found\n")
+    if batch:
+        yield batch
+
+
+def load_peptides(file_path, shard=None):
+    # Loads the peptides of the first column of a file (comma or whitespace separated) or of a columnar file
+    if columnar.is_columnar(file_path):
+        return shards.read_table(file_path, shard)["peptide"].tolist()
+    peptides = []
+    try:
+        for line in shards.read_lines(file_path, shard):
+            line = line.rstrip()
+            line = line.split(",") if "," in line else line.split()
+            if not line or line[0] == "peptide":
+                continue
+            peptides.append(line[0])
+    except IOError:
+        raise Exception("Error: input file not found\n")
+    return peptides
+
+
+def load_variants(file_path, shard=None):
+    """
+    Loads missense variants (comma or whitespace separated): protein position ref alt.
+    The position is 1-based, as in the usual variant annotations (for example p.R175H is TP53 175 R H)
+    :param file_path: path to the file
+    :param shard: tuple (i, N) to load only the lines of one shard of the file, or None
+    :return: list of tuples (protein, position, ref, alt)
+    """
+    variants = []
+    try:
+        for line in shards.read_lines(file_path, shard):
+            line = line.rstrip()
+            line = line.split(",") if "," in line else line.split()
+            if len(line) < 4 or line[0] == "protein":
+                continue
+            try:
+                position = int(line[1])
+            except ValueError:
+                diagnostics.record(
+                    diagnostics.SKIPPED_VARIANT,
+                    None,
+                    "invalid position %s, skipping" % line[1],
+                )
+                continue
+            variants.append((line[0], position, line[2], line[3]))
+    except IOError:
+        raise Exception("Error: input file not found\n")
+    return variants
+
+
+def load_fasta(file_path):
+    """
+    Loads the sequences of a fasta file
+    :param file_path: path to the file
+    :return: dict {name: sequence}, the name is the first word of the header
+    """
+    sequences = {}
+    name = None
+    try:
+        with streams.open_text(file_path, "r") as inn:
+            for line in inn:
+                line = line.strip()
+                if line.startswith(">"):
+                    name = line[1:].split()[0] if len(line) > 1 else ""
+                    sequences[name] = []
+                elif line and name is not None:
+                    sequences[name].append(line)
+    except IOError:
+        raise Exception("Error: input file not found\n")
+    return {name: "".join(lines) for name, lines in sequences.items()}
+
+
 def process_peptides(motif, data):
     results = {}
     for element in data:
@@ -55,28 +183,50 @@ def process_peptides(motif, data):
                 results.setdefault(processed_hla, {}).setdefault(
                     peptide, result[processed_hla][peptide]
                 )
-        except:
+        except Exception as error:
+            diagnostics.collector.error(
+                error, hla, "processing %s for HLA %s" % (peptide, hla)
+            )
             raise Exception(
                 "Error ocurred while processing %s for HLA %s\n" % (peptide, hla)
             )
     return results
 
 
-def score_peptides_paralleled(processors, loaded_data, motif):
-    pool = mp.Pool(processors)
+def score_peptides_paralleled(processors, loaded_data, motif, pool=None):
+    """
+    Scores the data splitting it between the given number of processors
+    :param processors: number of processors to use
+    :param loaded_data: list of tuples (peptide, hla)
+    :param motif: model to use to score the peptides
+    :param pool: multiprocessing pool to use instead of creating a new one (it is not terminated)
+    :return: dict {hla: {peptide: score}}
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = mp.Pool(processors)
     workers = []
+    # Repeated pairs are scored only once
+    loaded_data = peptide_keys.unique_pairs(loaded_data, motif.valid_letters)
     splited_data = np.array_split(loaded_data, processors)
     output_data = {}
     for i in range(processors):
-        workers.append(pool.apply_async(process_peptides, (motif, splited_data[i])))
+        workers.append(
+            pool.apply_async(
+                diagnostics.run_collected,
+                (process_peptides, motif, splited_data[i]),
+            )
+        )
     for worker in workers:
-        result = worker.get()
+        result, events = worker.get()
+        diagnostics.collector.merge(events)
         for hla in result:
             for peptide in result[hla]:
                 output_data.setdefault(hla, {}).setdefault(
                     peptide, result[hla][peptide]
                 )
-    pool.terminate()
+    if own_pool:
+        pool.terminate()
     return output_data
 
 
@@ -86,6 +236,6 @@ def print_motif(motif, hla):
     for i in range(motif_length):
         hla_num = motif.hla_to_num[motif.env_to_hla[i][hla][0]]
         for letter in motif.valid_letters:
-            value = motif.likelihood_matrix[i][hla_num][motif.letters_to_nums[letter]]
+            value = motif.get_likelihoods(i, hla_num)[motif.letters_to_nums[letter]]
             motif_dict.setdefault(i, {}).setdefault(letter, value)
     return motif_dict
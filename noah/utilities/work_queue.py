@@ -0,0 +1,254 @@
+import contextlib
+import os
+import shutil
+import socket
+import threading
+import uuid
+
+from utilities import utilities
+
+# Seconds between the updates of the lock of a task that is being run
+HEARTBEAT = 30
+# A lock that has not been updated for this number of seconds belongs to a dead worker and can be taken
+STALE_LOCK = 300
+# Seconds between the checks of a coordinator waiting for the tasks run by other workers
+POLL_INTERVAL = 10
+
+
+class WorkQueue:
+    """
+    Queue of tasks stored in a shared directory, so any number of workers on any host that sees the directory
+    can run them without a broker. The directory has:
+        state.pkl: the data shared by all the tasks of the job
+        tasks/<name>.pkl: the payload of each task
+        locks/<name>.lock: created with O_CREAT | O_EXCL by the worker that runs the task (atomic also on NFS)
+        results/<name>.pkl: the result of each finished task
+        job: id of the job, written once the state and the tasks are ready
+    The results and the tasks are tagged with the job id, so the results of an old job are never mixed with the
+    ones of a new job in the same directory. The workers update the time of their locks while they run a task,
+    and the lock of a worker that died is taken by another one once it is older than stale_lock seconds. The
+    ages are measured against a file touched in the directory, so the clocks of the hosts do not matter.
+    """
+
+    def __init__(self, directory, stale_lock=STALE_LOCK):
+        self.directory = directory
+        self.stale_lock = stale_lock
+
+    def _path(self, folder, name):
+        return os.path.join(self.directory, folder, name)
+
+    def _now(self):
+        # Current time of the file system of the directory
+        clock = os.path.join(self.directory, "clock")
+        with open(clock, "a"):
+            pass
+        os.utime(clock, None)
+        return os.stat(clock).st_mtime
+
+    def job(self):
+        # Id of the job of the directory (None until the coordinator has submitted it)
+        try:
+            with open(os.path.join(self.directory, "job"), "r") as inn:
+                return inn.read().strip() or None
+        except IOError:
+            return None
+
+    def submit(self, state, tasks, resume=False, config=None):
+        """
+        Writes the shared state and the tasks of a job
+        :param state: data shared by all the tasks (written once as state.pkl)
+        :param tasks: dict {name: payload}, names must be valid file names
+        :param resume: Boolean, keep the results of the previous job of the directory (it must have been
+        submitted with the same config)
+        :param config: hash of the configuration of the job, it is added to the job id
+        :return: id of the job
+        """
+        previous = self.job()
+        prefix = "%s-" % config if config else ""
+        if resume and previous and not previous.startswith(prefix):
+            raise Exception(
+                "Error: the queue %s was submitted with a different configuration\n"
+                % self.directory
+            )
+        job = previous if resume and previous else prefix + uuid.uuid4().hex
+        job_file = os.path.join(self.directory, "job")
+        if os.path.exists(job_file):
+            os.remove(job_file)
+        folders = ["tasks"] if resume else ["tasks", "results", "locks"]
+        for folder in folders:
+            shutil.rmtree(os.path.join(self.directory, folder), ignore_errors=True)
+        for folder in ["tasks", "results", "locks"]:
+            os.makedirs(os.path.join(self.directory, folder), exist_ok=True)
+        utilities.save_checkpoint(
+            {"job": job, "state": state}, os.path.join(self.directory, "state.pkl")
+        )
+        for name, payload in tasks.items():
+            if self.result(name, job) is None:
+                utilities.save_checkpoint(
+                    {"job": job, "payload": payload},
+                    self._path("tasks", "%s.pkl" % name),
+                )
+        tmp_file = "%s.tmp" % job_file
+        with open(tmp_file, "w") as out:
+            out.write(job)
+        os.replace(tmp_file, job_file)
+        return job
+
+    def state(self):
+        # Returns (job, state) or None if there is no state
+        loaded = utilities.load_checkpoint(os.path.join(self.directory, "state.pkl"))
+        if loaded is None:
+            return None
+        return loaded["job"], loaded["state"]
+
+    def result(self, name, job):
+        """
+        Result of a task
+        :param name: name of the task
+        :param job: id of the job
+        :return: result or None if the task of this job is not finished
+        """
+        loaded = utilities.load_checkpoint(self._path("results", "%s.pkl" % name))
+        if loaded is None or loaded["job"] != job:
+            return None
+        return loaded["result"]
+
+    def pending(self, names, job):
+        # Names of the tasks of a job that are not finished
+        return [name for name in names if self.result(name, job) is None]
+
+    def _acquire(self, name, steal=True):
+        # Creates the lock of a task, taking it if it is stale. Returns True if the task is ours
+        lock = self._path("locks", "%s.lock" % name)
+        try:
+            descriptor = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = self._now() - os.stat(lock).st_mtime
+            except FileNotFoundError:
+                return False
+            if not steal or age <= self.stale_lock:
+                return False
+            self._steal(lock)
+            return self._acquire(name, False)
+        with os.fdopen(descriptor, "w") as out:
+            out.write("%s %s\n" % (socket.gethostname(), os.getpid()))
+        return True
+
+    def _steal(self, lock):
+        # Removes a stale lock. Renaming it first makes sure that only one worker removes it
+        stolen = "%s.%s" % (lock, uuid.uuid4().hex)
+        try:
+            os.rename(lock, stolen)
+        except OSError:
+            return
+        if self._now() - os.stat(stolen).st_mtime <= self.stale_lock:
+            # Another worker took the task in the meantime, give its lock back
+            try:
+                os.link(stolen, lock)
+            except OSError:
+                pass
+        os.remove(stolen)
+
+    def release(self, name):
+        # Removes the lock of a task
+        try:
+            os.remove(self._path("locks", "%s.lock" % name))
+        except FileNotFoundError:
+            pass
+
+    def claim(self):
+        """
+        Claims the first task of the current job that is not finished nor run by another worker
+        :return: tuple (name, job, payload) or None if there is no task to claim
+        """
+        job = self.job()
+        if job is None:
+            return None
+        try:
+            files = sorted(os.listdir(os.path.join(self.directory, "tasks")))
+        except FileNotFoundError:
+            return None
+        for file_name in files:
+            if not file_name.endswith(".pkl"):
+                continue
+            name = file_name[: -len(".pkl")]
+            if self.result(name, job) is not None or not self._acquire(name):
+                continue
+            task = utilities.load_checkpoint(self._path("tasks", file_name))
+            if task is None or task["job"] != job or self.result(name, job) is not None:
+                # Finished while it was being claimed, or removed by a new job
+                self.release(name)
+                continue
+            return name, job, task["payload"]
+        return None
+
+    @contextlib.contextmanager
+    def hold(self, name):
+        """
+        Keeps the lock of a task updated while it runs. If the task fails the lock is released,
+        so another worker can run it.
+        :param name: name of the task
+        """
+        lock = self._path("locks", "%s.lock" % name)
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(HEARTBEAT):
+                try:
+                    os.utime(lock, None)
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            yield
+        except BaseException:
+            stop.set()
+            self.release(name)
+            raise
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, name, job, result):
+        """
+        Saves the result of a task and releases its lock
+        :param name: name of the task
+        :param job: id of the job of the task
+        :param result: result to save
+        :return:
+        """
+        if self.job() == job:
+            utilities.save_checkpoint(
+                {"job": job, "result": result}, self._path("results", "%s.pkl" % name)
+            )
+        self.release(name)
+
+
+def run_worker(directory, work):
+    """
+    Runs tasks of a queue until there is no task left to claim (the tasks run by other workers are not waited)
+    :param directory: directory of the queue
+    :param work: function(state, payload) that runs a task and returns its result
+    :return: number of tasks run
+    """
+    queue = WorkQueue(directory)
+    loaded = None
+    done = 0
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            return done
+        name, job, payload = claimed
+        with queue.hold(name):
+            if loaded is None or loaded[0] != job:
+                loaded = queue.state()
+            if loaded is None or loaded[0] != job:
+                # The job changed while the task was claimed
+                queue.release(name)
+                continue
+            result = work(loaded[1], payload)
+        queue.complete(name, job, result)
+        done += 1
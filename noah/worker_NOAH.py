@@ -0,0 +1,79 @@
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+
+from predictor.Model_builder import refine_worker
+from utilities import work_queue
+
+
+def parse_args():
+    """
+    Parse command line arguments
+    :returns:
+    """
+    desc = """Script that helps to refine a model that is being trained with train_NOAH.py --queue. It runs the
+    refinement tasks of the queue directory (one per HLA) until there is no task left and exits. It can be started
+    on any host that sees the directory, as many times as wanted."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument(
+        "-queue",
+        required=True,
+        help="Queue directory given to train_NOAH.py --queue",
+    )
+    parser.add_argument(
+        "-processors", default=1, type=int, help="Number of processors to use"
+    )
+    parser.add_argument(
+        "-wait",
+        default=0,
+        type=int,
+        help="Seconds to wait for train_NOAH.py to write the tasks (workers can be started before it). "
+        "default 0",
+    )
+    args = parser.parse_args()
+    return args.queue, args.processors, args.wait
+
+
+def queue_directories(queue_dir):
+    # Directories with a submitted job: the queue or, when several lengths are trained, its length_N folders
+    directories = [queue_dir] + [
+        os.path.join(queue_dir, name)
+        for name in sorted(os.listdir(queue_dir))
+        if name.startswith("length_")
+    ]
+    return [x for x in directories if work_queue.WorkQueue(x).job() is not None]
+
+
+def run_queues(directories):
+    # Runs the tasks of all the queues, returns the number of hlas refined
+    return sum(refine_worker(directory) for directory in directories)
+
+
+def main(queue_dir, processors=1, wait=0):
+    start = time.time()
+    while True:
+        directories = queue_directories(queue_dir) if os.path.isdir(queue_dir) else []
+        if directories or time.time() - start >= wait:
+            break
+        time.sleep(work_queue.POLL_INTERVAL)
+    if not directories:
+        sys.stderr.write("Error: no refinement job found in %s\n" % queue_dir)
+        exit(1)
+    print("Refining the HLAs of %s" % " ".join(directories))
+    if processors > 1:
+        pool = mp.Pool(processors)
+        workers = [
+            pool.apply_async(run_queues, (directories,)) for _ in range(processors)
+        ]
+        refined = sum(worker.get() for worker in workers)
+        pool.terminate()
+    else:
+        refined = run_queues(directories)
+    print("%s HLAs refined, no tasks left" % refined)
+
+
+if __name__ == "__main__":
+    queue_dir, processors, wait = parse_args()
+    main(queue_dir, processors, wait)